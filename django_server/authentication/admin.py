@@ -1,40 +1,129 @@
+from django.conf import settings
 from django.contrib import admin
-from .models import User, Patient, Doctor, Prediction, Report, Appointment, Message
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Max, Min
+from django.utils.functional import cached_property
+from .models import User, Patient, Doctor, Prediction, Report, Appointment, Message, NotificationEvent, OutboxEvent, ConsumerOffset
+
+
+class EstimatedCountPaginator(Paginator):
+    """Paginator that skips the exact COUNT(*) for unfiltered large tables.
+
+    A COUNT capped at ADMIN_ESTIMATED_COUNT_THRESHOLD + 1 rows tells small
+    tables, which get that exact count, from large ones. For those,
+    PostgreSQL uses the planner's row estimate from pg_class; other backends
+    use the primary key range, an index lookup that overestimates once rows
+    have been deleted or archived. Filtered changelists always get an exact
+    count.
+    """
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        query = getattr(queryset, 'query', None)
+        if query is not None and not query.where:
+            threshold = getattr(settings, 'ADMIN_ESTIMATED_COUNT_THRESHOLD', 10000)
+            # Reads at most threshold + 1 index entries, however big the table
+            capped = queryset.order_by()[:threshold + 1].count()
+            if capped <= threshold:
+                return capped
+            estimate = self._estimate(queryset)
+            return max(estimate or 0, capped)
+        return super().count
+
+    def _estimate(self, queryset):
+        model = queryset.model
+        connection = connections[queryset.db]
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    'SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass',
+                    [model._meta.db_table],
+                )
+                row = cursor.fetchone()
+            return row[0] if row and row[0] > 0 else None
+        bounds = model._default_manager.using(queryset.db).aggregate(low=Min('pk'), high=Max('pk'))
+        if bounds['high'] is None:
+            return 0
+        return bounds['high'] - bounds['low'] + 1
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    paginator = EstimatedCountPaginator
+    # Avoids the second, unfiltered COUNT(*) behind "N total"
+    show_full_result_count = False
+    # Newest first along the primary key, the index the paginator's estimate uses
+    ordering = ('-id',)
 
 @admin.register(User)
-class UserAdmin(admin.ModelAdmin):
+class UserAdmin(LargeTableAdmin):
     list_display = ('email', 'role', 'is_active', 'date_joined')
     list_filter = ('role', 'is_active')
     search_fields = ('email',)
 
 @admin.register(Patient)
-class PatientAdmin(admin.ModelAdmin):
+class PatientAdmin(LargeTableAdmin):
     list_display = ('name', 'age', 'gender', 'mail_id')
     list_filter = ('gender',)
     search_fields = ('name', 'mail_id')
+    raw_id_fields = ('user',)
 
 @admin.register(Doctor)
 class DoctorAdmin(admin.ModelAdmin):
     list_display = ('fam_dr_name', 'fam_dr_edu', 'fam_dr_hospital', 'fam_dr_hospital_location')
     search_fields = ('fam_dr_name', 'fam_dr_hospital')
+    raw_id_fields = ('user',)
 
 @admin.register(Prediction)
-class PredictionAdmin(admin.ModelAdmin):
+class PredictionAdmin(LargeTableAdmin):
     list_display = ('disease', 'confidence', 'user', 'timestamp')
     list_filter = ('disease',)
+    list_select_related = ('user',)
     search_fields = ('disease', 'user__email')
+    raw_id_fields = ('user',)
 
 @admin.register(Report)
-class ReportAdmin(admin.ModelAdmin):
+class ReportAdmin(LargeTableAdmin):
     list_display = ('patient_name', 'patient', 'prediction', 'created_at')
+    list_select_related = ('patient', 'prediction')
     search_fields = ('patient_name', 'patient__email')
+    raw_id_fields = ('patient', 'prediction')
 
 @admin.register(Appointment)
-class AppointmentAdmin(admin.ModelAdmin):
+class AppointmentAdmin(LargeTableAdmin):
     list_display = ('patient', 'doctor', 'date', 'time', 'status')
     list_filter = ('status', 'date')
+    list_select_related = ('patient', 'doctor')
+    raw_id_fields = ('patient', 'prediction')
+    autocomplete_fields = ('doctor',)
+
+    def get_queryset(self, request):
+        # __str__ on the change form also reads patient.email and doctor.fam_dr_name
+        return super().get_queryset(request).select_related('patient', 'doctor')
 
 @admin.register(Message)
-class MessageAdmin(admin.ModelAdmin):
+class MessageAdmin(LargeTableAdmin):
     list_display = ('sender', 'receiver', 'timestamp', 'is_read')
-    list_filter = ('is_read', 'timestamp')
\ No newline at end of file
+    list_filter = ('is_read', 'timestamp')
+    list_select_related = ('sender', 'receiver')
+    raw_id_fields = ('sender', 'receiver')
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('sender', 'receiver')
+
+@admin.register(NotificationEvent)
+class NotificationEventAdmin(LargeTableAdmin):
+    list_display = ('kind', 'recipient', 'created_at', 'attempts', 'delivered_at', 'failed_at')
+    list_filter = ('kind',)
+    list_select_related = ('recipient',)
+    raw_id_fields = ('recipient',)
+
+@admin.register(OutboxEvent)
+class OutboxEventAdmin(LargeTableAdmin):
+    list_display = ('id', 'aggregate', 'aggregate_id', 'action', 'created_at')
+    list_filter = ('aggregate', 'action')
+
+@admin.register(ConsumerOffset)
+class ConsumerOffsetAdmin(admin.ModelAdmin):
+    list_display = ('consumer', 'database', 'position', 'updated_at')
@@ -0,0 +1,293 @@
+"""Vectorized disease trend analytics over Prediction history.
+
+Prediction rows (hot on every shard, and archived) are pulled in chunks into
+flat NumPy columns once per snapshot. Every aggregate below is then computed with
+array operations over those columns: no Python loop touches the
+individual rows.
+
+A snapshot is reloaded when the newest prediction event in the outbox moves
+(any insert, edit, delete, archive move or re-scoring appends one), and in
+any case once it is ANALYTICS_SNAPSHOT_MAX_AGE seconds old.
+"""
+import threading
+import time
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Max
+from django.db.models.functions import TruncDate
+
+from .models import ArchivedPrediction, ArchiveWatermark, OutboxEvent, Prediction, RescoreCheckpoint
+from .sharding import fan_out, shards
+
+GROUP_FIELDS = ('disease', 'body_part')
+PERCENTILES = (10, 25, 50, 75, 90)
+HISTOGRAM_EDGES = np.linspace(0, 100, 11)
+
+_snapshot_lock = threading.Lock()
+_snapshot = None
+
+
+class PredictionColumns:
+    """Columnar copy of the prediction history."""
+
+    def __init__(self, days, confidence, codes, vocab, version):
+        self.days = days              # int32 days since 1970-01-01
+        self.confidence = confidence  # float32
+        self.codes = codes            # {field: int32 codes into vocab[field]}
+        self.vocab = vocab            # {field: list of labels}
+        self.version = version
+        self.loaded_at = time.monotonic()
+
+    def __len__(self):
+        return len(self.days)
+
+
+def snapshot_version():
+    """Cheap fingerprint of the prediction tables used to key snapshots."""
+    if getattr(settings, 'OUTBOX_ENABLED', True):
+        latest = fan_out(lambda alias: OutboxEvent.objects.using(alias).filter(aggregate='prediction')
+                         .aggregate(v=Max('id'))['v'])
+        return 'outbox:' + ','.join(str(top or 0) for top in latest)
+
+    # Without the outbox, deletes and most edits go unnoticed until the max age
+    hot_max = ','.join(str(top or 0) for top in fan_out(
+        lambda alias: Prediction.objects.using(alias).aggregate(v=Max('id'))['v']
+    ))
+    archived = sum(
+        ArchiveWatermark.objects.filter(kind='predictions').values_list('archived_count', flat=True)
+    )
+    # Re-scoring rewrites diseases in place without adding rows
+    rescored = RescoreCheckpoint.objects.aggregate(v=Max('updated_at'))['v']
+    return f'{hot_max}:{archived}:{rescored.timestamp() if rescored else 0}'
+
+
+def _encode(values, lookup, vocab):
+    uniques, inverse = np.unique(np.asarray(values, dtype=object), return_inverse=True)
+    mapping = np.empty(len(uniques), dtype=np.int32)
+    for i, label in enumerate(uniques):
+        if label not in lookup:
+            lookup[label] = len(vocab)
+            vocab.append(label)
+        mapping[i] = lookup[label]
+    return mapping[inverse]
+
+
+def load_columns(chunk_size=None, version=None):
+    chunk_size = chunk_size or getattr(settings, 'ANALYTICS_CHUNK_SIZE', 50000)
+    lookups = {field: {} for field in GROUP_FIELDS}
+    vocab = {field: [] for field in GROUP_FIELDS}
+    days, confidence = [], []
+    codes = {field: [] for field in GROUP_FIELDS}
+
+    sources = [Prediction.objects.using(alias) for alias in shards()] + [ArchivedPrediction.objects.all()]
+    for queryset in sources:
+        rows = (
+            queryset
+            .annotate(day=TruncDate('timestamp'))
+            .values_list('day', 'confidence', *GROUP_FIELDS)
+            .order_by()
+            .iterator(chunk_size=chunk_size)
+        )
+        while True:
+            chunk = [row for _, row in zip(range(chunk_size), rows)]
+            if not chunk:
+                break
+            day_col, conf_col, *group_cols = zip(*chunk)
+            days.append(np.array(day_col, dtype='datetime64[D]').astype(np.int32))
+            confidence.append(np.array(conf_col, dtype=np.float32))
+            for field, col in zip(GROUP_FIELDS, group_cols):
+                codes[field].append(_encode(col, lookups[field], vocab[field]))
+
+    def concat(parts, dtype):
+        return np.concatenate(parts) if parts else np.empty(0, dtype=dtype)
+
+    return PredictionColumns(
+        days=concat(days, np.int32),
+        confidence=concat(confidence, np.float32),
+        codes={field: concat(codes[field], np.int32) for field in GROUP_FIELDS},
+        vocab=vocab,
+        version=version,
+    )
+
+
+def current_columns():
+    """Return the in-process column snapshot, reloading it when stale."""
+    global _snapshot
+    version = snapshot_version()
+    max_age = getattr(settings, 'ANALYTICS_SNAPSHOT_MAX_AGE', 600)
+    with _snapshot_lock:
+        if (_snapshot is None or _snapshot.version != version
+                or time.monotonic() - _snapshot.loaded_at > max_age):
+            _snapshot = load_columns(version=version)
+        return _snapshot
+
+
+def group_codes(columns, group_by):
+    """Combine one or more categorical columns into dense group codes."""
+    combined = np.zeros(len(columns), dtype=np.int64)
+    key_space = 1
+    for field in group_by:
+        combined = combined * len(columns.vocab[field]) + columns.codes[field]
+        key_space *= len(columns.vocab[field])
+
+    if key_space <= 4 * len(columns) + 1024:
+        # Dense remap in O(n) instead of sorting all keys
+        present = np.bincount(combined, minlength=key_space) > 0
+        uniques = np.flatnonzero(present)
+        inverse = (np.cumsum(present) - 1)[combined]
+    else:
+        uniques, inverse = np.unique(combined, return_inverse=True)
+
+    labels = []
+    for value in uniques:
+        parts = []
+        for field in reversed(group_by):
+            size = len(columns.vocab[field])
+            parts.append(columns.vocab[field][value % size])
+            value //= size
+        labels.append(' / '.join(reversed(parts)) if len(parts) > 1 else parts[0])
+    return inverse.astype(np.int64), labels
+
+
+def grouped_percentiles(groups, values, n_groups, percentiles=PERCENTILES):
+    """Linear-interpolated percentiles per group, computed in one pass."""
+    values = values.astype(np.float64)
+    if len(values):
+        # Sort once on a single float key: group in the integer part, the
+        # value rescaled into [0, 1) in the fraction. Cheaper than lexsort.
+        low, span = values.min(), np.ptp(values) or 1.0
+        order = np.argsort(groups + (values - low) / (span * (1 + 1e-9)), kind='stable')
+    else:
+        order = np.empty(0, dtype=np.int64)
+    sorted_values = values[order]
+    sizes = np.bincount(groups, minlength=n_groups)
+    starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+
+    q = np.asarray(percentiles, dtype=np.float64) / 100.0
+    position = starts[:, None] + q[None, :] * np.maximum(sizes - 1, 0)[:, None]
+    lower = np.floor(position).astype(np.int64)
+    upper = np.minimum(lower + 1, starts[:, None] + np.maximum(sizes - 1, 0)[:, None])
+    weight = position - lower
+
+    if not len(sorted_values):
+        return np.full((n_groups, len(q)), np.nan)
+    # Empty groups point one past the end; clip them and blank them out below
+    lower = np.minimum(lower, len(sorted_values) - 1)
+    upper = np.minimum(upper, len(sorted_values) - 1)
+    result = sorted_values[lower] * (1 - weight) + sorted_values[upper] * weight
+    result[sizes == 0] = np.nan
+    return result
+
+
+def compute_trends(days, confidence, groups, n_groups, window=7):
+    """Daily counts, rolling means, percentiles and histograms per group."""
+    if not len(days):
+        return {'firstDay': None, 'counts': np.zeros((n_groups, 0), dtype=np.int64),
+                'rolling': np.zeros((n_groups, 0)), 'percentiles': np.full((n_groups, len(PERCENTILES)), np.nan),
+                'histogram': np.zeros((n_groups, len(HISTOGRAM_EDGES) - 1), dtype=np.int64),
+                'totals': np.zeros(n_groups, dtype=np.int64)}
+
+    first_day = int(days.min())
+    span = int(days.max()) - first_day + 1
+    counts = np.bincount(
+        groups * span + (days - first_day), minlength=n_groups * span
+    ).reshape(n_groups, span)
+
+    window = max(1, min(window, span))
+    cumulative = np.cumsum(np.pad(counts, ((0, 0), (1, 0))), axis=1)
+    rolling = np.empty((n_groups, span), dtype=np.float64)
+    rolling[:, window - 1:] = (cumulative[:, window:] - cumulative[:, :-window]) / window
+    # Shorter leading windows average over the days seen so far
+    rolling[:, :window - 1] = cumulative[:, 1:window] / np.arange(1, window)
+
+    buckets = np.clip(np.digitize(confidence, HISTOGRAM_EDGES[1:-1]), 0, len(HISTOGRAM_EDGES) - 2)
+    histogram = np.bincount(
+        groups * (len(HISTOGRAM_EDGES) - 1) + buckets,
+        minlength=n_groups * (len(HISTOGRAM_EDGES) - 1),
+    ).reshape(n_groups, -1)
+
+    return {
+        'firstDay': first_day,
+        'counts': counts,
+        'rolling': rolling,
+        'percentiles': grouped_percentiles(groups, confidence, n_groups),
+        'histogram': histogram,
+        'totals': counts.sum(axis=1),
+    }
+
+
+def disease_trends(group_by=('disease',), window=7, start=None, end=None):
+    """JSON-ready trend report, cached per snapshot version and parameters."""
+    columns = current_columns()
+    cache_key = 'analytics:trends:{}:{}:{}:{}:{}:{}'.format(
+        columns.version, columns.loaded_at, ','.join(group_by), window, start, end
+    )
+    cached = cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    mask = np.ones(len(columns), dtype=bool)
+    if start is not None:
+        mask &= columns.days >= np.datetime64(start, 'D').astype(np.int32)
+    if end is not None:
+        mask &= columns.days <= np.datetime64(end, 'D').astype(np.int32)
+
+    groups, labels = group_codes(columns, group_by)
+    trends = compute_trends(columns.days[mask], columns.confidence[mask], groups[mask], len(labels), window)
+
+    first_day = trends['firstDay']
+    report = {
+        'groupBy': list(group_by),
+        'window': window,
+        'firstDay': None if first_day is None else str(np.datetime64(first_day, 'D')),
+        'groups': [],
+    }
+    for i, label in enumerate(labels):
+        if not trends['totals'][i]:
+            continue
+        report['groups'].append({
+            'key': label,
+            'total': int(trends['totals'][i]),
+            'dailyCounts': trends['counts'][i].tolist(),
+            'rollingMean': np.round(trends['rolling'][i], 3).tolist(),
+            'confidencePercentiles': {
+                f'p{p}': round(float(v), 2) for p, v in zip(PERCENTILES, trends['percentiles'][i])
+            },
+            'confidenceHistogram': trends['histogram'][i].tolist(),
+        })
+    report['histogramEdges'] = HISTOGRAM_EDGES.tolist()
+
+    cache.set(cache_key, report, getattr(settings, 'ANALYTICS_CACHE_SECONDS', 300))
+    return report
+
+
+def synthetic_columns(rows, n_diseases=30, n_body_parts=12, days=3 * 365, seed=0):
+    """Random prediction columns for benchmarking without a database."""
+    rng = np.random.default_rng(seed)
+    return PredictionColumns(
+        days=rng.integers(19000, 19000 + days, rows, dtype=np.int32),
+        confidence=(rng.beta(5, 2, rows) * 100).astype(np.float32),
+        codes={
+            'disease': rng.integers(0, n_diseases, rows, dtype=np.int32),
+            'body_part': rng.integers(0, n_body_parts, rows, dtype=np.int32),
+        },
+        vocab={
+            'disease': [f'disease-{i}' for i in range(n_diseases)],
+            'body_part': [f'part-{i}' for i in range(n_body_parts)],
+        },
+        version='synthetic',
+    )
+
+
+def benchmark(rows=10_000_000, window=7):
+    """Time the vectorized aggregation on ``rows`` synthetic predictions."""
+    columns = synthetic_columns(rows)
+    timings = {}
+    for group_by in (('disease',), ('disease', 'body_part')):
+        started = time.perf_counter()
+        groups, labels = group_codes(columns, group_by)
+        compute_trends(columns.days, columns.confidence, groups, len(labels), window)
+        timings[','.join(group_by)] = time.perf_counter() - started
+    return timings
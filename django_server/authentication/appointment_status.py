@@ -0,0 +1,171 @@
+"""Appointment status state machine.
+
+Every status change is a compare-and-set: a conditional
+``UPDATE appointment SET status = <to> WHERE id = ... AND status = <from>``
+touching only the status column. There is no prior SELECT and no row lock.
+When two transitions race (confirm vs. cancel), the second one's UPDATE for
+the old status matches zero rows, and it is applied from the status the
+first left instead, so rollups and the change feed see both steps.
+"""
+from collections import defaultdict
+
+from django.db import router
+from django.db.models import Value
+from django.db.models.functions import Coalesce
+
+from . import notifications
+from .models import Appointment
+from .outbox import record
+from .rollups import GENERAL_CONSULTATION, bump_many, record_status_change
+from .sharding import group_by_shard, locate, use_shard
+from .writer import write_transactions
+
+# Per role: target status -> statuses it may be reached from, most likely
+# first. This is the policy update_appointment_status always had: any status
+# may be set from any other, patients may only cancel (their own
+# appointments), doctors may set anything but cancelled, staff anything.
+TRANSITIONS = {
+    'patient': {'cancelled': ('pending', 'confirmed', 'completed')},
+    'doctor': {
+        'pending': ('confirmed', 'cancelled', 'completed'),
+        'confirmed': ('pending', 'completed', 'cancelled'),
+        'completed': ('confirmed', 'pending', 'cancelled'),
+    },
+}
+TRANSITIONS['staff'] = {**TRANSITIONS['doctor'], **TRANSITIONS['patient']}
+
+# cancel_appointment also lets doctors cancel: they manage appointments centrally
+CANCEL_TRANSITIONS = {**TRANSITIONS, 'doctor': TRANSITIONS['patient']}
+
+# transition() outcomes
+APPLIED = 'applied'
+UNCHANGED = 'unchanged'
+NOT_FOUND = 'not_found'
+FORBIDDEN = 'forbidden'
+CONFLICT = 'conflict'
+
+
+def role_for(user):
+    if user.is_staff:
+        return 'staff'
+    if getattr(user, 'role', None) == 'doctor':
+        return 'doctor'
+    return 'patient'
+
+
+def _scoped(user, role):
+    appointments = Appointment.objects.all()
+    if role == 'patient':
+        appointments = appointments.filter(patient=user)
+    return appointments
+
+
+def transition(user, appointment_id, new_status, transitions=TRANSITIONS):
+    """Apply one status change; return ``(outcome, current_status)``.
+
+    Each allowed source status gets one conditional UPDATE, most likely
+    first, so the happy path is a single statement. The authorization scope
+    is part of the WHERE clause. Only when nothing matched does one SELECT
+    tell not-found, forbidden, unchanged and conflict apart.
+    """
+    with use_shard(locate(Appointment, appointment_id)):
+        return _transition(user, appointment_id, new_status, transitions)
+
+
+def _transition(user, appointment_id, new_status, transitions):
+    role = role_for(user)
+    allowed_from = transitions[role].get(new_status)
+    if not allowed_from:
+        return FORBIDDEN, None
+
+    scoped = _scoped(user, role).filter(id=appointment_id)
+    with write_transactions(using=router.db_for_write(Appointment)):
+        for old_status in allowed_from:
+            if scoped.filter(status=old_status).update(status=new_status):
+                record_status_change(appointment_id, old_status, new_status)
+                record(Appointment, [appointment_id], status=new_status)
+                if new_status == 'confirmed':
+                    notifications.appointment_confirmed(appointment_id)
+                return APPLIED, new_status
+
+    row = Appointment.objects.filter(id=appointment_id).values('patient_id', 'status').first()
+    if row is None:
+        return NOT_FOUND, None
+    if role == 'patient' and row['patient_id'] != user.id:
+        return FORBIDDEN, None
+    if row['status'] == new_status:
+        return UNCHANGED, new_status
+    return CONFLICT, row['status']
+
+
+def bulk_transition(user, appointment_ids, new_status):
+    """Move ``appointment_ids`` to ``new_status``; return ``{id: (ok, message)}``.
+
+    One SELECT loads and authorizes the whole batch. Then, per source status,
+    the rows still in it are locked and exactly those are updated, so a row
+    another writer moved in the meantime is reported as lost even when it
+    reached the same status. With sharding, each shard's share of the ids is
+    handled that way.
+    """
+    results = {}
+    for alias, ids in group_by_shard(Appointment, appointment_ids).items():
+        with use_shard(alias):
+            results.update(_bulk_transition(user, ids, new_status))
+    return {apt_id: results[apt_id] for apt_id in appointment_ids}
+
+
+def _bulk_transition(user, appointment_ids, new_status):
+    role = role_for(user)
+    allowed_from = TRANSITIONS[role].get(new_status)
+    if not allowed_from:
+        message = 'Patients can only cancel appointments'
+        return {apt_id: (False, message) for apt_id in appointment_ids}
+
+    rows = {
+        row['id']: row
+        for row in Appointment.objects.filter(id__in=appointment_ids)
+        .annotate(disease=Coalesce('prediction__disease', Value(GENERAL_CONSULTATION)))
+        .values('id', 'patient_id', 'doctor_id', 'date', 'status', 'disease')
+    }
+
+    results = {}
+    by_status = defaultdict(list)
+    for apt_id in appointment_ids:
+        row = rows.get(apt_id)
+        if row is None:
+            results[apt_id] = (False, 'Appointment not found')
+        elif role == 'patient' and row['patient_id'] != user.id:
+            results[apt_id] = (False, 'Not authorized to update this appointment')
+        elif row['status'] == new_status:
+            results[apt_id] = (True, f'Appointment already {new_status}')
+        elif row['status'] not in allowed_from:
+            results[apt_id] = (False, f"Cannot change status from {row['status']} to {new_status}")
+        else:
+            by_status[row['status']].append(apt_id)
+
+    deltas = defaultdict(int)
+    confirmed = []
+    with write_transactions(using=router.db_for_write(Appointment)):
+        for old_status, ids in by_status.items():
+            # FOR UPDATE rechecks the status of rows it waited for (on SQLite
+            # the IMMEDIATE transaction already keeps other writers out)
+            changed = set(
+                Appointment.objects.select_for_update().filter(id__in=ids, status=old_status)
+                .values_list('id', flat=True)
+            )
+            Appointment.objects.filter(id__in=changed).update(status=new_status)
+            for apt_id in ids:
+                if apt_id in changed:
+                    row = rows[apt_id]
+                    deltas[('appointment', row['date'], row['doctor_id'], old_status, row['disease'])] -= 1
+                    deltas[('appointment', row['date'], row['doctor_id'], new_status, row['disease'])] += 1
+                    results[apt_id] = (True, f'Appointment status updated to {new_status}')
+                    confirmed.append(row)
+                else:
+                    results[apt_id] = (False, 'Appointment status changed concurrently')
+            record(Appointment, [apt_id for apt_id in ids if apt_id in changed], status=new_status)
+        bump_many(deltas)
+        if new_status == 'confirmed':
+            notifications.appointments_confirmed(confirmed)
+
+    return {apt_id: results[apt_id] for apt_id in appointment_ids}
@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class AuthenticationConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'authentication'
+
+    def ready(self):
+        # Connects the shard replication, per-request tenant, outbox,
+        # similarity tombstone and doctor cache invalidation signals
+        from . import outbox, sharding, similarity, views  # noqa: F401
@@ -0,0 +1,153 @@
+"""Hot/cold archival of Prediction and Message rows.
+
+Rows older than ``settings.ARCHIVE_HORIZON_DAYS`` are moved into the
+``Archived*`` tables in small batches. Every batch copies and deletes inside
+one transaction, so an interrupted run can simply be started again.
+
+List views page through the hot table by descending id and only query the
+archive once the page reaches ids at or below the archive watermark. With
+shards, the hot page is read from every shard and merged; archiving itself
+only knows ``default`` and refuses to run while SHARDS is set. Callers that
+ask for no page (neither ``cursor`` nor ``limit``) get every row, newest
+first, as the list views always returned them.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from . import sharding
+from .models import (
+    ArchivedMessage,
+    ArchivedPrediction,
+    ArchiveWatermark,
+    Message,
+    Prediction,
+)
+from .outbox import muted, record
+from .writer import write_transaction
+
+
+def _prediction_candidates(cutoff):
+    # Predictions still referenced by an appointment or report stay hot;
+    # deleting them would cascade into those rows.
+    return Prediction.objects.filter(
+        timestamp__lt=cutoff,
+        appointment__isnull=True,
+        report__isnull=True,
+    )
+
+
+def _message_candidates(cutoff):
+    return Message.objects.filter(timestamp__lt=cutoff)
+
+
+ARCHIVE_KINDS = {
+    'predictions': (Prediction, ArchivedPrediction, _prediction_candidates),
+    'messages': (Message, ArchivedMessage, _message_candidates),
+}
+
+
+def default_cutoff():
+    return timezone.now() - timedelta(days=getattr(settings, 'ARCHIVE_HORIZON_DAYS', 180))
+
+
+def archive_batch(kind, cutoff, batch_size):
+    """Move up to ``batch_size`` rows of ``kind`` older than ``cutoff``.
+
+    Returns the number of rows moved; 0 means there is nothing left to do.
+    """
+    if sharding.enabled():
+        raise ImproperlyConfigured('Archiving reads and writes default only; it cannot run with SHARDS set')
+    hot_model, archive_model, candidates = ARCHIVE_KINDS[kind]
+    columns = [field.attname for field in hot_model._meta.concrete_fields]
+
+    with write_transaction():
+        rows = list(
+            candidates(cutoff).order_by('id').values(*columns)[:batch_size]
+        )
+        if not rows:
+            return 0
+        ids = [row['id'] for row in rows]
+        # ignore_conflicts keeps a re-run idempotent if rows were already copied
+        archive_model.objects.bulk_create(
+            [archive_model(**row) for row in rows], ignore_conflicts=True
+        )
+        # One 'archived' event per row rather than a 'deleted' one from the signal
+        with muted():
+            hot_model.objects.filter(id__in=ids).delete()
+        record(hot_model, ids, 'archived')
+
+        watermark, _ = ArchiveWatermark.objects.get_or_create(kind=kind)
+        ArchiveWatermark.objects.filter(pk=watermark.pk).update(
+            max_id=Greatest(F('max_id'), max(ids)),
+            archived_count=F('archived_count') + len(ids),
+        )
+    return len(ids)
+
+
+def archive_watermark(kind):
+    return (
+        ArchiveWatermark.objects.filter(kind=kind)
+        .values_list('max_id', flat=True)
+        .first()
+        or 0
+    )
+
+
+def wants_page(request):
+    """Whether the request asked for paging (``cursor`` or ``limit``)."""
+    return 'cursor' in request.query_params or 'limit' in request.query_params
+
+
+def parse_page_params(request):
+    """Read ``cursor`` and ``limit`` query params, clamped to sane values."""
+    default_limit = getattr(settings, 'API_PAGE_SIZE', 100)
+    max_limit = getattr(settings, 'API_MAX_PAGE_SIZE', 500)
+    try:
+        limit = int(request.query_params.get('limit', default_limit))
+    except (TypeError, ValueError):
+        limit = default_limit
+    limit = max(1, min(limit, max_limit))
+
+    try:
+        cursor = int(request.query_params.get('cursor'))
+    except (TypeError, ValueError):
+        cursor = None
+    return cursor, limit
+
+
+def read_page(kind, hot_qs, archive_qs, cursor=None, limit=100):
+    """Return ``(rows, next_cursor)`` ordered by descending id, across every shard.
+
+    The archive is only consulted when the hot page is short or ends at an
+    id that could have archived neighbours, i.e. when the cursor has reached
+    the archived range.
+    """
+    if cursor is not None:
+        hot_qs = hot_qs.filter(id__lt=cursor)
+        archive_qs = archive_qs.filter(id__lt=cursor)
+
+    pages = sharding.fan_out(lambda alias: list(hot_qs.using(alias).order_by('-id')[:limit]))
+    rows = sharding.merge_sorted(pages, key=lambda row: row.id, reverse=True)[:limit]
+    floor = rows[-1].id if len(rows) == limit else 0
+
+    if archive_watermark(kind) > floor:
+        cold = list(archive_qs.filter(id__gt=floor).order_by('-id')[:limit])
+        if cold:
+            rows = sorted(rows + cold, key=lambda row: row.id, reverse=True)[:limit]
+
+    next_cursor = str(rows[-1].id) if len(rows) == limit else None
+    return rows, next_cursor
+
+
+def read_all(kind, hot_qs, archive_qs):
+    """Every row, hot on every shard and archived, by descending timestamp."""
+    newest_first = ('-timestamp', '-id')
+    sources = sharding.fan_out(lambda alias: list(hot_qs.using(alias).order_by(*newest_first)))
+    if archive_watermark(kind):
+        sources.append(list(archive_qs.order_by(*newest_first)))
+    return sharding.merge_sorted(sources, key=lambda row: (row.timestamp, row.id), reverse=True)
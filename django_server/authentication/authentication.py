@@ -4,6 +4,8 @@ import jwt
 from django.conf import settings
 from django.contrib.auth import get_user_model
 
+from . import sharding
+
 User = get_user_model()
 
 
@@ -46,4 +48,5 @@ class SimpleJWTAuthentication(BaseAuthentication):
         except User.DoesNotExist:
             raise exceptions.AuthenticationFailed('User not found')
 
+        sharding.activate(user)
         return (user, token)
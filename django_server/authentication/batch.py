@@ -0,0 +1,173 @@
+"""Multiplex several API calls over one HTTP round trip.
+
+Each sub-request is resolved with the URL resolver and handed straight to
+the view, reusing the user the outer request already authenticated.
+Consecutive GETs run concurrently on a thread pool. A write is a barrier,
+so writes still execute in the order the client sent them.
+
+Each sub-request runs through the project's middleware stack like a
+request of its own: it is admitted in the admission class of its own view
+(a batched login waits in ``auth``, a batched export in ``heavy``) and shed
+with a 503 of its own when that class is full. A view that raises fails
+only its own item, with a 500.
+"""
+import contextvars
+import io
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core.exceptions import PermissionDenied
+from django.core.handlers.base import BaseHandler
+from django.db import close_old_connections
+from django.http import Http404, HttpRequest, JsonResponse, QueryDict
+from django.urls import Resolver404, resolve
+
+ALLOWED_METHODS = ('GET', 'POST', 'PUT', 'PATCH', 'DELETE')
+API_PREFIX = '/api/auth/'
+
+logger = logging.getLogger(__name__)
+
+_pool = None
+_handler = None
+
+
+class BatchError(ValueError):
+    """A sub-request that cannot be dispatched at all."""
+
+
+class SubRequestHandler(BaseHandler):
+    """The middleware stack around a view call whose exceptions stay in its item."""
+
+    def _get_response(self, request):
+        try:
+            return super()._get_response(request)
+        except (Http404, PermissionDenied):
+            raise  # the stack turns these into a 404/403
+        except Exception:
+            logger.exception('Batch sub-request %s %s failed', request.method, request.path)
+            return JsonResponse({'message': 'Internal server error'}, status=500)
+
+
+def _middleware():
+    global _handler
+    if _handler is None:
+        handler = SubRequestHandler()
+        handler.load_middleware()
+        _handler = handler
+    return _handler
+
+
+def _executor():
+    global _pool
+    if _pool is None:
+        _pool = ThreadPoolExecutor(
+            max_workers=getattr(settings, 'BATCH_MAX_CONCURRENCY', 4),
+            thread_name_prefix='batch',
+        )
+    return _pool
+
+
+def _sub_request(parent, method, path, body):
+    url = urlsplit(path)
+    data = b'' if body is None else json.dumps(body).encode('utf-8')
+
+    request = HttpRequest()
+    request.method = method
+    request.path = request.path_info = url.path
+    request.META = {
+        key: value for key, value in parent.META.items()
+        if (key.startswith('HTTP_') and key != 'HTTP_X_PROFILE')  # the batch itself is profiled
+        or key in ('REMOTE_ADDR', 'SERVER_NAME', 'SERVER_PORT', 'wsgi.url_scheme')
+    }
+    request.META.update({
+        'REQUEST_METHOD': method,
+        'PATH_INFO': url.path,
+        'QUERY_STRING': url.query,
+        'CONTENT_TYPE': 'application/json',
+        'CONTENT_LENGTH': str(len(data)),
+    })
+    request.GET = QueryDict(url.query)
+    request.COOKIES = parent.COOKIES
+    request._stream = io.BytesIO(data)
+    request._read_started = False
+    # DRF honours these instead of running the authentication classes again
+    request._force_auth_user = parent.user
+    request._force_auth_token = parent.auth
+    return request
+
+
+def _validate(item):
+    if not isinstance(item, dict):
+        raise BatchError('Each request must be an object with method and path')
+    method = str(item.get('method', 'GET')).upper()
+    path = item.get('path')
+    if method not in ALLOWED_METHODS:
+        raise BatchError(f'Unsupported method {method}')
+    if not isinstance(path, str) or not path.startswith(API_PREFIX):
+        raise BatchError(f'Path must start with {API_PREFIX}')
+    if urlsplit(path).path.rstrip('/') == API_PREFIX + 'batch':
+        raise BatchError('Batches cannot be nested')
+    return method, path, item.get('body')
+
+
+def _dispatch(parent, method, path, body):
+    request = _sub_request(parent, method, path, body)
+    try:
+        resolve(request.path_info)
+    except Resolver404:
+        return {'status': 404, 'body': {'message': 'Not found'}}
+
+    response = _middleware().get_response(request)
+    if response.streaming:
+        response.close()  # frees the admission slot the stream would hold
+        return {'status': 400, 'body': {'message': 'Streaming responses are not available in a batch'}}
+
+    content = response.content.decode(response.charset or 'utf-8')
+    if response.get('Content-Type', '').startswith('application/json') and content:
+        content = json.loads(content)
+    return {'status': response.status_code, 'body': content}
+
+
+def _dispatch_in_worker(parent, method, path, body):
+    close_old_connections()
+    try:
+        return _dispatch(parent, method, path, body)
+    finally:
+        close_old_connections()
+
+
+def run_batch(parent, items):
+    """Execute ``items`` and return one ``{status, body}`` per item, in order."""
+    results = [None] * len(items)
+    reads = []
+
+    def flush_reads():
+        if len(reads) == 1:
+            index, args = reads[0]
+            results[index] = _dispatch(parent, *args)
+        elif reads:
+            # copy_context carries the request's shard tenant into the worker
+            futures = [
+                (index, _executor().submit(contextvars.copy_context().run, _dispatch_in_worker, parent, *args))
+                for index, args in reads
+            ]
+            for index, future in futures:
+                results[index] = future.result()
+        reads.clear()
+
+    for index, item in enumerate(items):
+        try:
+            method, path, body = _validate(item)
+        except BatchError as exc:
+            results[index] = {'status': 400, 'body': {'message': str(exc)}}
+            continue
+        if method == 'GET':
+            reads.append((index, (method, path, body)))
+        else:
+            flush_reads()
+            results[index] = _dispatch(parent, method, path, body)
+    flush_reads()
+    return results
@@ -0,0 +1,112 @@
+"""Composite patient dashboard built from a fixed set of queries.
+
+The patient app used to call profile, predictions, appointments, reports
+and conversations one after another on launch. ``patient_dashboard``
+answers all of it with five indexed queries. With
+``settings.DASHBOARD_PARALLEL_QUERIES`` enabled, those queries run
+concurrently on a small thread pool, each thread on its own connection,
+which it closes (or hands back to the pool) as soon as its query is done.
+"""
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connections
+from django.utils import timezone
+
+from .models import Appointment, Message, Patient, Prediction, Report
+
+_pool = None
+
+
+def _executor():
+    global _pool
+    if _pool is None:
+        _pool = ThreadPoolExecutor(max_workers=5, thread_name_prefix='dashboard')
+    return _pool
+
+
+def _in_worker(query):
+    def run():
+        try:
+            return query()
+        finally:
+            # Not close_old_connections(): with CONN_MAX_AGE that keeps each
+            # pool thread's connection (on every shard it read) open for good
+            connections.close_all()
+    return run
+
+
+def _profile(user):
+    return Patient.objects.filter(user=user).values('name', 'age', 'gender', 'mail_id').first()
+
+
+def _predictions(user, limit):
+    return [
+        {
+            '_id': str(pred.id),
+            'disease': pred.disease,
+            'confidence': pred.confidence,
+            'timestamp': pred.timestamp.isoformat(),
+            'imageUrl': pred.image_url,
+        }
+        for pred in Prediction.objects.filter(user=user).order_by('-id')[:limit]
+    ]
+
+
+def _upcoming_appointments(user, limit):
+    appointments = (
+        Appointment.objects
+        .filter(patient=user, date__gte=timezone.localdate(), status__in=('pending', 'confirmed'))
+        .select_related('doctor', 'prediction')
+        .order_by('date', 'time')[:limit]
+    )
+    return [
+        {
+            '_id': str(apt.id),
+            'doctorId': str(apt.doctor_id),
+            'doctorName': apt.doctor.fam_dr_name,
+            'date': apt.date.isoformat(),
+            'time': apt.time.strftime('%I:%M %p'),
+            'status': apt.status,
+            'disease': apt.prediction.disease if apt.prediction else 'General Consultation',
+        }
+        for apt in appointments
+    ]
+
+
+def _reports(user, limit):
+    return [
+        {
+            '_id': str(report.id),
+            'predictionId': str(report.prediction_id),
+            'disease': report.prediction.disease,
+            'confidence': report.prediction.confidence,
+            'timestamp': report.created_at.isoformat(),
+            'pdfUrl': report.pdf_url,
+        }
+        for report in Report.objects.filter(patient=user).select_related('prediction').order_by('-id')[:limit]
+    ]
+
+
+def _unread_count(user):
+    return Message.objects.filter(receiver=user, is_read=False).count()
+
+
+def patient_dashboard(user, limit=5):
+    queries = {
+        'profile': lambda: _profile(user),
+        'predictions': lambda: _predictions(user, limit),
+        'upcomingAppointments': lambda: _upcoming_appointments(user, limit),
+        'reports': lambda: _reports(user, limit),
+        'unreadMessages': lambda: _unread_count(user),
+    }
+
+    if getattr(settings, 'DASHBOARD_PARALLEL_QUERIES', False):
+        # copy_context carries the request's shard tenant into the workers
+        futures = {
+            key: _executor().submit(contextvars.copy_context().run, _in_worker(query))
+            for key, query in queries.items()
+        }
+        return {key: future.result() for key, future in futures.items()}
+    return {key: query() for key, query in queries.items()}
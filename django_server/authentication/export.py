@@ -0,0 +1,183 @@
+"""Streaming CSV/Parquet export of predictions, appointments and reports.
+
+On PostgreSQL, rows are read with ``.iterator(chunk_size=...)`` inside one
+REPEATABLE READ READ ONLY transaction: a consistent snapshot that never
+blocks writers. SQLite has a single writer, so an export there holds no
+transaction at all. It walks the tables in id order, one short query per
+chunk, up to the highest id present when it started. A row changed while the
+export runs may show either version. A row archived mid-export is still
+emitted exactly once. Output is produced chunk by chunk, so memory stays flat
+regardless of table size.
+
+With shards, the hot table is read from every shard (ids are unique across
+them). On PostgreSQL each database gets its own snapshot, so the export is
+consistent per shard rather than across them.
+"""
+import csv
+import io
+from itertools import islice
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection, connections, transaction
+from django.db.models import Max
+
+from .models import Appointment, ArchivedPrediction, Prediction, Report
+from .sharding import shards
+
+PREDICTION_COLUMNS = (
+    'id', 'user_id', 'disease', 'confidence', 'image_url', 'body_part',
+    'symptoms', 'duration', 'timestamp', 'model_version',
+)
+
+EXPORT_KINDS = {
+    'predictions': (
+        PREDICTION_COLUMNS,
+        lambda: (Prediction.objects.order_by('id'), ArchivedPrediction.objects.order_by('id')),
+    ),
+    'appointments': (
+        ('id', 'patient_id', 'doctor_id', 'prediction_id', 'date', 'time', 'status', 'created_at'),
+        lambda: (Appointment.objects.order_by('id'),),
+    ),
+    'reports': (
+        ('id', 'patient_id', 'prediction_id', 'patient_name', 'patient_age',
+         'patient_gender', 'pdf_url', 'created_at'),
+        lambda: (Report.objects.order_by('id'),),
+    ),
+}
+
+EXPORT_FORMATS = ('csv', 'parquet')
+
+
+def default_chunk_size():
+    return getattr(settings, 'EXPORT_CHUNK_SIZE', 2000)
+
+
+def _keyset_chunks(querysets, columns, chunk_size):
+    ceiling = max((qs.aggregate(top=Max('id'))['top'] or 0 for qs in querysets), default=0)
+    last = 0
+    while True:
+        rows, bound = {}, ceiling
+        # Hot before archive: a row archived between the two reads is seen
+        # twice (deduplicated by id) rather than not at all
+        for qs in querysets:
+            chunk = list(qs.filter(id__gt=last, id__lte=ceiling).values_list(*columns)[:chunk_size])
+            if len(chunk) == chunk_size:
+                bound = min(bound, chunk[-1][0])
+            for row in chunk:
+                rows.setdefault(row[0], row)
+        chunk = [rows[pk] for pk in sorted(rows) if pk <= bound][:chunk_size]
+        if not chunk:
+            return
+        yield chunk
+        last = chunk[-1][0]
+
+
+def _sources(kind):
+    """The hot queryset on every shard, then the archive's (on ``default``)."""
+    hot, *archived = EXPORT_KINDS[kind][1]()
+    return [hot.using(alias) for alias in shards()] + archived
+
+
+def _snapshot_rows(querysets, columns, chunk_size):
+    # One REPEATABLE READ READ ONLY transaction per database
+    for alias in dict.fromkeys(qs.db for qs in querysets):
+        with transaction.atomic(using=alias):
+            with connections[alias].cursor() as cursor:
+                cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY')
+            for qs in querysets:
+                if qs.db == alias:
+                    yield from qs.values_list(*columns).iterator(chunk_size=chunk_size)
+
+
+def iter_rows(kind, chunk_size=None):
+    """Yield lists of value tuples for ``kind`` in id order (see the module docs)."""
+    columns = EXPORT_KINDS[kind][0]
+    chunk_size = chunk_size or default_chunk_size()
+
+    if connection.vendor != 'postgresql':
+        yield from _keyset_chunks(_sources(kind), columns, chunk_size)
+        return
+
+    rows = _snapshot_rows(_sources(kind), columns, chunk_size)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class _Echo:
+    """File-like object whose write() just returns the value for csv.writer."""
+
+    def write(self, value):
+        return value
+
+
+def stream_csv(kind, chunk_size=None):
+    columns, _ = EXPORT_KINDS[kind]
+    writer = csv.writer(_Echo())
+    yield writer.writerow(columns)
+    for chunk in iter_rows(kind, chunk_size):
+        yield ''.join(writer.writerow(row) for row in chunk)
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only sink that hands buffered bytes back to a generator."""
+
+    def __init__(self):
+        self.parts = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self.parts)
+        self.parts = []
+        return data
+
+
+def _arrow_schema(pa, kind):
+    columns, querysets = EXPORT_KINDS[kind]
+    model = querysets()[0].model
+    types = {
+        'BigAutoField': pa.int64(), 'AutoField': pa.int64(), 'BigIntegerField': pa.int64(),
+        'IntegerField': pa.int64(), 'ForeignKey': pa.int64(), 'FloatField': pa.float64(),
+        'BooleanField': pa.bool_(), 'DateField': pa.date32(), 'TimeField': pa.time64('us'),
+        'DateTimeField': pa.timestamp('us', tz='UTC'),
+    }
+    fields = {field.attname: field for field in model._meta.concrete_fields}
+    return pa.schema([
+        (name, types.get(fields[name].get_internal_type(), pa.string())) for name in columns
+    ])
+
+
+def stream_parquet(kind, chunk_size=None):
+    """Yield a Parquet file in pieces, one row group per chunk."""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImproperlyConfigured('Parquet export requires the pyarrow package')
+
+    schema = _arrow_schema(pa, kind)
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(pa.PythonFile(sink, mode='w'), schema)
+    for chunk in iter_rows(kind, chunk_size):
+        writer.write_table(pa.Table.from_arrays(
+            [pa.array(list(values), type=field.type) for values, field in zip(zip(*chunk), schema)],
+            schema=schema,
+        ))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def stream_export(kind, fmt='csv', chunk_size=None):
+    if fmt == 'parquet':
+        return stream_parquet(kind, chunk_size)
+    return stream_csv(kind, chunk_size)
@@ -0,0 +1,166 @@
+"""Idempotency-Key support for write endpoints.
+
+A client that retries a POST with the same ``Idempotency-Key`` header gets
+the stored response of the first attempt. The retry does not touch the
+business tables. A duplicate that arrives while the first attempt is still
+running waits for it to finish, up to IDEMPOTENCY_WAIT_SECONDS. An attempt
+holds the key on a lease: if it has neither finished nor released the key
+after IDEMPOTENCY_LEASE_SECONDS (its worker crashed), the next retry takes
+the key over and runs the request itself. Only the current holder can store
+a response.
+
+Keys are scoped to the authenticated caller. Anonymous callers cannot use
+them: they would all share one scope and could replay each other's results.
+
+Responses are kept as zlib-compressed JSON and expire after
+IDEMPOTENCY_TTL_SECONDS. Expired rows are purged lazily by writers.
+"""
+import functools
+import hashlib
+import json
+import random
+import time
+import zlib
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+
+from .models import IdempotencyRecord
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+
+
+def _digest(*parts):
+    return hashlib.sha256('\x1f'.join(parts).encode('utf-8')).hexdigest()
+
+
+def _fingerprint(request):
+    body = request.body if hasattr(request, 'body') else b''
+    return hashlib.sha256(request.method.encode() + b' ' + request.path.encode() + b'\n' + body).hexdigest()
+
+
+def _claim(key_hash, request_hash):
+    """Insert the in-flight marker; return its ``claimed_at`` if this request owns the key, else None."""
+    now = timezone.now()
+    if random.random() < getattr(settings, 'IDEMPOTENCY_PURGE_PROBABILITY', 0.01):
+        IdempotencyRecord.objects.filter(expires_at__lt=now).delete()
+    try:
+        with transaction.atomic():
+            IdempotencyRecord.objects.create(
+                key_hash=key_hash,
+                request_hash=request_hash,
+                claimed_at=now,
+                expires_at=now + timedelta(seconds=getattr(settings, 'IDEMPOTENCY_TTL_SECONDS', 86400)),
+            )
+        return now
+    except IntegrityError:
+        return None
+
+
+def _lease_expired(record):
+    lease = timedelta(seconds=getattr(settings, 'IDEMPOTENCY_LEASE_SECONDS', 120))
+    return record.claimed_at <= timezone.now() - lease
+
+
+def _take_over(record):
+    """Claim an in-flight key whose lease ran out; return the new ``claimed_at`` or None."""
+    if not _lease_expired(record):
+        return None
+    now = timezone.now()
+    taken = IdempotencyRecord.objects.filter(
+        key_hash=record.key_hash, status_code__isnull=True, claimed_at=record.claimed_at,
+    ).update(claimed_at=now)
+    return now if taken else None
+
+
+def _wait_for(key_hash):
+    """Poll until the owner of ``key_hash`` stores a response, its lease runs out or we give up."""
+    deadline = time.monotonic() + getattr(settings, 'IDEMPOTENCY_WAIT_SECONDS', 10)
+    delay = 0.01
+    while True:
+        record = IdempotencyRecord.objects.filter(key_hash=key_hash).first()
+        if (record is None or record.status_code is not None or _lease_expired(record)
+                or time.monotonic() > deadline):
+            return record
+        time.sleep(delay)
+        delay = min(delay * 2, 0.2)
+
+
+def _replay(record):
+    data = json.loads(zlib.decompress(bytes(record.response_body))) if record.response_body else None
+    response = Response(data, status=record.status_code)
+    response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def idempotent(scope):
+    """Decorate a DRF function view so retries with one key run it once.
+
+    Place it below ``@api_view``/``@permission_classes`` so ``request.user``
+    is already authenticated when the key is scoped to the caller.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            key = request.headers.get(HEADER)
+            if not key:
+                return view(request, *args, **kwargs)
+            if len(key) > MAX_KEY_LENGTH:
+                return Response({'message': f'{HEADER} must be at most {MAX_KEY_LENGTH} characters'},
+                                status=status.HTTP_400_BAD_REQUEST)
+
+            if request.user.is_anonymous:
+                return Response({'message': f'Authentication required to use {HEADER}'},
+                                status=status.HTTP_401_UNAUTHORIZED)
+
+            key_hash = _digest(scope, str(request.user.pk), key)
+            request_hash = _fingerprint(request)
+
+            for _ in range(2):
+                claimed_at = _claim(key_hash, request_hash)
+                if claimed_at:
+                    break
+                record = _wait_for(key_hash)
+                if record is None:
+                    continue  # the owner failed and released the key; try to claim it
+                if record.request_hash != request_hash:
+                    return Response({'message': f'{HEADER} was already used for a different request'},
+                                    status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+                if record.expires_at < timezone.now():
+                    IdempotencyRecord.objects.filter(key_hash=key_hash, expires_at__lt=timezone.now()).delete()
+                    continue
+                if record.status_code is None:
+                    claimed_at = _take_over(record)
+                    if claimed_at:
+                        break  # the holder's lease ran out; run the request here
+                    return Response({'message': 'A request with this Idempotency-Key is still in progress'},
+                                    status=status.HTTP_409_CONFLICT)
+                return _replay(record)
+            else:
+                return Response({'message': 'A request with this Idempotency-Key is still in progress'},
+                                status=status.HTTP_409_CONFLICT)
+
+            # Only while this attempt still holds the lease
+            held = IdempotencyRecord.objects.filter(key_hash=key_hash, claimed_at=claimed_at, status_code__isnull=True)
+            try:
+                response = view(request, *args, **kwargs)
+            except Exception:
+                held.delete()
+                raise
+
+            if response.status_code >= 500 or not hasattr(response, 'data'):
+                # Let the client retry failures for real
+                held.delete()
+                return response
+
+            body = zlib.compress(JSONRenderer().render(response.data)) if response.data is not None else None
+            held.update(status_code=response.status_code, response_body=body)
+            return response
+        return wrapper
+    return decorator
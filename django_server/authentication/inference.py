@@ -0,0 +1,89 @@
+"""Skin classifier plumbing for offline jobs; safe to import in worker processes.
+
+SKIN_MODEL_LOADER names a zero-argument callable returning the classifier,
+an object with:
+
+* ``version``: a short string, stored in Prediction.model_version;
+* ``preprocess(image_bytes)``: one image as an array of the model's input
+  shape;
+* ``predict(batch)``: an iterable of ``(disease, confidence)`` pairs for an
+  array of stacked images, with confidence in percent.
+
+Large weights belong in a flat file read with
+``model_store.open_weights(settings.SKIN_MODEL_WEIGHTS)``: every process
+maps the same page-cache pages instead of holding its own copy. A model may
+also define ``warm_up()``, run once at process start by ``warm_up`` below.
+
+Nothing here touches the database. Worker processes, started with
+``spawn``, import only this module and the model.
+"""
+import threading
+
+import numpy as np
+from django.utils.module_loading import import_string
+
+from . import model_store
+
+_model = None
+_model_lock = threading.Lock()
+
+
+def load_model(path):
+    return import_string(path)()
+
+
+def init_worker(path):
+    """Process-pool initializer: load the classifier once per worker."""
+    global _model
+    _model = load_model(path)
+
+
+def use_model(model):
+    """Score in this process with an already loaded ``model`` (no pool)."""
+    global _model
+    _model = model
+
+
+def get_model():
+    """The SKIN_MODEL_LOADER classifier for this process, loaded on first use; None if unset."""
+    global _model
+    if _model is None:
+        from django.conf import settings
+
+        path = getattr(settings, 'SKIN_MODEL_LOADER', None)
+        if not path:
+            return None
+        with _model_lock:
+            if _model is None:
+                _model = load_model(path)
+    return _model
+
+
+def warm_up():
+    """Load the classifier and fault in its weights before the first request.
+
+    Called at import time by the WSGI/ASGI entry points when
+    SKIN_MODEL_PRELOAD is set; under ``gunicorn --preload`` that is once in
+    the master, and the forked workers inherit the loaded model. Returns the
+    number of weight bytes now resident.
+    """
+    model = get_model()
+    if model is not None and hasattr(model, 'warm_up'):
+        model.warm_up()
+    return model_store.warm_all()
+
+
+def score(images):
+    """Classify a batch of raw image bytes; None for images that would not decode."""
+    tensors, decoded = [], []
+    for position, raw in enumerate(images):
+        try:
+            tensors.append(np.asarray(_model.preprocess(raw), dtype=np.float32))
+        except Exception:
+            continue
+        decoded.append(position)
+    results = [None] * len(images)
+    if tensors:
+        for position, (disease, confidence) in zip(decoded, _model.predict(np.stack(tensors))):
+            results[position] = (str(disease), float(confidence))
+    return results
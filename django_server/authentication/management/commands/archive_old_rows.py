@@ -0,0 +1,44 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from authentication import sharding
+from authentication.archive import ARCHIVE_KINDS, archive_batch, default_cutoff
+
+class Command(BaseCommand):
+    help = 'Move old predictions and messages from the hot tables into the archive tables'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--kind', choices=sorted(ARCHIVE_KINDS), action='append',
+                            help='Only archive this kind (may be repeated)')
+        parser.add_argument('--days', type=int, default=None,
+                            help='Archive rows older than this many days (default: ARCHIVE_HORIZON_DAYS)')
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help='Rows moved per transaction (default: ARCHIVE_BATCH_SIZE)')
+        parser.add_argument('--max-batches', type=int, default=None,
+                            help='Stop after this many batches; re-run to resume')
+
+    def handle(self, *args, **options):
+        if sharding.enabled():
+            raise CommandError('Archiving only covers the default database; it cannot run with SHARDS set')
+        kinds = options['kind'] or sorted(ARCHIVE_KINDS)
+        batch_size = options['batch_size'] or getattr(settings, 'ARCHIVE_BATCH_SIZE', 1000)
+        if options['days'] is not None:
+            cutoff = timezone.now() - timedelta(days=options['days'])
+        else:
+            cutoff = default_cutoff()
+
+        for kind in kinds:
+            moved = 0
+            batches = 0
+            while options['max_batches'] is None or batches < options['max_batches']:
+                count = archive_batch(kind, cutoff, batch_size)
+                if not count:
+                    break
+                moved += count
+                batches += 1
+            self.stdout.write(self.style.SUCCESS(
+                f'Archived {moved} {kind} older than {cutoff.isoformat()} in {batches} batches'
+            ))
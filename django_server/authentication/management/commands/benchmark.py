@@ -0,0 +1,698 @@
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+
+def _load_weights(mode, path, spawned, barrier, results):
+    """bench_model_store worker: load the weights, then report memory once every worker has."""
+    import numpy as np
+
+    from authentication.model_store import memory_usage, open_weights
+
+    started = time.perf_counter()
+    if mode == 'npz':
+        with np.load(path) as archive:
+            weights = {name: archive[name] for name in archive.files}
+    else:
+        weights = open_weights(path)
+        weights.warm()
+    loaded = time.perf_counter() - started
+    ready = time.time() - spawned
+    barrier.wait()
+    results.put((loaded, ready, memory_usage()))
+    barrier.wait()
+    del weights
+
+
+# Run in a fresh interpreter by bench_startup: import the WSGI app, then time
+# its first requests. Prints JSON on the last line.
+STARTUP_PROBE = '''
+import io, json, sys, time
+started = time.perf_counter()
+from epicure_skin.wsgi import application
+imported = time.perf_counter() - started
+timings = []
+for path in sys.argv[1:]:
+    environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'QUERY_STRING': '', 'SERVER_NAME': 'localhost',
+               'SERVER_PORT': '80', 'REMOTE_ADDR': '127.0.0.1', 'wsgi.url_scheme': 'http',
+               'wsgi.input': io.BytesIO(), 'wsgi.errors': sys.stderr}
+    started = time.perf_counter()
+    b''.join(application(environ, lambda status, headers, exc_info=None: None))
+    timings.append(time.perf_counter() - started)
+print(json.dumps({'import': imported, 'requests': timings}))
+'''
+
+
+class Command(BaseCommand):
+    help = 'Run a performance benchmark scenario and print the timings'
+
+    scenarios = ('analytics', 'connections', 'dashboard', 'model_store', 'notifications', 'outbox', 'ratelimit',
+                 'reminders', 'similarity', 'stampede', 'startup', 'threads', 'transitions', 'writes')
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenario', choices=self.scenarios)
+        parser.add_argument('--size', type=int, default=None,
+                            help='Scenario size (rows, requests, ...); each scenario has its own default')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        getattr(self, f"bench_{options['scenario']}")(options['size'])
+        self.stdout.write(f'Total wall time: {time.perf_counter() - started:.2f}s')
+
+    def bench_analytics(self, size):
+        from authentication.analytics import benchmark
+
+        rows = size or 10_000_000
+        for group_by, seconds in benchmark(rows=rows).items():
+            self.stdout.write(
+                f'{group_by}: {rows:,} predictions in {seconds:.3f}s '
+                f'({rows / seconds / 1e6:.1f}M rows/s)'
+            )
+
+    def bench_connections(self, size):
+        """Connection setup cost per request: fresh, persistent and pooled."""
+        import copy
+        from concurrent.futures import ThreadPoolExecutor
+
+        from django.db.utils import load_backend
+
+        requests = size or 2000
+        threads = 8
+        settings_dict = connection.settings_dict
+        backend = load_backend(settings_dict['ENGINE'])
+
+        def wrapper(pooled):
+            options = copy.deepcopy(settings_dict)
+            if not pooled:
+                options['OPTIONS'].pop('pool', None)
+            return backend.DatabaseWrapper(options, alias='benchmark')
+
+        def request(db, reconnect):
+            if reconnect:
+                db.connect()
+            with db.cursor() as cursor:
+                cursor.execute('SELECT 1')
+                cursor.fetchone()
+            if reconnect:
+                db.close()  # a pooled connection goes back to the pool
+
+        modes = [('new connection per request', False, True), ('persistent connection', False, False)]
+        if settings_dict['OPTIONS'].get('pool'):
+            modes.append(('pooled connection', True, True))
+        else:
+            self.stdout.write(f'{connection.vendor}: no pool configured, skipping the pooled run')
+
+        for label, pooled, reconnect in modes:
+            def worker(count):
+                db = wrapper(pooled)
+                db.connect()
+                try:
+                    for _ in range(count):
+                        request(db, reconnect)
+                finally:
+                    db.close()
+
+            started = time.perf_counter()
+            worker(requests)
+            single = time.perf_counter() - started
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=threads) as pool:
+                list(pool.map(worker, [requests // threads] * threads))
+            threaded = time.perf_counter() - started
+            if pooled:
+                wrapper(True).close_pool()
+            self.stdout.write(f'{label}: {single / requests * 1e6:.0f}us per request, '
+                              f'{threads} threads {requests / threaded:,.0f} requests/s')
+
+    @contextmanager
+    def scratch_database(self):
+        """Run a scenario against a throwaway test database, never live data."""
+        test_settings = connection.settings_dict.setdefault('TEST', {})
+        if connection.vendor == 'sqlite' and not test_settings.get('NAME'):
+            # A file rather than shared-cache memory, so threads behave like workers
+            test_settings['NAME'] = os.path.join(tempfile.mkdtemp(), 'benchmark.sqlite3')
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            yield
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def bench_threads(self, size):
+        """Opening one conversation as the message table grows; bulk vs. per-message read receipts."""
+        import random
+
+        import jwt
+        from django.test import Client
+
+        from authentication.models import Message, User
+        from authentication.threads import mark_read
+
+        total = size or 1_000_000
+        with self.scratch_database():
+            users = User.objects.bulk_create([User(email=f'bench-{i}@example.com', username=f'bench-{i}@example.com')
+                                              for i in range(500)])
+            patient, doctor = users[0], users[1]
+            token = jwt.encode({'sub': str(patient.id), 'email': patient.email}, 'secret', algorithm='HS256')
+            client = Client(HTTP_AUTHORIZATION=f'Bearer {token}')
+            thread = Message.objects.bulk_create([
+                Message(sender=doctor if i % 2 else patient, receiver=patient if i % 2 else doctor, content='thread')
+                for i in range(200)
+            ])
+            inbound = [message.id for message in thread if message.sender_id == doctor.id]
+
+            stored = len(thread)
+            for volume in (total // 100, total // 10, total):
+                while stored < volume:
+                    batch = min(50_000, volume - stored)
+                    Message.objects.bulk_create([
+                        Message(sender=random.choice(users[2:]), receiver=random.choice(users), content='other')
+                        for _ in range(batch)
+                    ], batch_size=5000)
+                    stored += batch
+                timings = []
+                for _ in range(20):
+                    Message.objects.filter(id__in=inbound).update(is_read=False)
+                    started = time.perf_counter()
+                    response = client.get(f'/api/auth/messages/thread/{doctor.id}?limit=50')
+                    timings.append(time.perf_counter() - started)
+                timings.sort()
+                self.stdout.write(f'{stored:,} messages: open thread median {timings[10] * 1000:.1f}ms, '
+                                  f"marked {response.json()['markedRead']} read")
+
+            Message.objects.filter(id__in=inbound).update(is_read=False)
+            started = time.perf_counter()
+            for message in Message.objects.filter(sender=doctor, receiver=patient, is_read=False):
+                message.is_read = True
+                message.save()
+            per_message = time.perf_counter() - started
+            Message.objects.filter(id__in=inbound).update(is_read=False)
+            started = time.perf_counter()
+            marked = mark_read(patient, doctor)
+            self.stdout.write(f'read receipts for {marked}: one save each {per_message * 1000:.1f}ms, '
+                              f'one UPDATE {(time.perf_counter() - started) * 1000:.1f}ms')
+
+    def bench_transitions(self, size):
+        """Race confirm/complete/cancel from many threads on the same rows."""
+        import random
+        from collections import Counter
+        from concurrent.futures import ThreadPoolExecutor
+        from datetime import date, time as clock
+
+        from django.db import connections
+
+        from authentication.appointment_status import APPLIED, transition
+        from authentication.models import Appointment, Doctor, User
+        from authentication.rollups import compute_rollups, record_appointment_created, stored_rollups
+
+        attempts = size or 2000
+        with self.scratch_database():
+            doctor_user = User.objects.create_user(email='bench-doctor@example.com', role='doctor')
+            patient = User.objects.create_user(email='bench-patient@example.com')
+            doctor = Doctor.objects.create(user=doctor_user, fam_dr_name='Bench', fam_dr_edu='MD',
+                                           fam_dr_hospital='Bench', fam_dr_hospital_location='Bench')
+            ids = []
+            for _ in range(max(10, attempts // 20)):
+                appointment = Appointment.objects.create(patient=patient, doctor=doctor, date=date.today(),
+                                                         time=clock(10, 0), status='pending')
+                record_appointment_created(appointment)
+                ids.append(appointment.id)
+
+            actors = [(doctor_user, 'confirmed'), (doctor_user, 'completed'), (patient, 'cancelled')]
+            applied = Counter()
+
+            def worker(seed):
+                rng = random.Random(seed)
+                outcomes = Counter()
+                try:
+                    for _ in range(attempts // 16):
+                        user, target = rng.choice(actors)
+                        outcome, _ = transition(user, rng.choice(ids), target)
+                        outcomes[outcome] += 1
+                        if outcome == APPLIED:
+                            applied[target] += 1
+                finally:
+                    connections.close_all()
+                return outcomes
+
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=16) as pool:
+                outcomes = sum(pool.map(worker, range(16)), Counter())
+            elapsed = time.perf_counter() - started
+
+            final = Counter(Appointment.objects.values_list('status', flat=True))
+            # Every appointment starts pending and terminal states never change
+            expected_terminal = applied['completed'] + applied['cancelled']
+            if final['completed'] + final['cancelled'] != expected_terminal:
+                raise CommandError(f'Lost or duplicated transitions: {dict(final)} vs {dict(applied)}')
+            if compute_rollups() != stored_rollups():
+                raise CommandError('Rollups diverged from the appointment table')
+
+            total = sum(outcomes.values())
+            self.stdout.write(f'{total:,} transitions on {len(ids)} appointments from 16 threads '
+                              f'in {elapsed:.2f}s ({total / elapsed:,.0f}/s)')
+            self.stdout.write(f'Outcomes: {dict(outcomes)}; final statuses: {dict(final)}')
+            self.stdout.write(self.style.SUCCESS('No lost updates; rollups consistent'))
+
+    def bench_dashboard(self, size):
+        """Patient launch: five sequential calls vs. the composite dashboard."""
+        from datetime import date, time as clock
+
+        import jwt
+        from django.test import Client
+
+        from authentication.models import Appointment, Doctor, Message, Patient, Prediction, Report, User
+
+        rounds = size or 50
+        with self.scratch_database():
+            doctor_user = User.objects.create_user(email='bench-doctor@example.com', role='doctor')
+            doctor = Doctor.objects.create(user=doctor_user, fam_dr_name='Bench', fam_dr_edu='MD',
+                                           fam_dr_hospital='Bench', fam_dr_hospital_location='Bench')
+            patient = User.objects.create_user(email='bench-patient@example.com')
+            Patient.objects.create(user=patient, name='Bench', age=30, gender='other',
+                                   mail_id='bench-patient@example.com')
+            for i in range(20):
+                prediction = Prediction.objects.create(user=patient, disease='Eczema', confidence=70.0,
+                                                       image_url='https://example.com/x.jpg')
+                Report.objects.create(patient=patient, prediction=prediction, patient_name='Bench',
+                                      patient_age=30, patient_gender='other', pdf_url=f'/reports/{i}.pdf')
+                Appointment.objects.create(patient=patient, doctor=doctor, prediction=prediction,
+                                           date=date.today(), time=clock(10, 0))
+                Message.objects.create(sender=doctor_user, receiver=patient, content='hello')
+
+            token = jwt.encode({'sub': str(patient.id), 'email': patient.email}, 'secret', algorithm='HS256')
+            client = Client(HTTP_AUTHORIZATION=f'Bearer {token}')
+            sequence = ['/api/auth/patient/profile', '/api/auth/predictions', '/api/auth/appointments',
+                        '/api/auth/reports', '/api/auth/conversations']
+
+            def measure(paths):
+                executed = []
+
+                def count(execute, sql, params, many, context):
+                    executed.append(sql)
+                    return execute(sql, params, many, context)
+
+                with connection.execute_wrapper(count):
+                    started = time.perf_counter()
+                    for path in paths:
+                        client.get(path)
+                    first = time.perf_counter() - started
+                timings = []
+                for _ in range(rounds):
+                    started = time.perf_counter()
+                    for path in paths:
+                        client.get(path)
+                    timings.append(time.perf_counter() - started)
+                timings.sort()
+                return first, timings[len(timings) // 2], len(executed)
+
+            for label, paths in (('sequential (5 calls)', sequence), ('dashboard (1 call)', ['/api/auth/dashboard'])):
+                connection.close()
+                first, median, query_count = measure(paths)
+                self.stdout.write(f'{label}: cold {first * 1000:.1f}ms, warm median {median * 1000:.1f}ms, '
+                                  f'{query_count} queries')
+
+    def bench_similarity(self, size):
+        """Exact vs. IVF nearest-neighbour search: latency and recall@10."""
+        import numpy as np
+
+        from authentication.similarity import VectorIndex
+
+        count, dim, k = size or 1_000_000, 128, 10
+        rng = np.random.default_rng(0)
+        # Clustered vectors, like embeddings of similar-looking lesions
+        centres = rng.standard_normal((max(count // 250, 1), dim), dtype=np.float32)
+        index = VectorIndex(dim)
+        started = time.perf_counter()
+        for start in range(0, count, 100_000):
+            rows = min(100_000, count - start)
+            vectors = centres[rng.integers(len(centres), size=rows)] + 0.8 * rng.standard_normal((rows, dim), dtype=np.float32)
+            index.add(np.arange(start, start + rows), vectors)
+        self.stdout.write(f'add: {count:,} x {dim} vectors ({count * dim * 2 / 2**20:.0f} MiB float16) '
+                          f'in {time.perf_counter() - started:.2f}s')
+
+        picks = rng.integers(count, size=100)
+        queries = np.stack([index.vector(int(pk)) for pk in picks])
+        queries += 0.05 * rng.standard_normal(queries.shape, dtype=np.float32)
+
+        started = time.perf_counter()
+        for query in queries[:20]:
+            index.search(query, k)
+        single = (time.perf_counter() - started) / 20
+        started = time.perf_counter()
+        truth, _ = index.search(queries, k)
+        batched = (time.perf_counter() - started) / len(queries)
+        self.stdout.write(f'exact: {single * 1000:.1f}ms per query, {batched * 1000:.1f}ms per query '
+                          f'in a batch of {len(queries)}')
+
+        lists = int(np.sqrt(count))
+        started = time.perf_counter()
+        index.merge(lists=lists)
+        self.stdout.write(f'IVF: trained {lists} lists and grouped the base in {time.perf_counter() - started:.2f}s')
+        for probes in (4, 8, 16, 32):
+            started = time.perf_counter()
+            found, _ = index.search(queries, k, probes=probes)
+            elapsed = (time.perf_counter() - started) / len(queries)
+            recall = np.mean([len(set(a) & set(b)) / k for a, b in zip(found.tolist(), truth.tolist())])
+            self.stdout.write(f'IVF {probes:>2} probes: {elapsed * 1000:.2f}ms per query, recall@{k} {recall:.3f}')
+
+        extra = min(10_000, count)
+        started = time.perf_counter()
+        index.add(np.arange(count, count + extra), rng.standard_normal((extra, dim), dtype=np.float32))
+        added = time.perf_counter() - started
+        started = time.perf_counter()
+        index.search(queries, k)
+        self.stdout.write(f'incremental: {extra:,} adds in {added * 1000:.0f}ms; search with the delta '
+                          f'{(time.perf_counter() - started) / len(queries) * 1000:.2f}ms per query')
+
+    def bench_startup(self, size):
+        """Import time and first-request latency of a fresh worker, cold vs. warmed up."""
+        import json
+        import subprocess
+        import sys
+
+        runs = size or 5
+        paths = ['/api/auth/doctors', '/api/auth/predictions', '/api/auth/config', '/api/auth/doctors']
+        for label, warmup in (('cold', '0'), ('warm-up', '1')):
+            reports = []
+            for _ in range(runs):
+                output = subprocess.run(
+                    [sys.executable, '-c', STARTUP_PROBE, *paths], check=True, capture_output=True, text=True,
+                    env={**os.environ, 'EPICURE_WARMUP': warmup},
+                ).stdout
+                reports.append(json.loads(output.splitlines()[-1]))
+            imported = sum(report['import'] for report in reports) / runs
+            first = [sum(report['requests'][i] for report in reports) / runs for i in range(len(paths))]
+            self.stdout.write(f'{label}: import {imported * 1000:.0f}ms, ' + ', '.join(
+                f'{path} {seconds * 1000:.1f}ms' for path, seconds in zip(paths, first)
+            ) + f' (mean of {runs} fresh processes)')
+
+    def bench_stampede(self, size):
+        """Concurrent clients hitting the doctor roster right as it expires."""
+        import threading
+        from concurrent.futures import ThreadPoolExecutor
+
+        from django.core.cache import cache
+        from django.db import connections
+
+        from authentication.models import Doctor, User
+        from authentication.singleflight import cached
+        from authentication.views import _doctor_roster
+
+        clients = size or 500
+        with self.scratch_database():
+            for i in range(50):
+                user = User.objects.create_user(email=f'bench-doctor-{i}@example.com', role='doctor')
+                Doctor.objects.create(user=user, fam_dr_name=f'Doctor {i}', fam_dr_edu='MD',
+                                      fam_dr_hospital='Bench', fam_dr_hospital_location='Bench')
+
+            computations = []
+            guard = threading.Lock()
+
+            def roster():
+                with guard:
+                    computations.append(1)
+                time.sleep(0.05)  # make the window for a stampede obvious
+                return _doctor_roster()
+
+            def run(fetch):
+                computations.clear()
+                cache.delete('bench:roster')
+                barrier = threading.Barrier(clients)
+
+                def client(_):
+                    try:
+                        barrier.wait()
+                        return fetch()
+                    finally:
+                        connections.close_all()
+
+                started = time.perf_counter()
+                with ThreadPoolExecutor(max_workers=clients) as pool:
+                    list(pool.map(client, range(clients)))
+                return len(computations), time.perf_counter() - started
+
+            def naive():
+                value = cache.get('bench:roster')
+                if value is None:
+                    value = roster()
+                    cache.set('bench:roster', value, 300)
+                return value
+
+            for label, fetch in (('plain cache', naive),
+                                 ('single-flight', lambda: cached('bench:roster', roster, ttl=300))):
+                count, elapsed = run(fetch)
+                self.stdout.write(f'{label}: {clients} concurrent misses -> {count} roster queries '
+                                  f'in {elapsed:.2f}s')
+
+    def bench_model_store(self, size):
+        """Worker cold start and memory: weights copied from an .npz vs. one shared memory map."""
+        import multiprocessing
+
+        import numpy as np
+
+        from authentication.model_store import save_weights
+
+        megabytes = size or 256
+        rng = np.random.default_rng(0)
+        # Layer shapes roughly like a CNN's, float32
+        arrays, remaining, layer = {}, megabytes * 2**20 // 4, 0
+        while remaining > 0:
+            rows = min(1024, max(remaining // 4096, 1))
+            arrays[f'layer{layer}.weight'] = rng.standard_normal((rows, min(4096, remaining)), dtype=np.float32)
+            remaining -= arrays[f'layer{layer}.weight'].size
+            layer += 1
+        directory = tempfile.mkdtemp()
+        paths = {'npz': os.path.join(directory, 'weights.npz'), 'mmap': os.path.join(directory, 'weights.bin')}
+        np.savez(paths['npz'], **arrays)
+        save_weights(paths['mmap'], arrays)
+        del arrays
+        self.stdout.write(f'{megabytes} MiB of weights in {layer} arrays')
+
+        context = multiprocessing.get_context('spawn')
+        try:
+            for mode in ('npz', 'mmap'):
+                for workers in (1, 2, 4, 8):
+                    # Start cold: neither file in the page cache
+                    for path in paths.values():
+                        with open(path, 'rb') as handle:
+                            os.posix_fadvise(handle.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+                    barrier, results = context.Barrier(workers), context.Queue()
+                    processes = [context.Process(target=_load_weights,
+                                                 args=(mode, paths[mode], time.time(), barrier, results))
+                                 for _ in range(workers)]
+                    for process in processes:
+                        process.start()
+                    reports = [results.get() for _ in processes]
+                    for process in processes:
+                        process.join()
+                    loads, readies, usages = zip(*reports)
+                    rss = np.mean([usage['rss'] for usage in usages])
+                    pss = sum(usage.get('pss', usage['rss']) for usage in usages)
+                    self.stdout.write(
+                        f'{mode:>4} x {workers}: load {np.mean(loads) * 1000:.0f}ms avg '
+                        f'(max {max(loads) * 1000:.0f}ms), ready {np.mean(readies):.2f}s after spawn; '
+                        f'RSS {rss / 2**20:.0f} MiB per worker, PSS {pss / 2**20:.0f} MiB total'
+                    )
+        finally:
+            for path in paths.values():
+                os.remove(path)
+            os.rmdir(directory)
+
+    def bench_notifications(self, size):
+        """Digest delivery throughput against a local aiosmtpd SMTP server."""
+        try:
+            from aiosmtpd.controller import Controller
+        except ImportError:
+            raise CommandError('The notifications scenario needs aiosmtpd (pip install aiosmtpd)')
+        import asyncio
+        import socket
+
+        from django.test import override_settings
+        from django.utils import timezone
+
+        from authentication.models import NotificationEvent, User
+        from authentication.notifications import run_worker
+
+        events = size or 5000
+        recipients = max(1, events // 5)
+
+        class Sink:
+            received = 0
+
+            async def handle_DATA(self, server, session, envelope):
+                self.received += 1
+                return '250 OK'
+
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            port = probe.getsockname()[1]
+        sink = Sink()
+        controller = Controller(sink, hostname='127.0.0.1', port=port)
+        controller.start()
+        try:
+            with self.scratch_database(), override_settings(EMAIL_HOST='127.0.0.1', EMAIL_PORT=port,
+                                                            EMAIL_USE_TLS=False, EMAIL_HOST_USER=''):
+                users = User.objects.bulk_create([
+                    User(email=f'bench-{i}@example.com', username=f'bench-{i}@example.com')
+                    for i in range(recipients)
+                ])
+                NotificationEvent.objects.bulk_create([
+                    NotificationEvent(recipient=users[i % recipients], kind='message_received',
+                                      payload={'sender': 'bench@example.com', 'preview': 'hello'})
+                    for i in range(events)
+                ], batch_size=1000)
+
+                for connections in (1, 4, 16):
+                    NotificationEvent.objects.update(delivered_at=None, claim='', attempts=0, next_attempt_at=timezone.now())
+                    sink.received = 0
+                    with override_settings(NOTIFICATION_SMTP_CONNECTIONS=connections):
+                        metrics = asyncio.run(run_worker(once=True, digest_seconds=0))
+                    self.stdout.write(f'{connections} SMTP connections: {metrics.summary()}; '
+                                      f'server received {sink.received}')
+        finally:
+            controller.stop()
+
+    def bench_outbox(self, size):
+        """Write overhead of the outbox, and tailing it vs. rescanning the table."""
+        from django.db import transaction
+        from django.test import override_settings
+
+        from authentication import outbox
+        from authentication.models import Message, User
+
+        writes = size or 20_000
+        with self.scratch_database():
+            sender = User.objects.create_user(email='bench-sender@example.com')
+            receiver = User.objects.create_user(email='bench-receiver@example.com', role='doctor')
+
+            for label, enabled in (('without outbox', False), ('with outbox', True)):
+                with override_settings(OUTBOX_ENABLED=enabled):
+                    started = time.perf_counter()
+                    for _ in range(writes):
+                        with transaction.atomic():
+                            Message.objects.create(sender=sender, receiver=receiver, content='benchmark')
+                    elapsed = time.perf_counter() - started
+                self.stdout.write(f'{label}: {writes:,} inserts in {elapsed:.2f}s '
+                                  f'({elapsed / writes * 1e6:.0f}us each)')
+
+            # A consumer that is 100 changes behind
+            after = outbox.read(0, writes + 1)[-1].id
+            for _ in range(100):
+                Message.objects.create(sender=sender, receiver=receiver, content='new')
+
+            started = time.perf_counter()
+            events = outbox.read(after, 500)
+            tail = time.perf_counter() - started
+            started = time.perf_counter()
+            rows = list(Message.objects.values())
+            rescan = time.perf_counter() - started
+            self.stdout.write(f'tail: {len(events)} new events in {tail * 1000:.1f}ms; '
+                              f'rescan: {len(rows):,} rows in {rescan * 1000:.1f}ms')
+
+    def bench_ratelimit(self, size):
+        """Per-check cost of the sliding-window limiter, alone and under contention."""
+        from concurrent.futures import ThreadPoolExecutor
+
+        from authentication.throttling import SlidingWindowStore
+
+        checks = size or 100_000
+        store = SlidingWindowStore(os.path.join(tempfile.mkdtemp(), 'ratelimit.sqlite3'))
+
+        started = time.perf_counter()
+        for i in range(checks):
+            store.hit(f'bench:ip:{i % 1000}', 100, 60)
+        elapsed = time.perf_counter() - started
+        self.stdout.write(f'1 thread: {checks:,} checks in {elapsed:.2f}s '
+                          f'({elapsed / checks * 1e6:.1f}us per check)')
+
+        threads = 8
+        per_thread = checks // threads
+
+        def worker(offset):
+            for i in range(per_thread):
+                store.hit(f'bench:user:{(offset + i) % 1000}', 100, 60)
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            list(pool.map(worker, range(threads)))
+        elapsed = time.perf_counter() - started
+        total = per_thread * threads
+        self.stdout.write(f'{threads} threads: {total:,} checks in {elapsed:.2f}s '
+                          f'({elapsed / total * 1e6:.1f}us per check)')
+
+    def bench_reminders(self, size):
+        """Timing wheel: schedule, cancel and fire a day's worth of reminders."""
+        import random
+
+        from authentication.reminders import TimingWheel
+
+        timers = size or 1_000_000
+        wheel = TimingWheel()
+        due = [random.randrange(1, wheel.horizon) for _ in range(timers)]
+
+        started = time.perf_counter()
+        for key, tick in enumerate(due):
+            wheel.add(key, tick)
+        elapsed = time.perf_counter() - started
+        self.stdout.write(f'add: {timers:,} timers in {elapsed:.2f}s ({elapsed / timers * 1e6:.2f}us each)')
+
+        cancelled = timers // 10
+        started = time.perf_counter()
+        for key in range(0, timers, 10):
+            wheel.remove(key)
+        elapsed = time.perf_counter() - started
+        self.stdout.write(f'cancel: {cancelled:,} timers in {elapsed:.2f}s ({elapsed / cancelled * 1e6:.2f}us each)')
+
+        started = time.perf_counter()
+        fired = 0
+        slowest = 0
+        for tick in range(1, wheel.horizon + 1):
+            tick_started = time.perf_counter()
+            fired += len(wheel.advance(tick))
+            slowest = max(slowest, time.perf_counter() - tick_started)
+        elapsed = time.perf_counter() - started
+        self.stdout.write(f'expire: {fired:,} timers over {wheel.horizon:,} ticks in {elapsed:.2f}s '
+                          f'(slowest tick {slowest * 1000:.2f}ms), {len(wheel)} left')
+
+    def bench_writes(self, size):
+        """Concurrent message inserts, direct vs. through the single-writer queue."""
+        from concurrent.futures import ThreadPoolExecutor
+
+        from django.db import OperationalError, connections
+        from django.test import override_settings
+
+        from authentication.models import Message, User
+        from authentication.writer import run_write
+
+        writes = size or 5000
+        threads = 32
+        with self.scratch_database():
+            sender = User.objects.create_user(email='bench-sender@example.com')
+            receiver = User.objects.create_user(email='bench-receiver@example.com', role='doctor')
+
+            def worker(count):
+                errors = 0
+                try:
+                    for _ in range(count):
+                        try:
+                            run_write(lambda: Message.objects.create(sender=sender, receiver=receiver,
+                                                                     content='benchmark'))
+                        except OperationalError:
+                            errors += 1
+                finally:
+                    connections.close_all()
+                return errors
+
+            for label, enabled in (('direct', False), ('write queue', True)):
+                with override_settings(WRITE_QUEUE_ENABLED=enabled):
+                    started = time.perf_counter()
+                    with ThreadPoolExecutor(max_workers=threads) as pool:
+                        errors = sum(pool.map(worker, [writes // threads] * threads))
+                    elapsed = time.perf_counter() - started
+                done = (writes // threads) * threads
+                self.stdout.write(f'{label}: {done:,} inserts from {threads} threads in {elapsed:.2f}s '
+                                  f'({(done - errors) / elapsed:,.0f}/s), {errors} errors')
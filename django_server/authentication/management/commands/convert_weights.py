@@ -0,0 +1,43 @@
+import os
+import time
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from authentication.model_store import Weights, save_weights
+
+
+class Command(BaseCommand):
+    help = 'Convert classifier weights (.npz or a PyTorch state dict) to the flat memory-mappable format'
+
+    def add_arguments(self, parser):
+        parser.add_argument('source', help='An .npz archive, or a .pt/.pth state dict (needs torch)')
+        parser.add_argument('--output', default=None,
+                            help='Weights file to write; default: SKIN_MODEL_WEIGHTS')
+        parser.add_argument('--model-version', default='',
+                            help='Model version stored in the file header')
+
+    def handle(self, *args, **options):
+        source = options['source']
+        output = options['output'] or settings.SKIN_MODEL_WEIGHTS
+        if not os.path.exists(source):
+            raise CommandError(f'{source} does not exist')
+        started = time.perf_counter()
+        if source.endswith('.npz'):
+            with np.load(source) as archive:
+                arrays = {name: archive[name] for name in archive.files}
+        else:
+            try:
+                import torch
+            except ImportError:
+                raise CommandError('Reading PyTorch checkpoints needs torch installed; export an .npz instead')
+            state = torch.load(source, map_location='cpu', weights_only=True)
+            arrays = {name: tensor.detach().numpy() for name, tensor in state.items()}
+
+        save_weights(output, arrays, meta={'version': options['model_version'], 'source': os.path.basename(source)})
+        with Weights(output) as weights:
+            self.stdout.write(self.style.SUCCESS(
+                f'Wrote {len(weights)} arrays ({weights.nbytes / 2**20:.1f} MiB) to {output} '
+                f'in {time.perf_counter() - started:.1f}s'
+            ))
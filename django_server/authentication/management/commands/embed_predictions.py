@@ -0,0 +1,62 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from authentication.models import Prediction
+from authentication.sharding import shards
+from authentication.similarity import encoder, load_new_embeddings, store_embeddings
+
+
+class Command(BaseCommand):
+    help = 'Compute missing prediction image embeddings and optionally save the similarity index'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=256,
+                            help='Predictions passed to the encoder at a time')
+        parser.add_argument('--limit', type=int, default=None,
+                            help='Embed at most this many predictions')
+        parser.add_argument('--save-index', action='store_true',
+                            help='Build the index from every stored embedding and write it to SIMILARITY_INDEX_PATH')
+        parser.add_argument('--retrain', action='store_true',
+                            help='With --save-index, recompute the IVF centroids')
+
+    def handle(self, *args, **options):
+        encode = encoder()
+        if encode is None and not options['save_index']:
+            raise CommandError('Set EMBEDDING_ENCODER to compute embeddings (or pass --save-index only)')
+        if encode is not None:
+            self.embed(encode, options['batch_size'], options['limit'])
+        if options['save_index']:
+            self.save_index(options['retrain'])
+
+    def embed(self, encode, batch_size, limit):
+        done = 0
+        started = time.perf_counter()
+        for alias in shards():
+            missing = Prediction.objects.using(alias).filter(embedding__isnull=True).order_by('id')
+            after = 0
+            while limit is None or done < limit:
+                size = batch_size if limit is None else min(batch_size, limit - done)
+                batch = list(missing.filter(id__gt=after)[:size])
+                if not batch:
+                    break
+                store_embeddings(batch, encode(batch))
+                after = batch[-1].id
+                done += len(batch)
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(f'Embedded {done} predictions in {elapsed:.1f}s'))
+
+    def save_index(self, retrain):
+        started = time.perf_counter()
+        index = load_new_embeddings(None)
+        if index is None:
+            raise CommandError('No embeddings stored yet')
+        lists = getattr(settings, 'SIMILARITY_IVF_LISTS', 0)
+        index.merge(lists=lists, retrain=retrain)
+        index.save(settings.SIMILARITY_INDEX_PATH)
+        kind = f'IVF, {lists} lists' if index.centroids is not None else 'exact'
+        self.stdout.write(self.style.SUCCESS(
+            f'Saved {len(index):,} vectors ({kind}) to {settings.SIMILARITY_INDEX_PATH} '
+            f'in {time.perf_counter() - started:.1f}s'
+        ))
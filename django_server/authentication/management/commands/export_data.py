@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from authentication.export import EXPORT_FORMATS, EXPORT_KINDS, stream_export
+
+class Command(BaseCommand):
+    help = 'Stream predictions, appointments or reports to a CSV or Parquet file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=sorted(EXPORT_KINDS))
+        parser.add_argument('output', type=str, help='Path of the file to write')
+        parser.add_argument('--format', choices=EXPORT_FORMATS, default='csv')
+        parser.add_argument('--chunk-size', type=int, default=None,
+                            help='Rows per fetch / row group (default: EXPORT_CHUNK_SIZE)')
+
+    def handle(self, *args, **options):
+        fmt = options['format']
+        written = 0
+        with open(options['output'], 'wb') as out:
+            for piece in stream_export(options['kind'], fmt, options['chunk_size']):
+                data = piece.encode('utf-8') if isinstance(piece, str) else piece
+                out.write(data)
+                written += len(data)
+        self.stdout.write(self.style.SUCCESS(
+            f"Exported {options['kind']} to {options['output']} ({written:,} bytes)"
+        ))
@@ -0,0 +1,9 @@
+from django.core.management.base import BaseCommand
+
+from authentication.profiling import make_token
+
+class Command(BaseCommand):
+    help = 'Print a signed X-Profile header value that enables profiling for a request'
+
+    def handle(self, *args, **options):
+        self.stdout.write(make_token())
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from authentication.rollups import compute_rollups, rebuild_rollups, stored_rollups
+
+class Command(BaseCommand):
+    help = 'Rebuild dashboard rollups from the appointment and prediction tables'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true',
+                            help='Only compare stored rollups with a fresh computation')
+
+    def handle(self, *args, **options):
+        expected = compute_rollups()
+        stored = stored_rollups()
+        mismatches = [
+            (key, stored.get(key, 0), expected.get(key, 0))
+            for key in sorted(set(expected) | set(stored), key=str)
+            if stored.get(key, 0) != expected.get(key, 0)
+        ]
+
+        for key, have, want in mismatches:
+            self.stdout.write(f'{key}: stored {have}, expected {want}')
+
+        if options['check']:
+            if mismatches:
+                raise CommandError(f'{len(mismatches)} rollup keys out of date')
+            self.stdout.write(self.style.SUCCESS(f'All {len(expected)} rollup keys match'))
+            return
+
+        rebuild_rollups(expected)
+        self.stdout.write(self.style.SUCCESS(
+            f'Rebuilt {len(expected)} rollup keys ({len(mismatches)} corrected)'
+        ))
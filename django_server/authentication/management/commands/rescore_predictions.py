@@ -0,0 +1,73 @@
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from authentication.inference import load_model
+from authentication.rescoring import TABLES, rescore
+from authentication.sharding import shards
+
+
+class Command(BaseCommand):
+    help = 'Re-score stored predictions with the classifier from SKIN_MODEL_LOADER, resuming where the last run stopped'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model-version', default=None,
+                            help="Version to record; default: the loaded model's own version")
+        parser.add_argument('--table', choices=[*TABLES, 'all'], default='all',
+                            help='Hot predictions, archived ones, or both')
+        parser.add_argument('--database', default=None,
+                            help='Only this database (or shard); default: every shard')
+        parser.add_argument('--chunk-size', type=int, default=512,
+                            help='Rows read, written and checkpointed at a time')
+        parser.add_argument('--batch-size', type=int, default=32,
+                            help='Images per inference call')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help='Inference processes; 0 scores in this process')
+        parser.add_argument('--fetch-threads', type=int, default=16,
+                            help='Threads downloading images')
+        parser.add_argument('--prefetch', type=int, default=2,
+                            help='Chunks of images fetched ahead of inference')
+        parser.add_argument('--restart', action='store_true',
+                            help='Ignore the checkpoint and retry every row not on this version')
+        parser.add_argument('--report-every', type=float, default=10,
+                            help='Print throughput every this many seconds')
+
+    def handle(self, *args, **options):
+        model_path = getattr(settings, 'SKIN_MODEL_LOADER', None)
+        if not model_path:
+            raise CommandError('Set SKIN_MODEL_LOADER to the classifier loader first')
+        model = None
+        if options['workers'] == 0 or not options['model_version']:
+            model = load_model(model_path)
+        version = options['model_version'] or str(model.version)
+
+        tables = list(TABLES) if options['table'] == 'all' else [options['table']]
+        databases = [options['database']] if options['database'] else shards()
+        started = last_report = time.perf_counter()
+        scored = failed = changed = 0
+        for table in tables:
+            for alias in databases:
+                if table == 'archived' and alias != DEFAULT_DB_ALIAS:
+                    continue  # the archive lives on default only
+                for chunk in rescore(
+                    table, alias, version, model_path=model_path, model=model, restart=options['restart'],
+                    chunk_size=options['chunk_size'], batch_size=options['batch_size'],
+                    workers=options['workers'], fetch_threads=options['fetch_threads'],
+                    prefetch=options['prefetch'],
+                    fetch_timeout=getattr(settings, 'RESCORE_FETCH_TIMEOUT_SECONDS', 10),
+                ):
+                    scored, failed, changed = scored + chunk.scored, failed + chunk.failed, changed + chunk.changed
+                    if time.perf_counter() - last_report >= options['report_every']:
+                        last_report = time.perf_counter()
+                        self.stdout.write(f'{table}@{alias} up to id {chunk.last_id}: '
+                                          f'{self.summary(scored, failed, changed, last_report - started)}')
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(f'{version}: {self.summary(scored, failed, changed, elapsed)}'))
+
+    def summary(self, scored, failed, changed, elapsed):
+        return (f'{scored} images scored ({scored / max(elapsed, 1e-9):.1f} images/s), '
+                f'{changed} diagnoses changed, {failed} failed')
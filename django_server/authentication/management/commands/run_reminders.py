@@ -0,0 +1,33 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+
+from authentication.reminders import ReminderScheduler
+
+
+class Command(BaseCommand):
+    help = 'Queue appointment reminder notifications from an in-memory timing wheel'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help='Send the reminders due now and exit')
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS,
+                            help='Database (or shard) whose appointments to watch; run one scheduler per shard')
+
+    def handle(self, *args, **options):
+        scheduler = ReminderScheduler(using=options['database'])
+        if options['once']:
+            sent = scheduler.run_once()
+            self.stdout.write(self.style.SUCCESS(f'{sent} reminders queued'))
+            return
+
+        tick = getattr(settings, 'REMINDER_TICK_SECONDS', 1)
+        self.stdout.write(f'Watching {options["database"]}: {scheduler.extend()} reminders loaded')
+        while True:
+            sent = scheduler.run_once()
+            if sent:
+                self.stdout.write(f'{sent} reminders queued ({scheduler.sent} total, '
+                                  f'{len(scheduler.wheel)} pending)')
+            time.sleep(tick)
@@ -0,0 +1,26 @@
+import asyncio
+
+from django.core.management.base import BaseCommand
+
+from authentication.notifications import run_worker
+
+
+class Command(BaseCommand):
+    help = 'Deliver queued notification emails as per-recipient digests'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help='Exit when nothing is due instead of polling forever')
+        parser.add_argument('--digest-seconds', type=float, default=None,
+                            help='Hold events this long to batch them (default: NOTIFICATION_DIGEST_SECONDS)')
+        parser.add_argument('--report-every', type=float, default=60,
+                            help='Print delivery metrics every this many seconds')
+
+    def handle(self, *args, **options):
+        metrics = asyncio.run(run_worker(
+            once=options['once'],
+            digest_seconds=options['digest_seconds'],
+            report=lambda metrics: self.stdout.write(metrics.summary()),
+            report_every=options['report_every'],
+        ))
+        self.stdout.write(self.style.SUCCESS(metrics.summary()))
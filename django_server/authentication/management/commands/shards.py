@@ -0,0 +1,84 @@
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.models import Count
+
+from authentication.models import ShardAssignment
+from authentication.sharding import (
+    ID_RANGE_MODELS, REFERENCE_MODELS, SHARDED_MODELS, ShardMoveError, enabled, move_tenant, replicate, shard_for_user, shards,
+)
+
+
+class Command(BaseCommand):
+    help = 'Set up shards, show how patients are spread over them, or move a patient'
+
+    def add_arguments(self, parser):
+        subcommands = parser.add_subparsers(dest='action', required=True)
+        subcommands.add_parser('init', help='Migrate every shard, reserve its id range and copy reference tables')
+        subcommands.add_parser('status', help='Patients and rows per shard')
+        move = subcommands.add_parser('move', help="Move one patient's rows to another shard")
+        move.add_argument('user_id', type=int)
+        move.add_argument('shard')
+
+    def handle(self, *args, **options):
+        if not enabled():
+            raise CommandError('Sharding is off: set SHARDS (or EPICURE_SHARDS) first')
+        getattr(self, f"handle_{options['action']}")(**options)
+
+    def handle_init(self, **options):
+        span = getattr(settings, 'SHARD_ID_SPAN', 10 ** 12)
+        for index, alias in enumerate(shards()):
+            if alias != DEFAULT_DB_ALIAS:
+                call_command('migrate', database=alias, verbosity=0)
+                for model in REFERENCE_MODELS:
+                    replicate(model, alias)
+            if index:
+                self.reserve_ids(alias, index * span)
+            self.stdout.write(self.style.SUCCESS(f'{alias}: ready, ids from {index * span}'))
+
+    def reserve_ids(self, alias, floor):
+        """Start each sharded table's id sequence on ``alias`` at ``floor``."""
+        connection = connections[alias]
+        with connection.cursor() as cursor:
+            for model in ID_RANGE_MODELS:
+                table = model._meta.db_table
+                if connection.vendor == 'sqlite':
+                    cursor.execute('UPDATE sqlite_sequence SET seq = %s WHERE name = %s AND seq < %s',
+                                   [floor, table, floor])
+                    cursor.execute('INSERT INTO sqlite_sequence (name, seq) SELECT %s, %s '
+                                   'WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = %s)',
+                                   [table, floor, table])
+                elif connection.vendor == 'postgresql':
+                    cursor.execute(
+                        f"SELECT setval(pg_get_serial_sequence(%s, 'id'), "
+                        f"GREATEST(%s, (SELECT COALESCE(MAX(id), 0) FROM {connection.ops.quote_name(table)})))",
+                        [table, floor],
+                    )
+                else:
+                    raise CommandError(f'Cannot reserve id ranges on {connection.vendor}')
+
+    def handle_status(self, **options):
+        patients = dict(
+            ShardAssignment.objects.values_list('shard').annotate(count=Count('pk')).order_by()
+        )
+        for alias in shards():
+            counts = ', '.join(
+                f'{model._meta.verbose_name_plural}: {model.objects.using(alias).count()}'
+                for model in SHARDED_MODELS
+            )
+            self.stdout.write(f'{alias}: {patients.get(alias, 0)} patients assigned; {counts}')
+
+    def handle_move(self, user_id, shard, **options):
+        if shard not in shards():
+            raise CommandError(f'Unknown shard {shard}; choose from {", ".join(shards())}')
+        source = shard_for_user(user_id)
+        try:
+            moved = move_tenant(user_id, shard)
+        except ShardMoveError as exc:
+            raise CommandError(str(exc))
+        if not moved:
+            self.stdout.write(f'User {user_id} is already on {shard}')
+            return
+        summary = ', '.join(f'{count} {name}' for name, count in moved.items())
+        self.stdout.write(self.style.SUCCESS(f'Moved user {user_id} from {source} to {shard}: {summary}'))
@@ -0,0 +1,57 @@
+import json
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from authentication import outbox
+from authentication.sharding import shards
+
+
+class Command(BaseCommand):
+    help = 'Print outbox events after a consumer\'s offset as JSON lines, or compact the outbox'
+
+    def add_arguments(self, parser):
+        parser.add_argument('consumer', nargs='?',
+                            help='Consumer name; its offset is committed after each batch is written')
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS,
+                            help='Database (or shard) whose outbox to read; each has its own ids and offsets')
+        parser.add_argument('--after', type=int, default=None,
+                            help='Start after this event id instead of the committed offset')
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help='Events per read (default: OUTBOX_BATCH_SIZE)')
+        parser.add_argument('--follow', action='store_true',
+                            help='Keep polling for new events instead of exiting when caught up')
+        parser.add_argument('--poll', type=float, default=1.0,
+                            help='Seconds between polls with --follow')
+        parser.add_argument('--compact', action='store_true',
+                            help='Delete events every consumer has read and that are past retention, then exit')
+
+    def handle(self, *args, **options):
+        if options['compact']:
+            for alias in dict.fromkeys([DEFAULT_DB_ALIAS, *shards()]):
+                deleted = outbox.compact(alias)
+                self.stderr.write(f'{alias}: compacted {deleted} events')
+            return
+        consumer = options['consumer']
+        if not consumer:
+            raise CommandError('Name the consumer to stream for (or pass --compact)')
+        database = options['database']
+        if database not in settings.DATABASES:
+            raise CommandError(f'Unknown database {database}')
+
+        position = options['after'] if options['after'] is not None else outbox.position(consumer, database)
+        while True:
+            events = outbox.read(position, options['batch_size'], database)
+            for event in events:
+                self.stdout.write(json.dumps(outbox.event_dict(event)))
+            if events:
+                self.stdout.flush()
+                # At-least-once: the offset moves only after the batch is out
+                position = events[-1].id
+                outbox.commit(consumer, position, database)
+            elif not options['follow']:
+                break
+            else:
+                time.sleep(options['poll'])
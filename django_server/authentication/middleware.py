@@ -0,0 +1,220 @@
+import math
+import random
+import threading
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.http import JsonResponse
+from django.urls import Resolver404, resolve
+
+from . import profiling
+
+
+class RequestProfilingMiddleware:
+    """Opt-in CPU and SQL profiling of individual requests.
+
+    A request is profiled when it carries a valid signed ``X-Profile``
+    header (see ``manage.py profile_token``) or is picked by sampling at
+    PROFILING_SAMPLE_RATE. With PROFILING_ENABLED off the middleware removes
+    itself from the stack at startup, so it costs nothing.
+    """
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'PROFILING_ENABLED', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.sample_rate = getattr(settings, 'PROFILING_SAMPLE_RATE', 0.0)
+        self.interval = getattr(settings, 'PROFILING_INTERVAL_MS', 5) / 1000
+
+    def should_profile(self, request):
+        token = request.headers.get('X-Profile')
+        if token:
+            return profiling.token_is_valid(token)
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def __call__(self, request):
+        if not self.should_profile(request):
+            return self.get_response(request)
+
+        recorder = profiling.QueryRecorder()
+        sampler = profiling.StackSampler(threading.get_ident(), self.interval)
+        started = time.perf_counter()
+        with ExitStack() as stack:
+            # Every configured database, so queries routed to a shard are timed too
+            for conn in connections.all():
+                stack.enter_context(conn.execute_wrapper(recorder))
+            sampler.start()
+            try:
+                response = self.get_response(request)
+            finally:
+                sampler.stop()
+        elapsed = time.perf_counter() - started
+
+        profiling.explain_slow_queries(recorder.queries)
+        name = profiling.write_profile({
+            'method': request.method,
+            'path': request.get_full_path() if profiling.record_params() else request.path,
+            'status': response.status_code,
+            'ms': round(elapsed * 1000, 3),
+            'sqlMs': round(sum(query['ms'] for query in recorder.queries), 3),
+            'samples': sum(sampler.samples.values()),
+            'intervalMs': self.interval * 1000,
+            'stacks': dict(sampler.samples.most_common()),
+            'queries': recorder.queries,
+        })
+        response['X-Profile-Id'] = name
+        return response
+
+
+class AdmissionClass:
+    """Concurrency limit with a bounded, deadline-limited wait queue."""
+
+    def __init__(self, name, concurrency, queue, timeout):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue = queue
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.shed = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            if self.active < self.concurrency:
+                self.active += 1
+                self.admitted += 1
+                return True
+            if self.waiting >= self.queue:
+                self.shed += 1
+                return False
+
+            self.waiting += 1
+            deadline = time.monotonic() + self.timeout
+            try:
+                while self.active >= self.concurrency:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.shed += 1
+                        return False
+                    self._cond.wait(remaining)
+                self.active += 1
+                self.admitted += 1
+                return True
+            finally:
+                self.waiting -= 1
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'concurrency': self.concurrency,
+                'queueLimit': self.queue,
+                'active': self.active,
+                'queued': self.waiting,
+                'admitted': self.admitted,
+                'shed': self.shed,
+            }
+
+
+# Per-process admission classes, shared by every middleware instance
+admission_classes = {}
+
+
+def admission_class_for(view):
+    """The admission class ``view`` is limited by, or None if unlimited (or admission is off)."""
+    # @api_view wraps the function in a class named after it
+    view_name = getattr(view, 'cls', view).__name__
+    name = getattr(settings, 'ADMISSION_ROUTES', {}).get(view_name, getattr(settings, 'ADMISSION_DEFAULT_CLASS', None))
+    return admission_classes.get(name)
+
+
+def busy_response(admission):
+    response = JsonResponse({'message': 'Server is busy, please retry shortly'}, status=503)
+    response['Retry-After'] = str(max(1, math.ceil(admission.timeout)))
+    return response
+
+
+class _ReleaseOnClose:
+    """Streaming body that frees its admission slot once it is exhausted or closed."""
+
+    def __init__(self, content, admission):
+        self._content = iter(content)
+        self._admission = admission
+        self._released = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self._content)
+        except StopIteration:
+            self.close()
+            raise
+
+    def close(self):
+        if not self._released:
+            self._released = True
+            self._admission.release()
+
+
+class AdmissionControlMiddleware:
+    """Per-route-class concurrency limits with early load shedding.
+
+    Views are assigned to classes by name in ADMISSION_ROUTES (for example
+    the PBKDF2-heavy ``login``/``register`` go to a small ``auth`` class).
+    That way a burst in one class cannot queue cheap reads like
+    ``get_doctors`` or ``ping`` behind it. A request that finds its class
+    queue full, or waits longer than the class timeout, gets a 503 with
+    Retry-After. Views not listed fall into ADMISSION_DEFAULT_CLASS (None
+    means unlimited).
+
+    A streaming response (exports) keeps its slot until the body has been
+    sent, not just until the view returns. Batch sub-requests are admitted
+    one by one in their own classes (authentication/batch.py).
+
+    Limits are per worker process and rely on threaded workers (WSGI); the
+    wait blocks the calling thread.
+    """
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'ADMISSION_CONTROL_ENABLED', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        for name, config in getattr(settings, 'ADMISSION_CLASSES', {}).items():
+            admission_classes.setdefault(name, AdmissionClass(
+                name, config['concurrency'], config['queue'], config['timeout'],
+            ))
+
+    def class_for(self, request):
+        try:
+            return admission_class_for(resolve(request.path_info).func)
+        except Resolver404:
+            return None
+
+    def __call__(self, request):
+        admission = self.class_for(request)
+        if admission is None:
+            return self.get_response(request)
+
+        if not admission.acquire():
+            return busy_response(admission)
+        try:
+            response = self.get_response(request)
+        except BaseException:
+            admission.release()
+            raise
+        if response.streaming and not response.is_async:
+            response.streaming_content = _ReleaseOnClose(response.streaming_content, admission)
+        else:
+            admission.release()
+        return response
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 23:58
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentication', '0007_archive_tables'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DashboardRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('appointment', 'Appointment'), ('prediction', 'Prediction')], max_length=20)),
+                ('day', models.DateField()),
+                ('status', models.CharField(blank=True, max_length=20)),
+                ('disease', models.CharField(blank=True, max_length=100)),
+                ('count', models.IntegerField(default=0)),
+                ('doctor', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='authentication.doctor')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('kind', 'day', 'doctor', 'status', 'disease'), name='dashboard_rollup_key'), models.UniqueConstraint(condition=models.Q(('doctor__isnull', True)), fields=('kind', 'day', 'status', 'disease'), name='dashboard_rollup_key_no_doctor')],
+            },
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-19 00:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentication', '0011_notification_event'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='appointment',
+            name='reminded_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='notificationevent',
+            name='kind',
+            field=models.CharField(choices=[('appointment_requested', 'Appointment requested'), ('appointment_confirmed', 'Appointment confirmed'), ('appointment_reminder', 'Appointment reminder'), ('message_received', 'Message received')], max_length=30),
+        ),
+        migrations.AddIndex(
+            model_name='appointment',
+            index=models.Index(fields=['date', 'time'], name='appointment_when_idx'),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 5.2.18 on 2026-10-19 00:28
+
+import authentication.models
+import django.core.serializers.json
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentication', '0012_appointment_reminders'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConsumerOffset',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('consumer', models.CharField(max_length=100)),
+                ('database', models.CharField(default='default', max_length=100)),
+                ('position', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('consumer', 'database'), name='consumer_offset_unique')],
+            },
+        ),
+        migrations.CreateModel(
+            name='OutboxEvent',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('aggregate', models.CharField(max_length=20)),
+                ('aggregate_id', models.BigIntegerField()),
+                ('action', models.CharField(choices=[('created', 'Created'), ('updated', 'Updated'), ('deleted', 'Deleted'), ('archived', 'Archived')], max_length=10)),
+                ('payload', models.JSONField(default=dict, encoder=django.core.serializers.json.DjangoJSONEncoder)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('txid', models.BigIntegerField(db_default=authentication.models.CurrentTransactionId(), editable=False, null=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['created_at'], name='outbox_created_idx'), models.Index(fields=['txid', 'id'], name='outbox_txid_idx'), models.Index(fields=['aggregate', 'id'], name='outbox_aggregate_idx')],
+            },
+        ),
+    ]
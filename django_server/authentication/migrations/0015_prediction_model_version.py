@@ -0,0 +1,43 @@
+# Generated by Django 5.2.18 on 2026-10-19 00:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentication', '0014_prediction_embedding'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='archivedprediction',
+            name='model_version',
+            field=models.CharField(blank=True, default='', max_length=50),
+        ),
+        migrations.AddField(
+            model_name='prediction',
+            name='model_version',
+            field=models.CharField(blank=True, default='', max_length=50),
+        ),
+        migrations.CreateModel(
+            name='RescoreCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model_version', models.CharField(max_length=50)),
+                ('table', models.CharField(max_length=20)),
+                ('database', models.CharField(default='default', max_length=100)),
+                ('last_id', models.BigIntegerField(default=0)),
+                ('scored', models.BigIntegerField(default=0)),
+                ('failed', models.BigIntegerField(default=0)),
+                ('pending_rollups', models.JSONField(blank=True, null=True)),
+                ('rollups_through', models.BigIntegerField(default=0)),
+                ('started_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('model_version', 'table', 'database'), name='rescore_checkpoint_unique')],
+            },
+        ),
+    ]
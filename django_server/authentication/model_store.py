@@ -0,0 +1,171 @@
+"""Flat, memory-mappable model weights.
+
+A weights file is a small JSON header followed by the raw arrays, each
+aligned to 64 bytes:
+
+    b'EPWT' | uint32 format | uint64 header length | header JSON | arrays
+
+``open_weights`` maps the file read-only with ``mmap`` and hands out numpy
+views into it. Nothing is copied or unpickled, so opening takes milliseconds
+whatever the file size. Pages are read from disk once. Every process that
+maps the file shares them through the OS page cache: N Gunicorn or Uvicorn
+workers cost one copy of the weights, not N, whether or not the app was
+preloaded before fork. ``Weights.warm`` faults every page in up front, so
+the first request does not pay for it.
+
+Classifier loaders (SKIN_MODEL_LOADER) read their weights with
+``open_weights(settings.SKIN_MODEL_WEIGHTS)``. ``manage.py convert_weights``
+writes the file from an .npz (or a PyTorch state dict), replacing it with
+``os.replace``. ``open_weights`` notices the new file (inode, size or mtime)
+and maps it on its next call; the old mapping is released once nothing uses
+its arrays. A model that is already loaded keeps the arrays it was given,
+so restart the workers (``kill -HUP`` the Gunicorn master) to serve new
+weights.
+"""
+import json
+import math
+import mmap
+import os
+import struct
+import threading
+from collections.abc import Mapping
+
+import numpy as np
+
+MAGIC = b'EPWT'
+FORMAT = 1
+ALIGN = 64
+PREAMBLE = struct.Struct('<4sIQ')
+
+_open = {}
+_open_lock = threading.Lock()
+
+
+def _align(offset):
+    return -(-offset // ALIGN) * ALIGN
+
+
+def save_weights(path, arrays, meta=None):
+    """Write ``{name: array}`` (plus JSON-able ``meta``) to ``path``, replacing it atomically."""
+    # asarray, not ascontiguousarray, which turns 0-d arrays into 1-d ones
+    arrays = {name: np.asarray(array, order='C') for name, array in arrays.items()}
+    header = {'meta': meta or {}, 'arrays': {}}
+    offset = 0
+    for name, array in arrays.items():
+        offset = _align(offset)
+        header['arrays'][name] = {
+            'dtype': array.dtype.newbyteorder('<').str,
+            'shape': list(array.shape),
+            'offset': offset,
+        }
+        offset += array.nbytes
+    encoded = json.dumps(header).encode()
+    data_start = _align(PREAMBLE.size + len(encoded))
+
+    staged = f'{path}.tmp-{os.getpid()}'
+    with open(staged, 'wb') as handle:
+        handle.write(PREAMBLE.pack(MAGIC, FORMAT, len(encoded)))
+        handle.write(encoded)
+        for name, array in arrays.items():
+            handle.write(b'\0' * (data_start + header['arrays'][name]['offset'] - handle.tell()))
+            handle.write(memoryview(array.astype(array.dtype.newbyteorder('<'), copy=False)).cast('B'))
+        handle.flush()
+        os.fsync(handle.fileno())
+    os.replace(staged, path)
+
+
+class Weights(Mapping):
+    """Read-only numpy views of the arrays in one mapped weights file."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as handle:
+            stat = os.fstat(handle.fileno())
+            self.identity = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+            if stat.st_size < PREAMBLE.size:
+                raise ValueError(f'{path} is not a weights file (format {FORMAT})')
+            self._map = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, length = PREAMBLE.unpack_from(self._map, 0)
+        if magic != MAGIC or version != FORMAT:
+            self._map.close()
+            raise ValueError(f'{path} is not a weights file (format {FORMAT})')
+        header = json.loads(self._map[PREAMBLE.size:PREAMBLE.size + length])
+        data_start = _align(PREAMBLE.size + length)
+        self.meta = header['meta']
+        self._arrays = {
+            name: np.frombuffer(
+                self._map, dtype=spec['dtype'], count=math.prod(spec['shape']),
+                offset=data_start + spec['offset'],
+            ).reshape(spec['shape'])
+            for name, spec in header['arrays'].items()
+        }
+
+    def __getitem__(self, name):
+        return self._arrays[name]
+
+    def __iter__(self):
+        return iter(self._arrays)
+
+    def __len__(self):
+        return len(self._arrays)
+
+    @property
+    def nbytes(self):
+        return len(self._map)
+
+    def close(self):
+        """Unmap the file, or leave that to the last array still pointing into it."""
+        self._arrays = {}
+        try:
+            self._map.close()
+        except BufferError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def warm(self):
+        """Fault in every page now (from the page cache if another process already has)."""
+        if hasattr(self._map, 'madvise'):
+            self._map.madvise(mmap.MADV_WILLNEED)
+        # One byte per page is enough to make the kernel map it
+        int(np.frombuffer(self._map, np.uint8)[::mmap.PAGESIZE].sum())
+
+
+def open_weights(path):
+    """The process-wide mapping of ``path``, opened on first use and again once the file is replaced."""
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    with _open_lock:
+        weights = _open.get(path)
+        if weights is None or weights.identity != (stat.st_ino, stat.st_size, stat.st_mtime_ns):
+            # Threads may still hold the old mapping: it is unmapped when they drop it
+            weights = _open[path] = Weights(path)
+        return weights
+
+
+def warm_all():
+    """Warm every weights file this process has opened; returns bytes mapped."""
+    with _open_lock:
+        opened = list(_open.values())
+    for weights in opened:
+        weights.warm()
+    return sum(weights.nbytes for weights in opened)
+
+
+def memory_usage():
+    """``{'rss': bytes, 'pss': bytes}`` for this process (PSS splits shared pages; Linux only)."""
+    usage = {}
+    try:
+        with open('/proc/self/smaps_rollup') as handle:
+            for line in handle:
+                key, _, value = line.partition(':')
+                if key in ('Rss', 'Pss'):
+                    usage[key.lower()] = int(value.split()[0]) * 1024
+    except OSError:
+        import resource
+        usage['rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return usage
@@ -1,5 +1,7 @@
 from django.contrib.auth.models import AbstractUser, BaseUserManager
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
+from django.utils import timezone
 
 class UserManager(BaseUserManager):
     def create_user(self, email, password=None, **extra_fields):
@@ -45,6 +47,22 @@ class Doctor(models.Model):
     def __str__(self):
         return self.fam_dr_name
 
+class OwnedQuerySet(models.QuerySet):
+    """QuerySet for patient-owned (sharded) rows.
+
+    ``create()`` saves without a database unless ``using()`` picked one, so
+    the router can route the new row by its owner (authentication/sharding.py)
+    rather than by the model alone.
+    """
+
+    def create(self, **kwargs):
+        if self._db is not None:
+            return super().create(**kwargs)
+        obj = self.model(**kwargs)
+        obj.save(force_insert=True)
+        return obj
+
+
 class Prediction(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     disease = models.CharField(max_length=100)
@@ -53,7 +71,11 @@ class Prediction(models.Model):
     body_part = models.CharField(max_length=50, blank=True)
     symptoms = models.TextField(blank=True)
     duration = models.CharField(max_length=50, blank=True)
-    timestamp = models.DateTimeField(auto_now_add=True)
+    timestamp = models.DateTimeField(auto_now_add=True, db_index=True)
+    # Classifier version behind disease/confidence; set by rescore_predictions
+    model_version = models.CharField(max_length=50, blank=True, default='')
+
+    objects = OwnedQuerySet.as_manager()
     
     def __str__(self):
         return f"{self.disease} - {self.confidence}%"
@@ -73,6 +95,15 @@ class Appointment(models.Model):
     time = models.TimeField()
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
     created_at = models.DateTimeField(auto_now_add=True)
+    # Set by run_reminders when the reminder goes out, so it is sent once
+    reminded_at = models.DateTimeField(null=True, blank=True)
+
+    objects = OwnedQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['date', 'time'], name='appointment_when_idx'),
+        ]
     
     def __str__(self):
         return f"{self.patient.email} - {self.doctor.fam_dr_name}"
@@ -81,8 +112,16 @@ class Message(models.Model):
     sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='sent_messages')
     receiver = models.ForeignKey(User, on_delete=models.CASCADE, related_name='received_messages')
     content = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    timestamp = models.DateTimeField(auto_now_add=True, db_index=True)
     is_read = models.BooleanField(default=False)
+
+    objects = OwnedQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # One direction of a conversation, newest first (authentication/threads.py)
+            models.Index(fields=['sender', 'receiver', 'timestamp'], name='message_thread_idx'),
+        ]
     
     def __str__(self):
         return f"{self.sender.email} to {self.receiver.email}"
@@ -95,6 +134,275 @@ class Report(models.Model):
     patient_gender = models.CharField(max_length=10)
     pdf_url = models.CharField(max_length=200)
     created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = OwnedQuerySet.as_manager()
     
     def __str__(self):
-        return f"Report for {self.patient_name}"
\ No newline at end of file
+        return f"Report for {self.patient_name}"
+
+class PredictionEmbedding(models.Model):
+    """Image embedding of a prediction, used for similar-case search.
+
+    Stored as L2-normalised float16 bytes on the prediction's own database.
+    There is no database constraint, so the row outlives archival of its
+    prediction and archived cases stay searchable. Re-embedding replaces the
+    row, which gives it a new id; the index picks up changes by id. Deleting
+    the prediction replaces it with an empty ``vector`` (a tombstone).
+    """
+    prediction = models.OneToOneField(
+        Prediction, on_delete=models.DO_NOTHING, db_constraint=False, related_name='embedding'
+    )
+    vector = models.BinaryField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Embedding of prediction {self.prediction_id}"
+
+# Cold storage for rows moved out of the hot tables by the archive_old_rows
+# command. Archived rows keep their original primary keys so id-based cursors
+# continue seamlessly from the hot table into the archive.
+class ArchivedPrediction(models.Model):
+    id = models.BigIntegerField(primary_key=True)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    disease = models.CharField(max_length=100)
+    confidence = models.FloatField()
+    image_url = models.URLField()
+    body_part = models.CharField(max_length=50, blank=True)
+    symptoms = models.TextField(blank=True)
+    duration = models.CharField(max_length=50, blank=True)
+    timestamp = models.DateTimeField()
+    model_version = models.CharField(max_length=50, blank=True, default='')
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.disease} - {self.confidence}% (archived)"
+
+class ArchivedMessage(models.Model):
+    id = models.BigIntegerField(primary_key=True)
+    sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    receiver = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    content = models.TextField()
+    timestamp = models.DateTimeField()
+    is_read = models.BooleanField(default=False)
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['sender', 'receiver', 'timestamp'], name='archived_message_thread_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.sender.email} to {self.receiver.email} (archived)"
+
+class ArchiveWatermark(models.Model):
+    """Pointer into the archive: the highest id moved out of a hot table.
+
+    Reads consult this single row to decide whether a cursor has reached
+    archived ids before touching the archive tables at all.
+    """
+    kind = models.CharField(max_length=20, unique=True)
+    max_id = models.BigIntegerField(default=0)
+    archived_count = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.kind} archived up to {self.max_id}"
+
+class DashboardRollup(models.Model):
+    """Pre-aggregated counters for the doctor dashboard.
+
+    One row per (kind, day, doctor, status, disease), kept current by the
+    views that create or transition appointments and predictions, and
+    rebuilt from scratch by the rebuild_rollups command.
+    """
+    KIND_CHOICES = [
+        ('appointment', 'Appointment'),
+        ('prediction', 'Prediction'),
+    ]
+
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    day = models.DateField()
+    doctor = models.ForeignKey(Doctor, on_delete=models.CASCADE, null=True, blank=True)
+    status = models.CharField(max_length=20, blank=True)
+    disease = models.CharField(max_length=100, blank=True)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['kind', 'day', 'doctor', 'status', 'disease'],
+                name='dashboard_rollup_key',
+            ),
+            # NULL doctors never collide in a plain unique index
+            models.UniqueConstraint(
+                fields=['kind', 'day', 'status', 'disease'],
+                condition=models.Q(doctor__isnull=True),
+                name='dashboard_rollup_key_no_doctor',
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} {self.day} {self.status} {self.disease}: {self.count}"
+
+class IdempotencyRecord(models.Model):
+    """Stored outcome of a write request made with an Idempotency-Key header.
+
+    ``key_hash`` digests the endpoint, the caller and the client key. A row
+    whose ``status_code`` is still NULL marks a request that is in flight;
+    ``claimed_at`` starts the lease of the attempt running it.
+    """
+    key_hash = models.CharField(max_length=64, primary_key=True)
+    request_hash = models.CharField(max_length=64)
+    status_code = models.PositiveSmallIntegerField(null=True, blank=True)
+    response_body = models.BinaryField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    claimed_at = models.DateTimeField(default=timezone.now)
+    expires_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f"{self.key_hash[:12]} ({self.status_code or 'in flight'})"
+
+class ShardAssignment(models.Model):
+    """Which shard holds a patient's predictions, appointments, messages and reports.
+
+    Lives on the default database only. A patient is placed by hashing their
+    id on first use; the row pins that placement so adding shards later does
+    not move existing patients, and the shards command rewrites it to move one.
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='+')
+    shard = models.CharField(max_length=50, db_index=True)
+    assigned_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"user {self.user_id} on {self.shard}"
+
+class NotificationEvent(models.Model):
+    """Something a user should hear about, queued for the notification worker.
+
+    Rows are added after the triggering write commits. ``send_notifications``
+    folds a recipient's pending events into one digest email; a failed
+    delivery pushes ``next_attempt_at`` back with exponential backoff.
+    """
+    KIND_CHOICES = [
+        ('appointment_requested', 'Appointment requested'),
+        ('appointment_confirmed', 'Appointment confirmed'),
+        ('appointment_reminder', 'Appointment reminder'),
+        ('message_received', 'Message received'),
+    ]
+
+    recipient = models.ForeignKey(User, on_delete=models.CASCADE, related_name='notifications')
+    kind = models.CharField(max_length=30, choices=KIND_CHOICES)
+    payload = models.JSONField(default=dict)
+    created_at = models.DateTimeField(auto_now_add=True)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    claim = models.CharField(max_length=32, blank=True)
+    last_error = models.TextField(blank=True)
+    delivered_at = models.DateTimeField(null=True, blank=True)
+    failed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=['next_attempt_at'],
+                condition=models.Q(delivered_at__isnull=True, failed_at__isnull=True),
+                name='notification_pending_idx',
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} for {self.recipient_id}"
+
+
+class CurrentTransactionId(models.Func):
+    """The writing transaction's id on PostgreSQL (``pg_current_xact_id``); NULL elsewhere."""
+    output_field = models.BigIntegerField()
+
+    def as_sql(self, compiler, connection, **extra_context):
+        return 'NULL', []
+
+    def as_postgresql(self, compiler, connection, **extra_context):
+        return '(pg_current_xact_id()::text::bigint)', []
+
+
+class OutboxEvent(models.Model):
+    """One change to a prediction, appointment, message or report.
+
+    Appended in the same transaction as the change, on the same database
+    (shard), so the log never shows a rolled-back write nor misses a
+    committed one. Consumers tail it in ``(txid, id)`` order; see
+    authentication/outbox.py.
+    """
+    ACTION_CHOICES = [
+        ('created', 'Created'),
+        ('updated', 'Updated'),
+        ('deleted', 'Deleted'),
+        ('archived', 'Archived'),
+    ]
+
+    id = models.BigAutoField(primary_key=True)
+    aggregate = models.CharField(max_length=20)
+    aggregate_id = models.BigIntegerField()
+    action = models.CharField(max_length=10, choices=ACTION_CHOICES)
+    payload = models.JSONField(default=dict, encoder=DjangoJSONEncoder)
+    created_at = models.DateTimeField(auto_now_add=True)
+    txid = models.BigIntegerField(null=True, editable=False, db_default=CurrentTransactionId())
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['created_at'], name='outbox_created_idx'),
+            models.Index(fields=['txid', 'id'], name='outbox_txid_idx'),
+            # Newest event per aggregate (analytics snapshot version)
+            models.Index(fields=['aggregate', 'id'], name='outbox_aggregate_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.aggregate} {self.aggregate_id} {self.action}"
+
+
+class ConsumerOffset(models.Model):
+    """Last outbox event id a consumer has processed on one database."""
+    consumer = models.CharField(max_length=100)
+    database = models.CharField(max_length=100, default='default')
+    position = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['consumer', 'database'], name='consumer_offset_unique'),
+        ]
+
+    def __str__(self):
+        return f"{self.consumer}@{self.database}: {self.position}"
+
+
+class RescoreCheckpoint(models.Model):
+    """How far ``rescore_predictions`` got for one model version, table and database.
+
+    Updated in the same transaction as each chunk's results, so a resumed
+    run starts right after the last chunk that was written.
+
+    On a shard, ``pending_rollups`` carries the last chunk's dashboard
+    rollup deltas, which are applied on ``default`` afterwards. The
+    ``default`` copy of the shard's checkpoint records in ``rollups_through``
+    the last chunk whose deltas were applied, so they are applied once.
+    """
+    model_version = models.CharField(max_length=50)
+    table = models.CharField(max_length=20)
+    database = models.CharField(max_length=100, default='default')
+    last_id = models.BigIntegerField(default=0)
+    scored = models.BigIntegerField(default=0)
+    failed = models.BigIntegerField(default=0)
+    pending_rollups = models.JSONField(null=True, blank=True)
+    rollups_through = models.BigIntegerField(default=0)
+    started_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['model_version', 'table', 'database'], name='rescore_checkpoint_unique'),
+        ]
+
+    def __str__(self):
+        return f"{self.model_version} {self.table}@{self.database}: {self.last_id}"
@@ -0,0 +1,272 @@
+"""Email notifications: queued with the write, delivered as digests by a worker.
+
+``enqueue`` adds a NotificationEvent inside the transaction of the write it
+describes, so a request never waits on SMTP, a rolled-back write never
+notifies anyone and a committed one always does. (Events live on
+``default``; a write on another shard commits separately from its event.)
+``manage.py send_notifications`` runs ``run_worker``, an
+asyncio loop that:
+
+* waits until a recipient's oldest pending event is NOTIFICATION_DIGEST_SECONDS
+  old, then claims all of that recipient's due events so a burst becomes one
+  email;
+* sends over a pool of NOTIFICATION_SMTP_CONNECTIONS persistent SMTP
+  connections (Django's EMAIL_* settings), each send in a thread;
+* on failure retries with exponential backoff and gives up after
+  NOTIFICATION_MAX_ATTEMPTS.
+"""
+import asyncio
+import logging
+import random
+import smtplib
+import time
+import uuid
+from dataclasses import dataclass, field
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.mail import EmailMessage
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import Min
+from django.utils import timezone
+
+from .models import NotificationEvent, User
+
+logger = logging.getLogger(__name__)
+
+SUBJECTS = {
+    'appointment_requested': 'New appointment request',
+    'appointment_confirmed': 'Your appointment is confirmed',
+    'appointment_reminder': 'Upcoming appointment',
+    'message_received': 'New message',
+}
+
+
+def enabled():
+    return getattr(settings, 'NOTIFICATIONS_ENABLED', True)
+
+
+def enqueue(recipient_id, kind, **payload):
+    """Queue a notification for ``recipient_id``; call inside the transaction that made the change."""
+    if not enabled() or recipient_id is None:
+        return
+    NotificationEvent.objects.using(DEFAULT_DB_ALIAS).create(recipient_id=recipient_id, kind=kind, payload=payload)
+
+
+def appointments_confirmed(appointments):
+    """Tell each patient their appointment was confirmed; ``appointments`` are dicts of id, patient_id and date."""
+    if not enabled():
+        return
+    NotificationEvent.objects.using(DEFAULT_DB_ALIAS).bulk_create([
+        NotificationEvent(recipient_id=row['patient_id'], kind='appointment_confirmed',
+                          payload={'appointment': row['id'], 'date': row['date'].isoformat()})
+        for row in appointments
+    ])
+
+
+def appointment_confirmed(appointment_id):
+    """Like ``appointments_confirmed`` for one appointment, looked up by id."""
+    from .models import Appointment
+    from .sharding import locate, use_shard
+
+    with use_shard(locate(Appointment, appointment_id)):
+        row = Appointment.objects.filter(id=appointment_id).values('id', 'patient_id', 'date').first()
+    if row is not None:
+        appointments_confirmed([row])
+
+
+def describe(event):
+    payload = event.payload
+    if event.kind == 'appointment_requested':
+        return f"{payload.get('patient', 'A patient')} requested an appointment on {payload.get('date', '')}"
+    if event.kind == 'appointment_confirmed':
+        return f"Your appointment on {payload.get('date', '')} was confirmed"
+    if event.kind == 'appointment_reminder':
+        return f"Reminder: appointment with {payload.get('doctor', 'your doctor')} on {payload.get('date', '')} at {payload.get('time', '')}"
+    if event.kind == 'message_received':
+        return f"{payload.get('sender', 'Someone')} wrote: {payload.get('preview', '')}"
+    return event.kind
+
+
+@dataclass
+class Digest:
+    address: str
+    events: list
+
+    def email(self):
+        if len(self.events) == 1:
+            subject = SUBJECTS.get(self.events[0].kind, 'Notification')
+        else:
+            subject = f'{len(self.events)} new notifications'
+        body = '\n'.join(f'- {describe(event)}' for event in self.events)
+        return EmailMessage(f'Epicure Skin: {subject}', body, settings.DEFAULT_FROM_EMAIL, [self.address])
+
+
+def claim_digests(limit, digest_seconds):
+    """Claim the due events of up to ``limit`` recipients; one Digest each."""
+    now = timezone.now()
+    pending = NotificationEvent.objects.filter(delivered_at=None, failed_at=None, next_attempt_at__lte=now)
+    recipients = list(
+        pending.values('recipient_id')
+        .annotate(oldest=Min('created_at'))
+        .filter(oldest__lte=now - timedelta(seconds=digest_seconds))
+        .order_by('oldest')
+        .values_list('recipient_id', flat=True)[:limit]
+    )
+    if not recipients:
+        return []
+
+    # The lease keeps a second worker off these rows while we send
+    token = uuid.uuid4().hex
+    lease = now + timedelta(seconds=getattr(settings, 'NOTIFICATION_LEASE_SECONDS', 300))
+    pending.filter(recipient_id__in=recipients).update(claim=token, next_attempt_at=lease)
+    claimed = NotificationEvent.objects.filter(claim=token).order_by('created_at')
+    emails = dict(User.objects.filter(id__in=recipients).values_list('id', 'email'))
+
+    digests = {}
+    for event in claimed:
+        digests.setdefault(event.recipient_id, Digest(emails.get(event.recipient_id), [])).events.append(event)
+    return list(digests.values())
+
+
+def mark_delivered(events):
+    NotificationEvent.objects.filter(id__in=[event.id for event in events]).update(
+        delivered_at=timezone.now(), claim='', last_error=''
+    )
+
+
+def mark_failed(events, error):
+    """Back off exponentially (with jitter); give up after NOTIFICATION_MAX_ATTEMPTS."""
+    base = getattr(settings, 'NOTIFICATION_RETRY_BASE_SECONDS', 30)
+    max_attempts = getattr(settings, 'NOTIFICATION_MAX_ATTEMPTS', 6)
+    now = timezone.now()
+    for event in events:
+        event.attempts += 1
+        event.claim = ''
+        event.last_error = str(error)[:1000]
+        if event.attempts >= max_attempts:
+            event.failed_at = now
+        else:
+            delay = base * 2 ** (event.attempts - 1) * random.uniform(0.8, 1.2)
+            event.next_attempt_at = now + timedelta(seconds=delay)
+    NotificationEvent.objects.bulk_update(events, ['attempts', 'claim', 'last_error', 'failed_at', 'next_attempt_at'])
+
+
+def purge_delivered():
+    cutoff = timezone.now() - timedelta(days=getattr(settings, 'NOTIFICATION_RETENTION_DAYS', 7))
+    NotificationEvent.objects.filter(delivered_at__lt=cutoff).delete()
+
+
+class SMTPPool:
+    """Up to ``size`` open SMTP connections, handed out one sender at a time."""
+
+    def __init__(self, size):
+        self.size = size
+        self.opened = 0
+        self._idle = asyncio.Queue()
+        self._slots = asyncio.Semaphore(size)
+
+    def _connect(self):
+        connection = smtplib.SMTP(settings.EMAIL_HOST, settings.EMAIL_PORT, timeout=settings.EMAIL_TIMEOUT or 30)
+        if settings.EMAIL_USE_TLS:
+            connection.starttls()
+        if settings.EMAIL_HOST_USER:
+            connection.login(settings.EMAIL_HOST_USER, settings.EMAIL_HOST_PASSWORD)
+        self.opened += 1
+        return connection
+
+    async def send(self, email):
+        async with self._slots:
+            connection = self._idle.get_nowait() if not self._idle.empty() else None
+            try:
+                if connection is None:
+                    connection = await asyncio.to_thread(self._connect)
+                await asyncio.to_thread(
+                    connection.sendmail, email.from_email, email.recipients(), email.message().as_bytes()
+                )
+            except Exception:
+                if connection is not None:
+                    await asyncio.to_thread(_close_quietly, connection)
+                raise
+            self._idle.put_nowait(connection)
+
+    async def close(self):
+        while not self._idle.empty():
+            await asyncio.to_thread(_close_quietly, self._idle.get_nowait())
+
+
+def _close_quietly(connection):
+    try:
+        connection.quit()
+    except Exception:
+        connection.close()
+
+
+@dataclass
+class Metrics:
+    emails: int = 0
+    events: int = 0
+    failures: int = 0
+    started: float = field(default_factory=time.monotonic)
+
+    def summary(self):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        return (f'{self.emails} emails ({self.events} events) in {elapsed:.2f}s, '
+                f'{self.emails / elapsed:.1f} emails/s, {self.failures} failed deliveries')
+
+
+async def _deliver(pool, digest):
+    """Send one digest; return the exception on failure, else None."""
+    try:
+        if not digest.address:
+            raise ValueError('Recipient has no email address')
+        await pool.send(digest.email())
+    except Exception as exc:
+        logger.warning('Notification delivery to %s failed: %s', digest.address, exc)
+        return exc
+    return None
+
+
+def _record(outcomes, metrics):
+    delivered = []
+    for digest, error in outcomes:
+        if error is None:
+            metrics.emails += 1
+            metrics.events += len(digest.events)
+            delivered.extend(digest.events)
+        else:
+            metrics.failures += 1
+            mark_failed(digest.events, error)
+    if delivered:
+        mark_delivered(delivered)
+
+
+async def run_worker(once=False, digest_seconds=None, metrics=None, report=None, report_every=60):
+    """Deliver notifications until cancelled (or, with ``once``, until none are due)."""
+    connections = getattr(settings, 'NOTIFICATION_SMTP_CONNECTIONS', 4)
+    poll = getattr(settings, 'NOTIFICATION_POLL_SECONDS', 2)
+    if digest_seconds is None:
+        digest_seconds = getattr(settings, 'NOTIFICATION_DIGEST_SECONDS', 60)
+    metrics = metrics or Metrics()
+    pool = SMTPPool(connections)
+    last_report = time.monotonic()
+    try:
+        while True:
+            digests = await sync_to_async(claim_digests)(connections * 25, digest_seconds)
+            if digests:
+                errors = await asyncio.gather(*(_deliver(pool, digest) for digest in digests))
+                # One bookkeeping round trip per batch, not per email
+                await sync_to_async(_record)(list(zip(digests, errors)), metrics)
+            elif once:
+                break
+            else:
+                await asyncio.sleep(poll)
+            if time.monotonic() - last_report >= report_every:
+                if report is not None:
+                    report(metrics)
+                await sync_to_async(purge_delivered)()
+                last_report = time.monotonic()
+    finally:
+        await pool.close()
+    return metrics
@@ -0,0 +1,224 @@
+"""Transactional outbox: a change feed of predictions, appointments, messages and reports.
+
+Every write to those tables appends an OutboxEvent in the same transaction
+and on the same database (shard) as the write. Consumers such as analytics
+can then read only what changed since their last visit, with no rescan of
+the tables:
+
+* ``save()`` and ``delete()`` are captured by signals, and the payload
+  holds the whole row;
+* ``QuerySet.update()`` bypasses signals, so code that changes these
+  tables set-wise calls ``record`` with the ids and the columns it set;
+* a consumer reads the events after its stored offset (``read``) and then
+  ``commit``s the id of the last one it processed. A crash between the two
+  replays that batch, so delivery is at-least-once;
+* ``compact`` deletes events that every consumer has passed once they are
+  older than OUTBOX_RETENTION_HOURS.
+
+Writes that relocate rows without changing them (moving a patient to
+another shard) run under ``muted()``.
+"""
+import contextvars
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, router, transaction
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import Appointment, ConsumerOffset, Message, OutboxEvent, Prediction, Report
+
+AGGREGATES = {
+    Prediction: 'prediction',
+    Appointment: 'appointment',
+    Message: 'message',
+    Report: 'report',
+}
+
+_muted = contextvars.ContextVar('outbox_muted', default=False)
+
+
+def enabled():
+    return getattr(settings, 'OUTBOX_ENABLED', True) and not _muted.get()
+
+
+def is_muted():
+    """Whether the current writes only relocate rows (archiving, moving shards)."""
+    return _muted.get()
+
+
+@contextmanager
+def muted():
+    token = _muted.set(True)
+    try:
+        yield
+    finally:
+        _muted.reset(token)
+
+
+def snapshot(instance):
+    return {field.attname: field.value_from_object(instance) for field in instance._meta.concrete_fields}
+
+
+def _append(using, *events):
+    # bulk_create skips save() and its signals, which cost more than the INSERT itself
+    OutboxEvent.objects.using(using).bulk_create(events)
+
+
+def record(model, ids, action='updated', using=None, **changes):
+    """Append one ``action`` event per id; call inside the transaction that made the change.
+
+    ``changes`` are the columns a ``QuerySet.update()`` set, and they become
+    the payload (along with the id).
+    """
+    record_each(model, {pk: changes for pk in ids}, action, using)
+
+
+def record_each(model, changes, action='updated', using=None):
+    """Like ``record`` with different columns per row: ``changes`` is ``{id: {column: value}}``."""
+    if not enabled() or not changes:
+        return
+    using = using or router.db_for_write(model)
+    _append(using, *(
+        OutboxEvent(aggregate=AGGREGATES[model], aggregate_id=pk, action=action, payload={'id': pk, **columns})
+        for pk, columns in changes.items()
+    ))
+
+
+@receiver(post_save)
+def _record_save(sender, instance, created, using, raw=False, **kwargs):
+    if sender not in AGGREGATES or raw or not enabled():
+        return
+    _append(using, OutboxEvent(
+        aggregate=AGGREGATES[sender],
+        aggregate_id=instance.pk,
+        action='created' if created else 'updated',
+        payload=snapshot(instance),
+    ))
+
+
+@receiver(post_delete)
+def _record_delete(sender, instance, using, **kwargs):
+    if sender not in AGGREGATES or not enabled():
+        return
+    _append(using, OutboxEvent(
+        aggregate=AGGREGATES[sender], aggregate_id=instance.pk, action='deleted', payload=snapshot(instance)
+    ))
+
+
+# Transactions below this id have all committed or rolled back
+VISIBLE_HORIZON = RawSQL('pg_snapshot_xmin(pg_current_snapshot())::text::bigint', [])
+
+
+def _ordered(using):
+    """Whether ``using`` hands out event ids in commit order (a single writer)."""
+    return connections[using].vendor != 'postgresql'
+
+
+def _key(event_id, using):
+    """``(txid, id)`` of an event, the order consumers read it in on PostgreSQL."""
+    txid = (
+        OutboxEvent.objects.using(using).filter(id__lte=event_id)
+        .order_by('-id').values_list('txid', flat=True).first()
+    )
+    return txid, event_id
+
+
+def _rank(key):
+    txid, event_id = key
+    return (-1 if txid is None else txid), event_id
+
+
+def _after(events, key):
+    txid, event_id = key
+    if txid is None:
+        return events.filter(id__gt=event_id)
+    return events.filter(Q(txid__gt=txid) | Q(txid=txid, id__gt=event_id))
+
+
+def _before(events, key):
+    txid, event_id = key
+    if txid is None:
+        return events.filter(id__lt=event_id)
+    return events.filter(Q(txid__lt=txid) | Q(txid=txid, id__lt=event_id))
+
+
+def read(after=0, limit=None, using=DEFAULT_DB_ALIAS):
+    """Up to ``limit`` events that follow event ``after``, oldest first.
+
+    Ids are handed out at INSERT, not at COMMIT. On SQLite there is one
+    writer at a time, so id order is commit order. On PostgreSQL an event
+    with a lower id can become visible after one with a higher id, so events
+    are read in ``(txid, id)`` order and only from transactions below the
+    snapshot's xmin: every one of those has already committed or rolled
+    back, and nothing can appear before the consumer's offset later.
+    """
+    limit = limit or getattr(settings, 'OUTBOX_BATCH_SIZE', 500)
+    events = OutboxEvent.objects.using(using)
+    if _ordered(using):
+        return list(events.filter(id__gt=after).order_by('id')[:limit])
+    events = events.filter(txid__lt=VISIBLE_HORIZON)
+    if after:
+        events = _after(events, _key(after, using))
+    return list(events.order_by('txid', 'id')[:limit])
+
+
+def event_dict(event):
+    return {
+        'id': event.id,
+        'aggregate': event.aggregate,
+        'aggregateId': event.aggregate_id,
+        'action': event.action,
+        'payload': event.payload,
+        'createdAt': event.created_at.isoformat(),
+    }
+
+
+def position(consumer, using=DEFAULT_DB_ALIAS):
+    """Last event id ``consumer`` has committed on database ``using`` (0 if none)."""
+    return (
+        ConsumerOffset.objects.filter(consumer=consumer, database=using)
+        .values_list('position', flat=True).first()
+        or 0
+    )
+
+
+def commit(consumer, event_id, using=DEFAULT_DB_ALIAS):
+    """Record that ``consumer`` processed every event up to ``event_id``; never moves back."""
+    offset, _ = ConsumerOffset.objects.get_or_create(consumer=consumer, database=using)
+    if _ordered(using):
+        ConsumerOffset.objects.filter(pk=offset.pk, position__lt=event_id).update(
+            position=event_id, updated_at=timezone.now()
+        )
+        return
+    # Offsets follow read order, (txid, id), so the current one is compared by key
+    with transaction.atomic():
+        position = ConsumerOffset.objects.select_for_update().values_list('position', flat=True).get(pk=offset.pk)
+        if _rank(_key(event_id, using)) > _rank(_key(position, using)):
+            ConsumerOffset.objects.filter(pk=offset.pk).update(position=event_id, updated_at=timezone.now())
+
+
+def compact(using=DEFAULT_DB_ALIAS, batch_size=1000):
+    """Delete events past retention that every consumer of ``using`` has read; return the count.
+
+    The event at the slowest consumer's offset is kept, since ``read``
+    resumes from its position.
+    """
+    cutoff = timezone.now() - timedelta(hours=getattr(settings, 'OUTBOX_RETENTION_HOURS', 72))
+    events = OutboxEvent.objects.using(using).filter(created_at__lt=cutoff)
+    positions = ConsumerOffset.objects.filter(database=using).values_list('position', flat=True)
+    if positions:
+        if _ordered(using):
+            events = events.filter(id__lt=min(positions))
+        else:
+            events = _before(events, min((_key(position, using) for position in positions), key=_rank))
+    deleted = 0
+    while True:
+        ids = list(events.order_by('id').values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return deleted
+        deleted += OutboxEvent.objects.using(using).filter(id__in=ids).delete()[0]
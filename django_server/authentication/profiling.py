@@ -0,0 +1,184 @@
+"""Per-request CPU sampling and SQL capture for the profiling middleware.
+
+A profile is a JSON document with:
+
+* ``stacks``: folded call stacks of the request thread, sampled every
+  PROFILING_INTERVAL_MS (flamegraph.pl / speedscope "collapsed" format);
+* ``queries``: every SQL statement with its duration; statements slower
+  than PROFILING_SLOW_QUERY_MS also carry their EXPLAIN plan.
+
+Profiles are written to PROFILING_DIR as a ring buffer of at most
+PROFILING_MAX_FILES files. The directory is created private to the server's
+user (0700) and each file 0600, since a profile shows who called what. Query
+parameters and the query string are left out unless PROFILING_RECORD_PARAMS
+is set.
+
+Each file starts with a one-line header (the fields the index shows), then
+the profile itself, so listing profiles reads one line per file.
+"""
+import json
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from itertools import count
+
+from django.conf import settings
+from django.core import signing
+from django.db import connections
+from django.utils import timezone
+
+SIGNING_SALT = 'authentication.profiling'
+PROFILE_NAME = re.compile(r'^[0-9]{8}T[0-9]{6}-[0-9]+-[0-9]+\.json$')
+
+_sequence = count()
+_write_lock = threading.Lock()
+
+
+HEADER_FIELDS = ('method', 'path', 'status', 'ms', 'sqlMs')
+
+
+def profile_dir():
+    directory = getattr(settings, 'PROFILING_DIR', None) or os.path.join(settings.BASE_DIR, 'profiles')
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    if os.stat(directory).st_mode & 0o077:
+        os.chmod(directory, 0o700)  # created before, or by someone else, with a looser mode
+    return directory
+
+
+def record_params():
+    return getattr(settings, 'PROFILING_RECORD_PARAMS', False)
+
+
+def make_token():
+    """Value for the X-Profile header that turns profiling on for a request."""
+    return signing.TimestampSigner(salt=SIGNING_SALT).sign('profile')
+
+
+def token_is_valid(token):
+    try:
+        signing.TimestampSigner(salt=SIGNING_SALT).unsign(
+            token, max_age=getattr(settings, 'PROFILING_TOKEN_MAX_AGE', 3600)
+        )
+        return True
+    except signing.BadSignature:
+        return False
+
+
+class StackSampler(threading.Thread):
+    """Statistical profiler: periodically snapshots one thread's stack."""
+
+    def __init__(self, target_ident, interval):
+        super().__init__(name='profile-sampler', daemon=True)
+        self.target_ident = target_ident
+        self.interval = interval
+        self.samples = Counter()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.target_ident)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+                frame = frame.f_back
+            if stack:
+                self.samples[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+class QueryRecorder:
+    """execute_wrapper callable that times every statement on any connection."""
+
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            query = {
+                'sql': sql,
+                'alias': context['connection'].alias,
+                'many': many,
+                'ms': round((time.perf_counter() - started) * 1000, 3),
+                '_params': params,  # for EXPLAIN; dropped before writing
+            }
+            if record_params():
+                query['params'] = repr(params)[:500]
+            self.queries.append(query)
+
+
+def explain_slow_queries(queries):
+    """Attach a plan to each slow SELECT, explained on the alias that ran it."""
+    threshold = getattr(settings, 'PROFILING_SLOW_QUERY_MS', 50)
+    for query in queries:
+        if query['ms'] < threshold or query['many'] or not query['sql'].lstrip().upper().startswith('SELECT'):
+            continue
+        connection = connections[query['alias']]
+        prefix = 'EXPLAIN QUERY PLAN ' if connection.vendor == 'sqlite' else 'EXPLAIN '
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(prefix + query['sql'], query.get('_params'))
+                query['plan'] = [' '.join(str(col) for col in row) for row in cursor.fetchall()]
+        except Exception as exc:  # the plan is best effort
+            query['plan'] = [f'EXPLAIN failed: {exc}']
+
+
+def write_profile(profile):
+    """Store ``profile`` and trim the ring buffer; return the file name."""
+    for query in profile.get('queries', ()):
+        query.pop('_params', None)
+    directory = profile_dir()
+    name = f"{timezone.now():%Y%m%dT%H%M%S}-{os.getpid()}-{next(_sequence)}.json"
+    header = {field: profile.get(field) for field in HEADER_FIELDS}
+    header['queryCount'] = len(profile.get('queries', ()))
+    fd = os.open(os.path.join(directory, name), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'w') as handle:
+        handle.write(json.dumps(header) + '\n')
+        json.dump(profile, handle)
+
+    with _write_lock:
+        names = sorted(list_profile_names(), key=lambda n: os.path.getmtime(os.path.join(directory, n)))
+        for old in names[:-getattr(settings, 'PROFILING_MAX_FILES', 200)]:
+            try:
+                os.remove(os.path.join(directory, old))
+            except FileNotFoundError:
+                pass
+    return name
+
+
+def list_profile_names():
+    return [name for name in os.listdir(profile_dir()) if PROFILE_NAME.match(name)]
+
+
+def list_profiles():
+    """Headers of the stored profiles, newest first, each with its ``id``."""
+    directory = profile_dir()
+    headers = []
+    for name in sorted(list_profile_names(), reverse=True):
+        try:
+            with open(os.path.join(directory, name)) as handle:
+                header = json.loads(handle.readline())
+        except (FileNotFoundError, ValueError):  # trimmed meanwhile, or still being written
+            continue
+        headers.append({'id': name, **header})
+    return headers
+
+
+def read_profile(name):
+    if not PROFILE_NAME.match(name):
+        return None
+    try:
+        with open(os.path.join(profile_dir(), name)) as handle:
+            handle.readline()
+            return json.loads(handle.read())
+    except (FileNotFoundError, ValueError):
+        return None
@@ -0,0 +1,221 @@
+"""Appointment reminders driven by a hierarchical timing wheel.
+
+``run_reminders`` keeps every reminder due within the wheel's horizon in
+memory. Adding or cancelling a timer is O(1), and each tick only looks at
+one slot, so nothing is ever re-scanned:
+
+* the window ahead is filled by a range query on the (date, time) index,
+  extended a little at a time as the clock moves;
+* appointments booked after their window was loaded are picked up by
+  polling ids above a watermark (a primary-key range, also indexed);
+* status is checked lazily when a reminder fires. A cancelled or completed
+  appointment is dropped then, so status changes need no event feed;
+* ``reminded_at`` is set with a conditional UPDATE when a reminder fires.
+  After a restart the wheel is rebuilt from the database, and reminders
+  missed while down (within REMINDER_GRACE_MINUTES) fire immediately.
+"""
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import Max, Q
+from django.utils import timezone
+
+from .models import Appointment, NotificationEvent
+from .outbox import record
+from .writer import write_transaction
+
+ACTIVE_STATUSES = ('pending', 'confirmed')
+
+
+class TimingWheel:
+    """Hierarchical (cascading) timing wheel over integer ticks.
+
+    Level ``n`` has ``sizes[n]`` slots, each spanning the full range of the
+    levels below it. A timer sits in the coarsest level that still tells it
+    apart from "now". When a coarse slot's turn comes, its timers cascade
+    into finer levels, and they fire from level 0.
+    """
+
+    def __init__(self, sizes=(60, 60, 24), now=0):
+        self.sizes = sizes
+        self.spans = [1]
+        for size in sizes[:-1]:
+            self.spans.append(self.spans[-1] * size)
+        self.horizon = self.spans[-1] * sizes[-1]
+        self.slots = [[{} for _ in range(size)] for size in sizes]
+        self.where = {}  # key -> slot dict holding it
+        self.overdue = {}
+        self.now = now
+
+    def __len__(self):
+        return len(self.where)
+
+    def __contains__(self, key):
+        return key in self.where
+
+    def add(self, key, due):
+        """Schedule ``key`` at tick ``due``; False when beyond the horizon."""
+        self.remove(key)
+        delta = due - self.now
+        if delta <= 0:
+            bucket = self.overdue
+        elif delta >= self.horizon:
+            return False
+        else:
+            level = 0
+            while delta >= self.spans[level] * self.sizes[level]:
+                level += 1
+            bucket = self.slots[level][(due // self.spans[level]) % self.sizes[level]]
+        bucket[key] = due
+        self.where[key] = bucket
+        return True
+
+    def remove(self, key):
+        bucket = self.where.pop(key, None)
+        if bucket is not None:
+            del bucket[key]
+
+    def advance(self, to):
+        """Move the clock to tick ``to``; return the keys that came due."""
+        fired = list(self.overdue)
+        for key in fired:
+            del self.where[key]
+        self.overdue.clear()
+        while self.now < to:
+            self.now += 1
+            # Coarse slots whose turn it is move their timers down first
+            for level in range(len(self.sizes) - 1, 0, -1):
+                if self.now % self.spans[level] == 0:
+                    bucket = self.slots[level][(self.now // self.spans[level]) % self.sizes[level]]
+                    pending = list(bucket.items())
+                    bucket.clear()
+                    for key, due in pending:
+                        del self.where[key]
+                        self.add(key, due)
+            bucket = self.slots[0][self.now % self.sizes[0]]
+            fired.extend(bucket)
+            for key in bucket:
+                del self.where[key]
+            bucket.clear()
+            fired.extend(self.overdue)
+            for key in self.overdue:
+                del self.where[key]
+            self.overdue.clear()
+        return fired
+
+
+def _when(date, time):
+    return timezone.make_aware(datetime.combine(date, time))
+
+
+def _between(start, end):
+    """Q for appointments whose (date, time) lies in [start, end), index friendly."""
+    start, end = timezone.localtime(start), timezone.localtime(end)
+    if start.date() == end.date():
+        return Q(date=start.date(), time__gte=start.time(), time__lt=end.time())
+    return (
+        Q(date=start.date(), time__gte=start.time())
+        | Q(date__gt=start.date(), date__lt=end.date())
+        | Q(date=end.date(), time__lt=end.time())
+    )
+
+
+class ReminderScheduler:
+    """Feeds the wheel from the database and sends the reminders it fires."""
+
+    def __init__(self, using=DEFAULT_DB_ALIAS, now=None):
+        self.using = using
+        self.tick = getattr(settings, 'REMINDER_TICK_SECONDS', 1)
+        self.lead = timedelta(minutes=getattr(settings, 'REMINDER_LEAD_MINUTES', 60))
+        self.grace = timedelta(minutes=getattr(settings, 'REMINDER_GRACE_MINUTES', 30))
+        now = now or timezone.now()
+        self.epoch = now
+        self.wheel = TimingWheel(getattr(settings, 'REMINDER_WHEEL_SIZES', (60, 60, 24)))
+        self.loaded_until = now - self.grace
+        self.watermark = self.appointments().aggregate(top=Max('id'))['top'] or 0
+        self.sent = 0
+
+    def appointments(self):
+        return Appointment.objects.using(self.using)
+
+    def _tick_of(self, moment):
+        return int((moment - self.epoch).total_seconds() // self.tick)
+
+    def _schedule(self, appointment_id, date, time):
+        remind_at = _when(date, time) - self.lead
+        self.wheel.add(appointment_id, self._tick_of(remind_at))
+
+    def extend(self):
+        """Load reminders due up to the edge of the wheel's horizon."""
+        # The wheel only holds timers less than one horizon past its own clock
+        until = self.epoch + timedelta(seconds=(self.wheel.now + self.wheel.horizon - 1) * self.tick)
+        if until <= self.loaded_until:
+            return 0
+        rows = self.appointments().filter(
+            _between(self.loaded_until + self.lead, until + self.lead),
+            status__in=ACTIVE_STATUSES,
+            reminded_at=None,
+        ).values_list('id', 'date', 'time')
+        count = 0
+        for appointment_id, date, time in rows.iterator():
+            self._schedule(appointment_id, date, time)
+            count += 1
+        self.loaded_until = until
+        return count
+
+    def poll_new(self):
+        """Schedule appointments created since the last poll."""
+        rows = list(
+            self.appointments().filter(id__gt=self.watermark, status__in=ACTIVE_STATUSES, reminded_at=None)
+            .order_by('id').values_list('id', 'date', 'time')
+        )
+        for appointment_id, date, time in rows:
+            remind_at = _when(date, time) - self.lead
+            # Later ones arrive through extend() once the window gets there
+            if remind_at < self.loaded_until and _when(date, time) > timezone.now():
+                self._schedule(appointment_id, date, time)
+        if rows:
+            self.watermark = rows[-1][0]
+        return len(rows)
+
+    def fire(self, now):
+        due = self.wheel.advance(self._tick_of(now))
+        if not due:
+            return 0
+        # The events (on default) are written inside the reminders' transaction.
+        # On another shard, default commits just before it: a failure between
+        # the two may repeat a reminder but never loses one.
+        with write_transaction(using=self.using), write_transaction(using=DEFAULT_DB_ALIAS):
+            candidates = (
+                self.appointments().select_related('doctor')
+                .filter(id__in=due, status__in=ACTIVE_STATUSES, reminded_at=None)
+            )
+            # The conditional UPDATE makes each reminder go out exactly once,
+            # even with a second scheduler or a restart in between
+            live = [
+                appointment for appointment in candidates
+                if self.appointments().filter(id=appointment.id, reminded_at=None).update(reminded_at=now)
+            ]
+            record(Appointment, [appointment.id for appointment in live], using=self.using, reminded_at=now)
+            NotificationEvent.objects.using(DEFAULT_DB_ALIAS).bulk_create([
+                NotificationEvent(
+                    recipient_id=appointment.patient_id,
+                    kind='appointment_reminder',
+                    payload={
+                        'appointment': appointment.id,
+                        'doctor': appointment.doctor.fam_dr_name,
+                        'date': appointment.date.isoformat(),
+                        'time': appointment.time.strftime('%I:%M %p'),
+                    },
+                )
+                for appointment in live
+            ])
+        self.sent += len(live)
+        return len(live)
+
+    def run_once(self, now=None):
+        now = now or timezone.now()
+        self.poll_new()
+        self.extend()
+        return self.fire(now)
@@ -0,0 +1,231 @@
+"""Offline re-scoring of stored predictions with a new classifier version.
+
+``rescore`` walks one prediction table on one database in id order, a chunk
+at a time:
+
+1. a thread pool fetches the chunk's images, up to ``prefetch`` chunks ahead
+   of inference;
+2. the images go in batches of ``batch_size`` to a process pool running
+   ``inference.score``, which builds one tensor per batch;
+3. the chunk's new disease, confidence and model_version are written with
+   one bulk UPDATE. The same transaction fixes the dashboard rollups, adds
+   outbox events and moves the RescoreCheckpoint to the chunk's last id.
+
+The rollups live on ``default``. On another shard they cannot share the
+chunk's transaction, so the chunk's deltas are saved with its checkpoint
+and then applied on ``default`` in a transaction that also marks the chunk
+done there. A run that stopped in between applies them when it resumes,
+and never twice.
+
+An interrupted run resumes after its checkpoint. Rows that already carry the
+new version are skipped. So are images that cannot be fetched or decoded:
+they count as failed and are retried by a ``restart``.
+"""
+import multiprocessing
+import urllib.request
+from collections import defaultdict, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import date
+
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import F
+from django.utils import timezone
+
+from . import inference
+from .models import Appointment, ArchivedPrediction, Prediction, RescoreCheckpoint
+from .outbox import record_each
+from .rollups import bump_many
+from .writer import write_transaction
+
+TABLES = {
+    'predictions': Prediction,
+    'archived': ArchivedPrediction,
+}
+
+
+@dataclass
+class ChunkResult:
+    scored: int
+    failed: int
+    changed: int
+    last_id: int
+
+
+def fetch_image(url, timeout):
+    """Image bytes from ``url`` (http(s) or file); None when it cannot be read."""
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            return response.read()
+    except (OSError, ValueError):
+        return None
+
+
+def checkpoint_for(version, table, using, restart=False):
+    checkpoint, _ = RescoreCheckpoint.objects.using(using).get_or_create(
+        model_version=version, table=table, database=using
+    )
+    if checkpoint.pending_rollups:
+        # The previous run stopped before the last chunk's rollups reached default
+        _apply_rollups(checkpoint, checkpoint.last_id, _decode(checkpoint.pending_rollups))
+    if restart:
+        RescoreCheckpoint.objects.using(using).filter(pk=checkpoint.pk).update(
+            last_id=0, scored=0, failed=0, finished_at=None, pending_rollups=None
+        )
+        RescoreCheckpoint.objects.using(DEFAULT_DB_ALIAS).filter(
+            model_version=version, table=table, database=using
+        ).update(rollups_through=0)
+        checkpoint.refresh_from_db()
+    return checkpoint
+
+
+def _chunks(model, using, version, after, chunk_size):
+    stale = model.objects.using(using).exclude(model_version=version).order_by('id')
+    while True:
+        rows = list(stale.filter(id__gt=after).values('id', 'image_url', 'disease', 'timestamp')[:chunk_size])
+        if not rows:
+            return
+        yield rows
+        after = rows[-1]['id']
+
+
+def _rollup_deltas(model, using, changed):
+    """Rollup moves for ``changed`` = ``{id: (row, new disease)}``."""
+    deltas = defaultdict(int)
+    for row, disease in changed.values():
+        day = timezone.localdate(row['timestamp'])
+        deltas[('prediction', day, None, '', row['disease'])] -= 1
+        deltas[('prediction', day, None, '', disease)] += 1
+    if model is Prediction:
+        # Appointment rollups are keyed by the linked prediction's disease
+        linked = Appointment.objects.using(using).filter(prediction_id__in=list(changed)).values(
+            'prediction_id', 'date', 'doctor_id', 'status'
+        )
+        for appointment in linked:
+            row, disease = changed[appointment['prediction_id']]
+            key = ('appointment', appointment['date'], appointment['doctor_id'], appointment['status'])
+            deltas[(*key, row['disease'])] -= 1
+            deltas[(*key, disease)] += 1
+    return deltas
+
+
+def _encode(deltas):
+    return [[kind, day.isoformat(), doctor_id, status, disease, delta]
+            for (kind, day, doctor_id, status, disease), delta in deltas.items() if delta]
+
+
+def _decode(encoded):
+    return {(kind, date.fromisoformat(day), doctor_id, status, disease): delta
+            for kind, day, doctor_id, status, disease, delta in encoded}
+
+
+def _apply_rollups(checkpoint, last_id, deltas):
+    """Apply a shard chunk's rollup ``deltas`` on default unless its chunk was already applied."""
+    with write_transaction(using=DEFAULT_DB_ALIAS):
+        marker, _ = RescoreCheckpoint.objects.using(DEFAULT_DB_ALIAS).get_or_create(
+            model_version=checkpoint.model_version, table=checkpoint.table, database=checkpoint.database
+        )
+        applied = RescoreCheckpoint.objects.using(DEFAULT_DB_ALIAS).select_for_update().filter(
+            pk=marker.pk
+        ).values_list('rollups_through', flat=True).get()
+        if applied >= last_id:
+            return
+        bump_many(deltas)
+        RescoreCheckpoint.objects.using(DEFAULT_DB_ALIAS).filter(pk=marker.pk).update(rollups_through=last_id)
+
+
+def _write(model, using, version, checkpoint, rows, results):
+    updates, changed = [], {}
+    for row, result in zip(rows, results):
+        if result is None:
+            continue
+        disease, confidence = result
+        updates.append(model(id=row['id'], disease=disease, confidence=confidence, model_version=version))
+        if disease != row['disease']:
+            changed[row['id']] = (row, disease)
+    failed = len(rows) - len(updates)
+
+    last_id = rows[-1]['id']
+    # Rollups are on default: a chunk on another shard leaves its deltas with the checkpoint
+    separate = using != DEFAULT_DB_ALIAS
+    with write_transaction(using=using):
+        model.objects.using(using).bulk_update(updates, ['disease', 'confidence', 'model_version'], batch_size=500)
+        deltas = _rollup_deltas(model, using, changed)
+        if not separate:
+            bump_many(deltas)
+        if model is Prediction:
+            record_each(model, {
+                update.id: {'disease': update.disease, 'confidence': update.confidence, 'model_version': version}
+                for update in updates
+            }, using=using)
+        RescoreCheckpoint.objects.using(using).filter(pk=checkpoint.pk).update(
+            last_id=last_id,
+            scored=F('scored') + len(updates),
+            failed=F('failed') + failed,
+            pending_rollups=_encode(deltas) if separate else None,
+            updated_at=timezone.now(),
+        )
+    if separate:
+        _apply_rollups(checkpoint, last_id, deltas)
+    return ChunkResult(len(updates), failed, len(changed), last_id)
+
+
+def rescore(table, using, version, model_path=None, model=None, restart=False, chunk_size=512, batch_size=32,
+            workers=0, fetch_threads=16, prefetch=2, fetch_timeout=10):
+    """Re-score ``table`` on ``using``; yields a ChunkResult per chunk written.
+
+    With ``workers`` > 0, inference runs in that many processes, each loading
+    ``model_path``. Otherwise ``model`` (loaded by the caller) scores inline.
+    """
+    model_class = TABLES[table]
+    checkpoint = checkpoint_for(version, table, using, restart)
+    source = _chunks(model_class, using, version, checkpoint.last_id, chunk_size)
+
+    fetchers = ThreadPoolExecutor(max_workers=fetch_threads, thread_name_prefix='rescore-fetch')
+    pool = None
+    if workers:
+        # spawn, not fork: the fetch threads are already running
+        pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=inference.init_worker, initargs=(model_path,))
+    else:
+        inference.use_model(model)
+
+    def submit(images):
+        if pool is not None:
+            return pool.submit(inference.score, images)
+        future = Future()
+        future.set_result(inference.score(images))
+        return future
+
+    fetching, scoring = deque(), deque()
+
+    def fetch_next():
+        rows = next(source, None)
+        if rows is not None:
+            fetching.append((rows, [fetchers.submit(fetch_image, row['image_url'], fetch_timeout) for row in rows]))
+
+    try:
+        for _ in range(prefetch + 1):
+            fetch_next()
+        while fetching or scoring:
+            # Keep the next chunk queued in the pool while this one is written
+            if fetching and len(scoring) < 2:
+                rows, downloads = fetching.popleft()
+                images = [download.result() for download in downloads]
+                fetch_next()
+                present = [position for position, image in enumerate(images) if image is not None]
+                batches = [present[start:start + batch_size] for start in range(0, len(present), batch_size)]
+                scoring.append((rows, [(batch, submit([images[position] for position in batch]))
+                                       for batch in batches]))
+                continue
+            rows, batches = scoring.popleft()
+            results = [None] * len(rows)
+            for batch, future in batches:
+                for position, result in zip(batch, future.result()):
+                    results[position] = result
+            yield _write(model_class, using, version, checkpoint, rows, results)
+        RescoreCheckpoint.objects.using(using).filter(pk=checkpoint.pk).update(finished_at=timezone.now())
+    finally:
+        fetchers.shutdown(wait=False, cancel_futures=True)
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
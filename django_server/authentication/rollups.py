@@ -0,0 +1,186 @@
+"""Incrementally maintained dashboard counters.
+
+Writers call the ``record_*`` helpers in the same transaction as the change
+they describe; ``dashboard_stats`` then answers range queries by summing a
+handful of rollup rows instead of scanning Appointment and Prediction.
+"""
+from collections import defaultdict
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Q, Sum, Value
+from django.db.models.functions import Coalesce, TruncDate
+from django.utils import timezone
+
+from .models import Appointment, ArchivedPrediction, DashboardRollup, Prediction
+from .sharding import shards
+
+GENERAL_CONSULTATION = 'General Consultation'
+
+
+def bump(kind, day, doctor_id=None, status='', disease='', delta=1):
+    keys = {
+        'kind': kind,
+        'day': day,
+        'doctor_id': doctor_id,
+        'status': status,
+        'disease': disease,
+    }
+    if DashboardRollup.objects.filter(**keys).update(count=F('count') + delta):
+        return
+    try:
+        with transaction.atomic():
+            DashboardRollup.objects.create(count=delta, **keys)
+    except IntegrityError:
+        # Another writer created the row between our UPDATE and INSERT
+        DashboardRollup.objects.filter(**keys).update(count=F('count') + delta)
+
+
+def bump_many(deltas):
+    """Apply ``{(kind, day, doctor_id, status, disease): delta}`` in a few queries.
+
+    Existing rows are locked and rewritten with one bulk UPDATE; missing keys
+    are inserted with one bulk INSERT. Used by set-wise writers such as the
+    bulk status endpoint, where per-key bumps would dominate the query count.
+    """
+    deltas = {key: delta for key, delta in deltas.items() if delta}
+    if not deltas:
+        return
+
+    match = Q()
+    for kind, day, doctor_id, status, disease in deltas:
+        match |= Q(kind=kind, day=day, doctor_id=doctor_id, status=status, disease=disease)
+
+    with transaction.atomic():
+        existing = list(DashboardRollup.objects.select_for_update().filter(match))
+        for row in existing:
+            row.count += deltas.pop((row.kind, row.day, row.doctor_id, row.status, row.disease), 0)
+        DashboardRollup.objects.bulk_update(existing, ['count'])
+
+        try:
+            with transaction.atomic():
+                DashboardRollup.objects.bulk_create([
+                    DashboardRollup(kind=kind, day=day, doctor_id=doctor_id, status=status,
+                                    disease=disease, count=delta)
+                    for (kind, day, doctor_id, status, disease), delta in deltas.items()
+                ])
+        except IntegrityError:
+            for (kind, day, doctor_id, status, disease), delta in deltas.items():
+                bump(kind, day, doctor_id, status, disease, delta)
+
+
+def _appointment_disease(appointment):
+    return appointment.prediction.disease if appointment.prediction_id else GENERAL_CONSULTATION
+
+
+def record_appointment_created(appointment):
+    bump('appointment', appointment.date, appointment.doctor_id,
+         appointment.status, _appointment_disease(appointment))
+
+
+def record_status_change(appointment_id, old_status, new_status):
+    """Move one appointment's count from ``old_status`` to ``new_status``."""
+    if old_status == new_status:
+        return
+    row = (
+        Appointment.objects.filter(id=appointment_id)
+        .annotate(disease=Coalesce('prediction__disease', Value(GENERAL_CONSULTATION)))
+        .values('date', 'doctor_id', 'disease')
+        .first()
+    )
+    if row is None:
+        return
+    bump('appointment', row['date'], row['doctor_id'], old_status, row['disease'], delta=-1)
+    bump('appointment', row['date'], row['doctor_id'], new_status, row['disease'])
+
+
+def record_prediction_created(prediction):
+    bump('prediction', timezone.localdate(prediction.timestamp), disease=prediction.disease)
+
+
+def dashboard_stats(start=None, end=None, doctor_id=None):
+    """Aggregate rollups between ``start`` and ``end`` (inclusive dates)."""
+    rows = DashboardRollup.objects.all()
+    if start:
+        rows = rows.filter(day__gte=start)
+    if end:
+        rows = rows.filter(day__lte=end)
+
+    appointments = rows.filter(kind='appointment')
+    if doctor_id:
+        appointments = appointments.filter(doctor_id=doctor_id)
+    predictions = rows.filter(kind='prediction')
+
+    by_status = {status: 0 for status, _ in Appointment.STATUS_CHOICES}
+    for row in appointments.values('status').annotate(total=Sum('count')):
+        by_status[row['status']] = row['total']
+
+    appointment_diseases = {
+        row['disease']: row['total']
+        for row in appointments.values('disease').annotate(total=Sum('count'))
+        if row['total']
+    }
+    prediction_diseases = {
+        row['disease']: row['total']
+        for row in predictions.values('disease').annotate(total=Sum('count'))
+        if row['total']
+    }
+
+    return {
+        'appointments': {
+            'total': sum(by_status.values()),
+            'byStatus': by_status,
+            'byDisease': appointment_diseases,
+        },
+        'predictions': {
+            'total': sum(prediction_diseases.values()),
+            'byDisease': prediction_diseases,
+        },
+    }
+
+
+def compute_rollups():
+    """Recompute every rollup key from the source tables on every shard."""
+    counts = defaultdict(int)
+
+    for alias in shards():
+        appointments = (
+            Appointment.objects.using(alias)
+            .annotate(disease=Coalesce('prediction__disease', Value(GENERAL_CONSULTATION)))
+            .values('date', 'doctor_id', 'status', 'disease')
+            .annotate(total=Count('id'))
+            .order_by()
+        )
+        for row in appointments:
+            counts[('appointment', row['date'], row['doctor_id'], row['status'], row['disease'])] += row['total']
+
+    for queryset in [Prediction.objects.using(alias) for alias in shards()] + [ArchivedPrediction.objects.all()]:
+        predictions = (
+            queryset
+            .annotate(day=TruncDate('timestamp'))
+            .values('day', 'disease')
+            .annotate(total=Count('id'))
+            .order_by()
+        )
+        for row in predictions:
+            counts[('prediction', row['day'], None, '', row['disease'])] += row['total']
+
+    return counts
+
+
+def stored_rollups():
+    return {
+        (row.kind, row.day, row.doctor_id, row.status, row.disease): row.count
+        for row in DashboardRollup.objects.all()
+        if row.count
+    }
+
+
+@transaction.atomic
+def rebuild_rollups(counts=None):
+    counts = compute_rollups() if counts is None else counts
+    DashboardRollup.objects.all().delete()
+    DashboardRollup.objects.bulk_create([
+        DashboardRollup(kind=kind, day=day, doctor_id=doctor_id, status=status,
+                        disease=disease, count=count)
+        for (kind, day, doctor_id, status, disease), count in counts.items()
+    ], batch_size=1000)
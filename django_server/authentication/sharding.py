@@ -0,0 +1,360 @@
+"""Horizontal sharding of patient-owned rows.
+
+Predictions, appointments, messages and reports belong to one patient (the
+tenant) and live on that patient's shard. Users, patient profiles and
+doctors are reference tables: they are written to ``default`` and copied to
+every shard, so foreign keys and lookups such as ``appointment.doctor``
+resolve inside a shard.
+
+ShardRouter picks the database for a sharded model from, in order:
+
+* an explicit ``use_shard(alias)`` block;
+* the object being saved or followed (its patient's shard);
+* the patient authenticated for the current request (``activate``), so a
+  patient's own queries need no changes in the views.
+
+Doctor and staff requests have no tenant. The few global lists fan out over
+every shard and merge (``fan_out``); by-id actions ``locate`` the row first.
+Each shard allocates primary keys (of the sharded tables and of prediction
+embeddings) from its own range of SHARD_ID_SPAN ids (``manage.py shards
+init``), so ids stay unique across shards and survive moving a patient.
+
+With SHARDS empty (the default) every route is ``default``.
+"""
+import contextvars
+import hashlib
+import heapq
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signals import request_finished, request_started
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import Case, Q, Value, When
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import (
+    Appointment, Doctor, Message, Patient, Prediction, PredictionEmbedding, Report, ShardAssignment, User,
+)
+from .outbox import muted, record
+from .writer import write_transaction
+
+# Sharded model -> field holding the owning patient (messages: see owner_id)
+SHARDED_MODELS = {
+    Prediction: 'user_id',
+    Appointment: 'patient_id',
+    Report: 'patient_id',
+    Message: None,
+}
+REFERENCE_MODELS = (User, Patient, Doctor)
+# Tables whose ids each shard allocates from its own range
+ID_RANGE_MODELS = (*SHARDED_MODELS, PredictionEmbedding)
+
+_override = contextvars.ContextVar('shard_override', default=None)
+_tenant = contextvars.ContextVar('shard_tenant', default=None)
+_pool = None
+
+
+class ShardMoveError(Exception):
+    """A patient's rows cannot be moved without breaking another patient's rows."""
+
+
+def enabled():
+    return bool(getattr(settings, 'SHARDS', None))
+
+
+def shards():
+    return list(getattr(settings, 'SHARDS', None) or [DEFAULT_DB_ALIAS])
+
+
+def _cache_key(user_id):
+    return f'shard:user:{user_id}'
+
+
+def shard_for_user(user_id):
+    """Shard holding ``user_id``'s rows; assigns one by hash on first use."""
+    if not enabled() or user_id is None:
+        return DEFAULT_DB_ALIAS
+    alias = cache.get(_cache_key(user_id))
+    if alias is None:
+        names = shards()
+        assignment, _ = ShardAssignment.objects.using(DEFAULT_DB_ALIAS).get_or_create(
+            user_id=user_id,
+            defaults={'shard': names[int(hashlib.sha1(str(user_id).encode()).hexdigest(), 16) % len(names)]},
+        )
+        alias = assignment.shard
+        cache.set(_cache_key(user_id), alias, getattr(settings, 'SHARD_MAP_CACHE_SECONDS', 60))
+    return alias
+
+
+def owner_id(instance):
+    field = SHARDED_MODELS[type(instance)]
+    if field is not None:
+        return getattr(instance, field)
+    # A message belongs to the patient side of the conversation
+    if instance.sender_id is None:
+        return None
+    return instance.receiver_id if instance.sender.role == 'doctor' else instance.sender_id
+
+
+def activate(user):
+    """Route the current request's sharded queries to ``user``'s shard (patients only)."""
+    if enabled() and not user.is_staff and getattr(user, 'role', None) != 'doctor':
+        _tenant.set(user.pk)
+
+
+@receiver([request_started, request_finished])
+def _reset_tenant(**kwargs):
+    _tenant.set(None)
+
+
+@contextmanager
+def use_shard(alias):
+    token = _override.set(alias)
+    try:
+        yield alias
+    finally:
+        _override.reset(token)
+
+
+class ShardRouter:
+    def _route(self, model, **hints):
+        if model not in SHARDED_MODELS or not enabled():
+            return None
+        alias = _override.get()
+        if alias:
+            return alias
+        instance = hints.get('instance')
+        if type(instance) in SHARDED_MODELS:
+            if instance._state.db and not instance._state.adding:
+                return instance._state.db
+            return shard_for_user(owner_id(instance))
+        tenant = _tenant.get()
+        if tenant is not None:
+            return shard_for_user(tenant)
+        return None
+
+    db_for_read = _route
+    db_for_write = _route
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if not enabled():
+            return None
+        # Reference rows exist on every shard
+        if isinstance(obj1, REFERENCE_MODELS) or isinstance(obj2, REFERENCE_MODELS):
+            return True
+        # An unsaved sharded row goes to its owner's shard when saved, whatever
+        # database the relation descriptors guessed for it meanwhile
+        if (type(obj1) in SHARDED_MODELS and obj1._state.adding) or (type(obj2) in SHARDED_MODELS and obj2._state.adding):
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if app_label == 'authentication' and model_name in ('shardassignment', 'consumeroffset'):
+            return db == DEFAULT_DB_ALIAS
+        return None
+
+
+def _executor():
+    global _pool
+    if _pool is None:
+        _pool = ThreadPoolExecutor(max_workers=len(shards()), thread_name_prefix='shard')
+    return _pool
+
+
+def fan_out(query):
+    """Run ``query(alias)`` on every shard concurrently; results in shard order."""
+    names = shards()
+    if len(names) == 1:
+        return [query(names[0])]
+    futures = [_executor().submit(contextvars.copy_context().run, query, alias) for alias in names]
+    return [future.result() for future in futures]
+
+
+def merge_sorted(results, key, reverse=False):
+    """Merge per-shard lists that are each already sorted by ``key``."""
+    return list(heapq.merge(*results, key=key, reverse=reverse))
+
+
+def locate(model, pk):
+    """Shard holding ``model`` row ``pk``; ``default`` when off or not found."""
+    if not enabled():
+        return DEFAULT_DB_ALIAS
+    names = shards()
+    span = getattr(settings, 'SHARD_ID_SPAN', 10 ** 12)
+    try:
+        home = names[int(pk) // span]  # where it was allocated, unless moved since
+    except (TypeError, ValueError, IndexError):
+        home = None
+    for alias in ([home] if home else []) + [name for name in names if name != home]:
+        if model.objects.using(alias).filter(pk=pk).exists():
+            return alias
+    return DEFAULT_DB_ALIAS
+
+
+def group_by_shard(model, pks):
+    """``{alias: [pk, ...]}``; pks found nowhere are grouped under ``default``."""
+    if not enabled():
+        return {DEFAULT_DB_ALIAS: list(pks)}
+    found = fan_out(lambda alias: set(model.objects.using(alias).filter(pk__in=pks).values_list('pk', flat=True)))
+    groups = {}
+    for pk in pks:
+        alias = next((name for name, hits in zip(shards(), found) if pk in hits), DEFAULT_DB_ALIAS)
+        groups.setdefault(alias, []).append(pk)
+    return groups
+
+
+def tenant_rows(alias, user_id):
+    """Querysets of one patient's rows on ``alias``, parents before children."""
+    return [
+        (Prediction, Prediction.objects.using(alias).filter(user_id=user_id)),
+        (PredictionEmbedding, PredictionEmbedding.objects.using(alias).filter(prediction__user_id=user_id)),
+        (Appointment, Appointment.objects.using(alias).filter(patient_id=user_id)),
+        (Report, Report.objects.using(alias).filter(patient_id=user_id)),
+        (Message, Message.objects.using(alias).filter(Q(sender_id=user_id) | Q(receiver_id=user_id))),
+    ]
+
+
+def _copy_preserving_timestamps(model, objects, copied):
+    """Insert ``objects`` where ``copied`` (the tenant's rows on the target) lives.
+
+    Rows already in ``copied`` are left alone, so a re-run skips them; an id
+    taken on the target by any other row is an error, not a silent skip.
+    """
+    alias = copied.db
+    pks = [obj.pk for obj in objects]
+    present = set(copied.filter(pk__in=pks).values_list('pk', flat=True))
+    if model.objects.using(alias).filter(pk__in=pks).exclude(pk__in=present).exists():
+        raise ShardMoveError(f'{model._meta.verbose_name} ids are already taken on {alias}')
+    objects = [obj for obj in objects if obj.pk not in present]
+    # bulk_create stamps auto_now_add fields with the current time; put the
+    # original values back afterwards.
+    stamped = [field.attname for field in model._meta.concrete_fields if getattr(field, 'auto_now_add', False)]
+    originals = [[getattr(obj, name) for name in stamped] for obj in objects]
+    model.objects.using(alias).bulk_create(objects)
+    if stamped and objects:
+        for obj, values in zip(objects, originals):
+            for name, value in zip(stamped, values):
+                setattr(obj, name, value)
+        model.objects.using(alias).bulk_update(objects, stamped)
+
+
+def _copy_embeddings(objects, alias):
+    """Re-insert embeddings on ``alias`` under new ids.
+
+    New ids sort above every similarity index's watermark for ``alias``, and
+    cannot collide with ids allocated before the table had an id range.
+    """
+    if not objects:
+        return
+    prediction_ids = [obj.prediction_id for obj in objects]
+    embeddings = PredictionEmbedding.objects.using(alias).filter(prediction_id__in=prediction_ids)
+    embeddings.delete()  # copies left by an interrupted run
+    PredictionEmbedding.objects.using(alias).bulk_create(
+        PredictionEmbedding(prediction_id=obj.prediction_id, vector=obj.vector) for obj in objects
+    )
+    embeddings.update(created_at=Case(
+        *(When(prediction_id=obj.prediction_id, then=Value(obj.created_at)) for obj in objects)
+    ))
+
+
+def move_tenant(user_id, target):
+    """Move one patient's rows to ``target``; return ``{model name: rows moved}``.
+
+    Rows are copied into ``target`` in one transaction, then the shard map
+    is flipped, then the source copies are deleted. A failure before the
+    flip leaves the source authoritative, and a re-run skips rows already
+    copied. Embeddings get new ids on ``target``. Appointments that point at another patient's prediction lose
+    that link; reports doing so (in either direction) block the move.
+    """
+    source = shard_for_user(user_id)
+    if source == target:
+        return {}
+
+    rows = {model: list(queryset) for model, queryset in tenant_rows(source, user_id)}
+    moved_predictions = {prediction.pk for prediction in rows[Prediction]}
+    foreign_reports = Report.objects.using(source).filter(prediction_id__in=moved_predictions).exclude(patient_id=user_id)
+    if foreign_reports.exists() or any(r.prediction_id not in moved_predictions for r in rows[Report]):
+        raise ShardMoveError(f'Reports link user {user_id} predictions with other patients')
+
+    unlinked = {
+        appointment.pk for appointment in rows[Appointment]
+        if appointment.prediction_id is not None and appointment.prediction_id not in moved_predictions
+    }
+    for appointment in rows[Appointment]:
+        if appointment.pk in unlinked:
+            appointment.prediction_id = None
+    copies = dict(tenant_rows(target, user_id))
+    with write_transaction(using=target):
+        for model, objects in rows.items():
+            if model is PredictionEmbedding:
+                _copy_embeddings(objects, target)
+            else:
+                _copy_preserving_timestamps(model, objects, copies[model])
+        record(Appointment, unlinked, using=target, prediction_id=None)
+
+    ShardAssignment.objects.using(DEFAULT_DB_ALIAS).update_or_create(user_id=user_id, defaults={'shard': target})
+    cache.delete(_cache_key(user_id))
+
+    with write_transaction(using=source):
+        orphaned = Appointment.objects.using(source).filter(prediction_id__in=moved_predictions).exclude(
+            patient_id=user_id
+        )
+        record(Appointment, list(orphaned.values_list('pk', flat=True)), using=source, prediction_id=None)
+        orphaned.update(prediction=None)
+        # The rows live on in ``target``; consumers see no change
+        with muted():
+            for model, objects in reversed(list(rows.items())):
+                model.objects.using(source).filter(pk__in=[obj.pk for obj in objects]).delete()
+    return {model._meta.model_name: len(objects) for model, objects in rows.items()}
+
+
+def _field_values(instance):
+    return {
+        field.attname: getattr(instance, field.attname)
+        for field in type(instance)._meta.concrete_fields if not field.primary_key
+    }
+
+
+def replicate(model, alias, batch_size=1000):
+    """Copy every ``model`` row from ``default`` to ``alias`` (insert or update)."""
+    fields = [field.name for field in model._meta.concrete_fields if not field.primary_key]
+    batch = []
+    for row in model.objects.using(DEFAULT_DB_ALIAS).order_by('pk').iterator(chunk_size=batch_size):
+        batch.append(row)
+        if len(batch) == batch_size:
+            model.objects.using(alias).bulk_create(batch, update_conflicts=True, unique_fields=['pk'], update_fields=fields)
+            batch = []
+    if batch:
+        model.objects.using(alias).bulk_create(batch, update_conflicts=True, unique_fields=['pk'], update_fields=fields)
+
+
+@receiver(post_save)
+def _replicate_save(sender, instance, using, **kwargs):
+    if sender not in REFERENCE_MODELS or using != DEFAULT_DB_ALIAS or not enabled():
+        return
+    pk, values = instance.pk, _field_values(instance)
+
+    def copy():
+        for alias in shards():
+            if alias != DEFAULT_DB_ALIAS:
+                sender.objects.using(alias).update_or_create(pk=pk, defaults=values)
+
+    # robust: a shard being down must not fail the write; `shards init` re-syncs
+    transaction.on_commit(copy, using=DEFAULT_DB_ALIAS, robust=True)
+
+
+@receiver(post_delete)
+def _replicate_delete(sender, instance, using, **kwargs):
+    if sender not in REFERENCE_MODELS or using != DEFAULT_DB_ALIAS or not enabled():
+        return
+    pk = instance.pk
+
+    def delete():
+        for alias in shards():
+            if alias != DEFAULT_DB_ALIAS:
+                sender.objects.using(alias).filter(pk=pk).delete()
+
+    transaction.on_commit(delete, using=DEFAULT_DB_ALIAS, robust=True)
@@ -0,0 +1,492 @@
+"""Similar-case search over prediction image embeddings.
+
+Embeddings are stored per prediction as float16 blobs (PredictionEmbedding).
+They are L2-normalised on the way in, so a dot product is the cosine
+similarity. ``VectorIndex`` holds them in two segments:
+
+* base: an immutable block, grouped by IVF list when the index is trained.
+  ``save`` writes it to SIMILARITY_INDEX_PATH as .npy files, and ``load``
+  maps them read-only, so every worker on a host shares one copy in the
+  page cache;
+* delta: vectors added since then, held in growable in-memory arrays.
+
+Search is exact, with batched dot products over chunks of the matrix, unless
+the base has IVF centroids (SIMILARITY_IVF_LISTS). Then only the
+SIMILARITY_IVF_PROBES lists nearest the query are scanned. Adding an id that
+is already indexed tombstones its old vector. ``merge`` folds the delta into
+a new base.
+
+Each process refreshes its index from the database at most every
+SIMILARITY_REFRESH_SECONDS, reading only embedding ids above its per-database
+watermark. Refreshes (and the merges they trigger) run on a background
+thread; searches keep using the current index meanwhile. Deleting a
+prediction replaces its embedding with an empty tombstone row, so every
+process drops it from its index on the next refresh.
+"""
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+import numpy as np
+from django.conf import settings
+from django.db import connections
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from .models import ArchivedPrediction, Prediction, PredictionEmbedding
+from .outbox import is_muted
+from .sharding import fan_out, locate, shards
+
+logger = logging.getLogger(__name__)
+
+CHUNK_ROWS = 8192  # rows per dot-product step; the float32 copy stays in cache
+
+
+def normalise(vectors):
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+def to_blob(vector):
+    return normalise(vector)[0].astype(np.float16).tobytes()
+
+
+def from_blob(blob):
+    return np.frombuffer(blob, dtype=np.float16)
+
+
+def _top_k(ids, scores, k):
+    """Best ``k`` of each row of ``scores`` (m x n) as ``(ids, scores)``, best first."""
+    ids = np.broadcast_to(ids, scores.shape)
+    if scores.shape[1] > k:
+        keep = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        ids, scores = np.take_along_axis(ids, keep, 1), np.take_along_axis(scores, keep, 1)
+    order = np.argsort(-scores, axis=1, kind='stable')
+    return np.take_along_axis(ids, order, 1), np.take_along_axis(scores, order, 1)
+
+
+def _pad(ids, scores, k):
+    pad = k - ids.shape[1]
+    if pad <= 0:
+        return ids, scores
+    return (np.pad(ids, ((0, 0), (0, pad)), constant_values=-1),
+            np.pad(scores, ((0, 0), (0, pad)), constant_values=-np.inf))
+
+
+def _scan(queries, ids, vectors, dead, k):
+    """Exact top ``k`` over ``vectors``, CHUNK_ROWS rows at a time."""
+    best_ids = np.empty((len(queries), 0), np.int64)
+    best_scores = np.empty((len(queries), 0), np.float32)
+    for start in range(0, len(ids), CHUNK_ROWS):
+        stop = start + CHUNK_ROWS
+        # float16 has no BLAS kernels: widen one chunk at a time
+        scores = queries @ np.asarray(vectors[start:stop], dtype=np.float32).T
+        scores[:, dead[start:stop]] = -np.inf
+        chunk_ids, chunk_scores = _top_k(ids[start:stop], scores, k)
+        best_ids, best_scores = _top_k(
+            np.concatenate([best_ids, chunk_ids], 1), np.concatenate([best_scores, chunk_scores], 1), k
+        )
+    return best_ids, best_scores
+
+
+def nearest_centroid(vectors, centroids):
+    return np.concatenate([
+        np.argmax(np.asarray(vectors[start:start + CHUNK_ROWS], dtype=np.float32) @ centroids.T, axis=1)
+        for start in range(0, len(vectors), CHUNK_ROWS)
+    ] or [np.empty(0, np.int64)]).astype(np.int32)
+
+
+def train_centroids(vectors, lists, iterations=10, seed=0):
+    """Spherical k-means on a sample of ``vectors``; returns ``lists`` unit centroids."""
+    rng = np.random.default_rng(seed)
+    sample = np.asarray(
+        vectors[np.sort(rng.choice(len(vectors), min(len(vectors), lists * 64), replace=False))], dtype=np.float32
+    )
+    centroids = sample[rng.choice(len(sample), lists, replace=False)]
+    for _ in range(iterations):
+        assignment = nearest_centroid(sample, centroids)
+        order = np.argsort(assignment, kind='stable')
+        counts = np.bincount(assignment, minlength=lists)
+        sums = np.zeros_like(centroids)
+        present = counts > 0
+        starts = np.r_[0, np.cumsum(counts)[:-1]]
+        sums[present] = np.add.reduceat(sample[order], starts[present])
+        # Lists that lost every member restart from a random sample
+        sums[~present] = sample[rng.choice(len(sample), int((~present).sum()))]
+        centroids = normalise(sums)
+    return centroids
+
+
+class VectorIndex:
+    """Top-k cosine search over ids with float16 vectors (see module docs)."""
+
+    def __init__(self, dim):
+        self.dim = dim
+        self.watermarks = {}  # database alias -> highest PredictionEmbedding id loaded
+        self.stamp = None
+        self._lock = threading.Lock()
+        self._set_base(np.empty(0, np.int64), np.empty((0, dim), np.float16), None, None)
+
+    def _set_base(self, ids, vectors, centroids, offsets):
+        self.base_ids, self.base_vectors = ids, vectors
+        self.centroids, self.offsets = centroids, offsets
+        self.base_dead = np.zeros(len(ids), bool)
+        self._base_order = np.argsort(ids, kind='stable')
+        self._base_sorted = ids[self._base_order]
+        self._delta_ids = np.empty(1024, np.int64)
+        self._delta_vectors = np.empty((1024, self.dim), np.float16)
+        self._delta_lists = np.empty(1024, np.int32)
+        self._delta_dead = np.zeros(1024, bool)
+        self._delta_size = 0
+        self._delta_positions = {}
+
+    def __len__(self):
+        return int((~self.base_dead).sum() + (~self._delta_dead[:self._delta_size]).sum())
+
+    @property
+    def delta_size(self):
+        return self._delta_size
+
+    def _base_positions(self, ids):
+        found = np.searchsorted(self._base_sorted, ids)
+        found = found[found < len(self._base_sorted)]
+        return self._base_order[found[np.isin(self._base_sorted[found], ids)]]
+
+    def _forget(self, ids):
+        self.base_dead[self._base_positions(ids)] = True
+        for key in ids.tolist():
+            position = self._delta_positions.pop(key, None)
+            if position is not None:
+                self._delta_dead[position] = True
+
+    def add(self, ids, vectors):
+        """Index ``vectors`` under ``ids``, replacing any vectors those ids had."""
+        ids = np.asarray(ids, np.int64)
+        if not len(ids):
+            return
+        vectors = normalise(vectors).astype(np.float16)
+        # Within one batch the last vector for an id wins
+        _, last = np.unique(ids[::-1], return_index=True)
+        keep = np.sort(len(ids) - 1 - last)
+        ids, vectors = ids[keep], vectors[keep]
+        with self._lock:
+            lists = (nearest_centroid(vectors, self.centroids) if self.centroids is not None
+                     else np.zeros(len(ids), np.int32))
+            self._forget(ids)
+            size, needed = self._delta_size, self._delta_size + len(ids)
+            if needed > len(self._delta_ids):
+                capacity = max(needed, 2 * len(self._delta_ids))
+                self._delta_ids = np.resize(self._delta_ids, capacity)
+                self._delta_vectors = np.resize(self._delta_vectors, (capacity, self.dim))
+                self._delta_lists = np.resize(self._delta_lists, capacity)
+                self._delta_dead = np.resize(self._delta_dead, capacity)
+            self._delta_ids[size:needed] = ids
+            self._delta_vectors[size:needed] = vectors
+            self._delta_lists[size:needed] = lists
+            self._delta_dead[size:needed] = False
+            self._delta_positions.update(zip(ids.tolist(), range(size, needed)))
+            self._delta_size = needed
+
+    def remove(self, ids):
+        with self._lock:
+            self._forget(np.asarray(ids, np.int64))
+
+    def copy(self):
+        """An independent copy to change (or merge) while this one keeps serving."""
+        with self._lock:
+            other = VectorIndex.__new__(VectorIndex)
+            other.__dict__.update(self.__dict__)
+            size = self._delta_size
+            other._lock = threading.Lock()
+            other.watermarks = dict(self.watermarks)
+            other.base_dead = self.base_dead.copy()
+            other._delta_ids = self._delta_ids[:size].copy()
+            other._delta_vectors = self._delta_vectors[:size].copy()
+            other._delta_lists = self._delta_lists[:size].copy()
+            other._delta_dead = self._delta_dead[:size].copy()
+            other._delta_positions = dict(self._delta_positions)
+        return other
+
+    def vector(self, key):
+        """The stored (normalised) vector for ``key``, or None."""
+        with self._lock:
+            position = self._delta_positions.get(key)
+            if position is not None:
+                return self._delta_vectors[position].astype(np.float32)
+            positions = self._base_positions(np.array([key], np.int64))
+            if len(positions) and not self.base_dead[positions[0]]:
+                return np.asarray(self.base_vectors[positions[0]], dtype=np.float32)
+        return None
+
+    def search(self, queries, k, probes=None):
+        """``(ids, scores)``, each ``len(queries)`` x ``k``, best first; missing hits score -inf."""
+        queries = normalise(queries)
+        with self._lock:
+            base = self.base_ids, self.base_vectors, self.base_dead, self.centroids, self.offsets
+            size = self._delta_size
+            delta = (self._delta_ids[:size], self._delta_vectors[:size], self._delta_dead[:size],
+                     self._delta_lists[:size])
+        base_ids, base_vectors, base_dead, centroids, offsets = base
+        delta_ids, delta_vectors, delta_dead, delta_lists = delta
+
+        if centroids is None:
+            found = [_scan(queries, base_ids, base_vectors, base_dead, k),
+                     _scan(queries, delta_ids, delta_vectors, delta_dead, k)]
+            ids, scores = (np.concatenate(parts, 1) for parts in zip(*found))
+            ids, scores = _top_k(ids, scores, k)
+        else:
+            probes = min(probes or getattr(settings, 'SIMILARITY_IVF_PROBES', 16), len(centroids))
+            nearest = np.argpartition(-(queries @ centroids.T), probes - 1, axis=1)[:, :probes]
+            rows = []
+            for query, lists in zip(queries, nearest):
+                positions = np.concatenate([np.arange(offsets[i], offsets[i + 1]) for i in lists])
+                in_delta = np.flatnonzero(np.isin(delta_lists, lists))
+                found = [
+                    _scan(query[None], base_ids[positions], base_vectors[positions], base_dead[positions], k),
+                    _scan(query[None], delta_ids[in_delta], delta_vectors[in_delta], delta_dead[in_delta], k),
+                ]
+                rows.append(_pad(*_top_k(*(np.concatenate(parts, 1) for parts in zip(*found)), k), k))
+            ids = np.concatenate([row[0] for row in rows])
+            scores = np.concatenate([row[1] for row in rows])
+        return _pad(ids, scores, k)
+
+    def merge(self, lists=None, retrain=False):
+        """Fold the delta into a new base; with ``lists``, group it into IVF lists.
+
+        Existing centroids are reused unless ``retrain`` is set or their
+        number differs from ``lists``. Takes the index lock for the
+        duration, so run it from a command or a quiet moment.
+        """
+        with self._lock:
+            size = self._delta_size
+            alive_base = ~self.base_dead
+            alive_delta = ~self._delta_dead[:size]
+            ids = np.concatenate([self.base_ids[alive_base], self._delta_ids[:size][alive_delta]])
+            vectors = np.concatenate([np.asarray(self.base_vectors)[alive_base],
+                                      self._delta_vectors[:size][alive_delta]])
+            centroids = self.centroids
+            if lists is not None and (lists <= 0 or len(ids) < lists):
+                centroids = None
+            elif lists is not None and (retrain or centroids is None or len(centroids) != lists):
+                centroids = train_centroids(vectors, lists)
+            offsets = None
+            if centroids is not None:
+                assignment = nearest_centroid(vectors, centroids)
+                order = np.argsort(assignment, kind='stable')
+                ids, vectors = ids[order], vectors[order]
+                offsets = np.r_[0, np.cumsum(np.bincount(assignment, minlength=len(centroids)))]
+            self._set_base(ids, vectors, centroids, offsets)
+
+    def save(self, path):
+        """Merge and write the index under ``path``; readers switch over atomically."""
+        self.merge()
+        os.makedirs(path, exist_ok=True)
+        version = uuid.uuid4().hex[:12]
+        arrays = {'ids': self.base_ids, 'vectors': np.asarray(self.base_vectors)}
+        if self.centroids is not None:
+            arrays.update(centroids=self.centroids, offsets=self.offsets)
+        for name, array in arrays.items():
+            np.save(os.path.join(path, f'{name}-{version}.npy'), array)
+        meta = {'dim': self.dim, 'version': version, 'arrays': sorted(arrays), 'watermarks': self.watermarks}
+        staged = os.path.join(path, f'meta-{version}.json')
+        with open(staged, 'w') as handle:
+            json.dump(meta, handle)
+        os.replace(staged, os.path.join(path, 'meta.json'))
+        # Workers that mapped the old files keep them until they reload
+        for name in os.listdir(path):
+            if name.endswith('.npy') and not name.endswith(f'-{version}.npy'):
+                os.remove(os.path.join(path, name))
+        self.stamp = version
+
+    @classmethod
+    def load(cls, path):
+        """Map a saved index read-only; None when there is none."""
+        try:
+            with open(os.path.join(path, 'meta.json')) as handle:
+                meta = json.load(handle)
+            arrays = {
+                name: np.load(os.path.join(path, f"{name}-{meta['version']}.npy"),
+                              mmap_mode='r' if name == 'vectors' else None)
+                for name in meta['arrays']
+            }
+        except (OSError, ValueError, KeyError):
+            return None
+        index = cls(meta['dim'])
+        index._set_base(arrays['ids'], arrays['vectors'], arrays.get('centroids'), arrays.get('offsets'))
+        index.watermarks = meta['watermarks']
+        index.stamp = meta['version']
+        return index
+
+
+def saved_stamp(path):
+    try:
+        with open(os.path.join(path, 'meta.json')) as handle:
+            return json.load(handle)['version']
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def load_new_embeddings(index, batch_size=10000):
+    """Add embeddings written since ``index``'s watermarks; returns ``index`` or a new one."""
+    for alias in shards():
+        while True:
+            after = (index.watermarks.get(alias, 0) if index is not None else 0)
+            rows = list(
+                PredictionEmbedding.objects.using(alias).filter(id__gt=after).order_by('id')
+                .values_list('id', 'prediction_id', 'vector')[:batch_size]
+            )
+            if not rows:
+                break
+            vectors = [row for row in rows if len(row[2])]
+            if index is None and vectors:
+                index = VectorIndex(len(vectors[0][2]) // 2)
+            if index is None:
+                break  # only tombstones so far; nothing to index or remove
+            # Empty vectors are tombstones of deleted predictions
+            index.remove([row[1] for row in rows if not len(row[2])])
+            matching = [row for row in vectors if len(row[2]) == index.dim * 2]
+            if len(matching) < len(vectors):
+                logger.warning('Skipped %d embeddings whose dimension is not %d', len(vectors) - len(matching),
+                               index.dim)
+            if matching:
+                index.add([row[1] for row in matching],
+                          np.frombuffer(b''.join(bytes(row[2]) for row in matching), np.float16).reshape(-1, index.dim))
+            index.watermarks[alias] = rows[-1][0]
+    return index
+
+
+_index = None
+_index_lock = threading.Lock()
+_refreshed = 0.0
+_refreshing = False
+
+
+def refresh_index():
+    """Bring this process's index up to date with the saved index and the database."""
+    global _index, _refreshed, _refreshing
+    try:
+        index = _index
+        path = getattr(settings, 'SIMILARITY_INDEX_PATH', None)
+        stamp = saved_stamp(path) if path else None
+        if stamp and (index is None or index.stamp != stamp):
+            index = VectorIndex.load(path) or index
+        index = load_new_embeddings(index)
+        if index is not None and index.delta_size > getattr(settings, 'SIMILARITY_MERGE_ROWS', 50000):
+            # Merge a copy so searches never wait for it
+            index = index.copy()
+            index.merge(lists=getattr(settings, 'SIMILARITY_IVF_LISTS', 0) or None)
+        _index = index
+    finally:
+        _refreshed = time.monotonic()
+        _refreshing = False
+
+
+def _refresh_in_background():
+    try:
+        refresh_index()
+    except Exception:
+        logger.exception('Similarity index refresh failed')
+    finally:
+        connections.close_all()
+
+
+def get_index():
+    """This process's index (None until there are embeddings).
+
+    Until there is an index, callers load it themselves. After that, a due
+    refresh starts on a background thread and callers get the current index
+    straight away.
+    """
+    global _refreshing
+    with _index_lock:
+        if _index is None:
+            refresh_index()
+        elif not _refreshing and time.monotonic() - _refreshed >= getattr(settings, 'SIMILARITY_REFRESH_SECONDS', 30):
+            _refreshing = True
+            threading.Thread(target=_refresh_in_background, name='similarity-refresh', daemon=True).start()
+        return _index
+
+
+@receiver(post_delete, sender=Prediction)
+def _tombstone(sender, instance, using, **kwargs):
+    # Archived and moved predictions stay searchable; only real deletes go
+    if is_muted():
+        return
+    if PredictionEmbedding.objects.using(using).filter(prediction_id=instance.pk).delete()[0]:
+        PredictionEmbedding.objects.using(using).create(prediction_id=instance.pk, vector=b'')
+        if _index is not None:
+            _index.remove([instance.pk])
+
+
+def store_embeddings(predictions, vectors):
+    """Save one embedding per prediction, on the prediction's database."""
+    by_database = {}
+    for prediction, vector in zip(predictions, normalise(vectors)):
+        by_database.setdefault(prediction._state.db, []).append(
+            PredictionEmbedding(prediction_id=prediction.pk, vector=vector.astype(np.float16).tobytes())
+        )
+    for alias, rows in by_database.items():
+        PredictionEmbedding.objects.using(alias).filter(prediction_id__in=[row.prediction_id for row in rows]).delete()
+        PredictionEmbedding.objects.using(alias).bulk_create(rows)
+
+
+def encoder():
+    """The configured EMBEDDING_ENCODER: ``encode(predictions) -> (n, dim) array``."""
+    path = getattr(settings, 'EMBEDDING_ENCODER', None)
+    return import_string(path) if path else None
+
+
+def _case_details(ids):
+    rows = {}
+    for found in fan_out(lambda alias: list(
+        Prediction.objects.using(alias).filter(id__in=ids)
+        .values('id', 'disease', 'confidence', 'body_part', 'image_url', 'timestamp')
+    )):
+        rows.update((row['id'], row) for row in found)
+    missing = [pk for pk in ids if pk not in rows]
+    if missing:
+        rows.update(
+            (row['id'], row) for row in ArchivedPrediction.objects.filter(id__in=missing)
+            .values('id', 'disease', 'confidence', 'body_part', 'image_url', 'timestamp')
+        )
+    return rows
+
+
+def similar_cases(prediction_id, k):
+    """Up to ``k`` other predictions most similar to ``prediction_id``; None without an embedding."""
+    index = get_index()
+    query = index.vector(prediction_id) if index is not None else None
+    if query is None:
+        blob = (
+            PredictionEmbedding.objects.using(locate(Prediction, prediction_id))
+            .filter(prediction_id=prediction_id).values_list('vector', flat=True).first()
+        )
+        if not blob:  # none, or a tombstone
+            return None
+        query = from_blob(bytes(blob))
+    if index is None:
+        return []
+
+    # A few spare hits cover the query itself and deleted predictions
+    ids, scores = index.search(query, k + 5)
+    hits = [(int(pk), float(score)) for pk, score in zip(ids[0], scores[0])
+            if pk != prediction_id and np.isfinite(score)]
+    details = _case_details([pk for pk, _ in hits])
+    cases = []
+    for pk, score in hits:
+        row = details.get(pk)
+        if row is not None:
+            cases.append({
+                '_id': str(pk),
+                'disease': row['disease'],
+                'confidence': row['confidence'],
+                'bodyPart': row['body_part'],
+                'imageUrl': row['image_url'],
+                'timestamp': row['timestamp'].isoformat(),
+                'similarity': round(score, 4),
+            })
+    return cases[:k]
@@ -0,0 +1,174 @@
+"""Single-flight caching for hot read endpoints.
+
+``cached(key, compute, ttl)`` returns the cached value for ``key``. When
+the value is missing, only one caller recomputes it and every concurrent
+caller waits for that result. Waiting happens on a lock in this process and
+on a lock file across processes. Keys hash onto a fixed set of
+SINGLEFLIGHT_STRIPES locks (and lock files), so memory and files stay
+bounded however many keys there are; unrelated keys that share a stripe
+just take turns. On top of that:
+
+* stale-while-revalidate: for ``stale`` seconds after expiry the old value
+  is served while one background thread refreshes it;
+* probabilistic early refresh (XFetch): shortly before expiry, a caller may
+  start that background refresh early. The chance grows as expiry nears and
+  with how long the last computation took, so refreshes of a hot key are
+  spread out instead of all landing at the expiry instant;
+* a ``None`` result (say, an unknown id) is kept for SINGLEFLIGHT_MISS_SECONDS
+  only, and is not served stale.
+
+Coalescing across processes needs a cache backend shared by the workers
+(file based, memcached, redis). With a per-process backend (LocMemCache, the
+default, or DummyCache) one worker's result never reaches another, so a lock
+file would only make the workers recompute one after another; the lock file
+is skipped and each process coalesces on its own.
+"""
+import hashlib
+import math
+import os
+import random
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import DEFAULT_CACHE_ALIAS, cache, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import close_old_connections
+
+try:
+    import fcntl
+except ImportError:  # Windows: only in-process coalescing
+    fcntl = None
+
+_stripes = []
+_stripes_guard = threading.Lock()
+_held = threading.local()  # stripes whose lock file this thread holds
+_refreshing = set()
+_refreshing_guard = threading.Lock()
+
+
+def _stripe(key):
+    """Index of the lock stripe ``key`` hashes onto."""
+    with _stripes_guard:
+        if not _stripes:
+            _stripes.extend(threading.RLock() for _ in range(getattr(settings, 'SINGLEFLIGHT_STRIPES', 64)))
+    return int(hashlib.sha1(key.encode('utf-8')).hexdigest(), 16) % len(_stripes)
+
+
+def _lock_path(stripe):
+    directory = getattr(settings, 'SINGLEFLIGHT_LOCK_DIR', None) or os.path.join(
+        tempfile.gettempdir(), 'epicure-singleflight'
+    )
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, f'stripe-{stripe}.lock')
+
+
+def _shared_cache():
+    return not isinstance(caches[DEFAULT_CACHE_ALIAS], (LocMemCache, DummyCache))
+
+
+@contextmanager
+def _flight(key, blocking=True):
+    """Hold the in-process and cross-process locks for ``key``'s stripe.
+
+    Yields True when both locks were acquired. A non-blocking attempt yields
+    False instead of waiting. A blocking attempt gives up on the file lock
+    after SINGLEFLIGHT_WAIT_SECONDS and computes anyway.
+    """
+    stripe = _stripe(key)
+    thread_lock = _stripes[stripe]
+    if not thread_lock.acquire(blocking):
+        yield False
+        return
+    held = getattr(_held, 'stripes', None)
+    if held is None:
+        held = _held.stripes = set()
+    handle = None
+    try:
+        # A compute() that reads another key of the same stripe already holds its file
+        if fcntl is not None and stripe not in held and _shared_cache():
+            handle = open(_lock_path(stripe), 'a+')
+            deadline = time.monotonic() + getattr(settings, 'SINGLEFLIGHT_WAIT_SECONDS', 10)
+            while True:
+                try:
+                    fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    held.add(stripe)
+                    break
+                except BlockingIOError:
+                    if not blocking:
+                        yield False
+                        return
+                    if time.monotonic() > deadline:
+                        break
+                    time.sleep(0.005)
+        yield True
+    finally:
+        if handle is not None:
+            if stripe in held:
+                held.discard(stripe)
+                fcntl.flock(handle, fcntl.LOCK_UN)
+            handle.close()
+        thread_lock.release()
+
+
+def _store(key, compute, ttl, stale):
+    started = time.monotonic()
+    value = compute()
+    delta = time.monotonic() - started
+    if value is None:
+        ttl, stale = getattr(settings, 'SINGLEFLIGHT_MISS_SECONDS', 5), 0
+    # (value, compute seconds, fresh until, stale until)
+    cache.set(key, (value, delta, time.time() + ttl, time.time() + ttl + stale), timeout=ttl + stale)
+    return value
+
+
+def _refresh_in_background(key, compute, ttl, stale):
+    """Start one refresh of ``key``; a no-op while one is already running here."""
+    with _refreshing_guard:
+        if key in _refreshing:
+            return
+        _refreshing.add(key)
+
+    def run():
+        try:
+            with _flight(key, blocking=False) as acquired:
+                if acquired:
+                    _store(key, compute, ttl, stale)
+        finally:
+            close_old_connections()
+            with _refreshing_guard:
+                _refreshing.discard(key)
+
+    threading.Thread(target=run, name=f'refresh:{key}', daemon=True).start()
+
+
+def invalidate(*keys):
+    """Drop ``keys`` so the next ``cached`` call recomputes them."""
+    cache.delete_many(keys)
+
+
+def cached(key, compute, ttl, stale=None, beta=1.0):
+    """Return the cached value of ``compute()`` under ``key``; see module docs."""
+    stale = getattr(settings, 'SINGLEFLIGHT_STALE_SECONDS', 30) if stale is None else stale
+
+    entry = cache.get(key)
+    if entry is not None:
+        value, delta, fresh_until, stale_until = entry
+        now = time.time()
+        # XFetch: -log(U) is exponential, so most callers see the entry as
+        # fresh and only a few refresh early, more often closer to expiry.
+        if now - delta * beta * math.log(1.0 - random.random()) < fresh_until:
+            return value
+        if now < stale_until:
+            _refresh_in_background(key, compute, ttl, stale)
+            return value
+
+    with _flight(key):
+        # Whoever held the flight before us has usually filled the cache
+        entry = cache.get(key)
+        if entry is not None and time.time() < entry[2]:
+            return entry[0]
+        return _store(key, compute, ttl, stale)
@@ -1,3 +1,1068 @@
-from django.test import TestCase
+import os
+import struct
+import tempfile
+import threading
+from datetime import date, time, timedelta
+from io import StringIO
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import jwt
+import numpy as np
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import DEFAULT_DB_ALIAS, connection, connections, transaction
+from django.conf import settings
+from django.contrib import admin
+from django.test import Client, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from . import (
+    analytics, model_store, notifications, outbox, profiling, rescoring, similarity, singleflight, throttling, warmup,
+)
+from .appointment_status import APPLIED, bulk_transition, transition
+from .admin import EstimatedCountPaginator, LargeTableAdmin
+from .archive import archive_batch
+from .export import iter_rows, stream_csv
+from .middleware import admission_classes
+from .models import (
+    Appointment, ArchivedPrediction, Doctor, IdempotencyRecord, Message, NotificationEvent, OutboxEvent, Prediction,
+    Patient, PredictionEmbedding, Report, ShardAssignment, User,
+)
+from .reminders import ReminderScheduler
+from .rollups import compute_rollups, rebuild_rollups, stored_rollups
+from .sharding import ShardMoveError, fan_out, locate, move_tenant, shard_for_user
+from .threads import mark_read, read_thread
+from .writer import run_write, write_transaction
+
+
+# Two SQLite shard files next to the test database (see ShardingTests). The
+# test database is a file too: threads sharing an in-memory database get
+# "table is locked" errors instead of SQLite's ordinary busy waiting.
+TEST_SHARDS = ('shard1', 'shard2')
+if connections.settings[DEFAULT_DB_ALIAS]['ENGINE'].endswith('sqlite3'):
+    _test_dir = tempfile.mkdtemp(prefix='epicure-tests-')
+    if not connections.settings[DEFAULT_DB_ALIAS]['TEST']['NAME']:
+        connections.settings[DEFAULT_DB_ALIAS]['TEST']['NAME'] = os.path.join(_test_dir, 'test_default.sqlite3')
+    for _alias in TEST_SHARDS:
+        connections.settings.setdefault(_alias, {
+            **connections.settings[DEFAULT_DB_ALIAS],
+            'NAME': os.path.join(_test_dir, f'{_alias}.sqlite3'),
+            'TEST': {**connections.settings[DEFAULT_DB_ALIAS]['TEST'],
+                     'NAME': os.path.join(_test_dir, f'test_{_alias}.sqlite3')},
+        })
+
+
+def make_user(email, role='patient', **extra):
+    return User.objects.create_user(email=email, role=role, **extra)
+
+
+def client_for(user):
+    token = jwt.encode({'sub': str(user.id), 'email': user.email}, 'secret', algorithm='HS256')
+    return Client(HTTP_AUTHORIZATION=f'Bearer {token}')
+
+
+class WriteTransactionTests(TransactionTestCase):
+    def test_write_transaction_takes_the_write_lock_on_begin(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('SQLite only')
+        with CaptureQueriesContext(connection) as queries:
+            with write_transaction():
+                pass
+        self.assertIn('BEGIN IMMEDIATE', [query['sql'] for query in queries])
+
+    def test_other_transactions_stay_deferred(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('SQLite only')
+        with CaptureQueriesContext(connection) as queries:
+            with transaction.atomic():
+                pass
+            with write_transaction():
+                pass
+            with transaction.atomic():
+                pass
+        self.assertEqual([query['sql'] for query in queries if query['sql'].startswith('BEGIN')],
+                         ['BEGIN', 'BEGIN IMMEDIATE', 'BEGIN'])
+
+    @override_settings(WRITE_QUEUE_ENABLED=True)
+    def test_queued_write_returns_its_result(self):
+        sender, receiver = make_user('a@example.com'), make_user('b@example.com', 'doctor')
+        message = run_write(lambda: Message.objects.create(sender=sender, receiver=receiver, content='hi'))
+        self.assertTrue(Message.objects.filter(pk=message.pk).exists())
+
+    @override_settings(WRITE_QUEUE_ENABLED=True)
+    def test_queued_write_failure_reaches_the_caller(self):
+        def fail():
+            raise ValueError('boom')
+
+        with self.assertRaises(ValueError):
+            run_write(fail)
+
+
+def make_prediction(user, disease='Eczema', **extra):
+    return Prediction.objects.create(user=user, disease=disease, confidence=80.0,
+                                     image_url='https://example.com/x.jpg', **extra)
+
+
+class ExportTests(TransactionTestCase):
+    def setUp(self):
+        self.patient = make_user('patient@example.com')
+        self.ids = [make_prediction(self.patient).id for _ in range(7)]
+
+    def test_sqlite_export_holds_no_transaction(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('SQLite only')
+        chunks = iter_rows('predictions', chunk_size=3)
+        next(chunks)
+        self.assertFalse(connection.in_atomic_block)
+        chunks.close()
+
+    def test_rows_archived_mid_export_are_emitted_once(self):
+        chunks = iter_rows('predictions', chunk_size=3)
+        seen = [row[0] for row in next(chunks)]
+        archive_batch('predictions', timezone.now() + timedelta(days=1), 100)
+        self.assertEqual(ArchivedPrediction.objects.count(), 7)
+        seen += [row[0] for chunk in chunks for row in chunk]
+        self.assertEqual(seen, self.ids)
+
+    def test_predictions_carry_their_model_version(self):
+        Prediction.objects.filter(id=self.ids[0]).update(model_version='v2')
+        header, *lines = ''.join(stream_csv('predictions')).splitlines()
+        self.assertEqual(header.split(',')[-1], 'model_version')
+        self.assertEqual([line.split(',')[-1] for line in lines], ['v2'] + [''] * 6)
+
+    def test_rows_created_mid_export_are_left_out(self):
+        chunks = iter_rows('predictions', chunk_size=3)
+        seen = [row[0] for row in next(chunks)]
+        make_prediction(self.patient)
+        seen += [row[0] for chunk in chunks for row in chunk]
+        self.assertEqual(seen, self.ids)
+
+
+@override_settings(API_PAGE_SIZE=2)
+class ListTests(TestCase):
+    def setUp(self):
+        self.patient = make_user('patient@example.com')
+        now = timezone.now()
+        self.ids = [make_prediction(self.patient).id for _ in range(4)]
+        for offset, pk in enumerate(self.ids):  # the oldest row has the highest id
+            Prediction.objects.filter(id=pk).update(timestamp=now - timedelta(days=offset))
+        archive_batch('predictions', now - timedelta(hours=12), 100)  # archives all but ids[0]
+
+    def test_unpaged_list_returns_every_row_newest_first(self):
+        body = Client().get('/api/auth/predictions').json()
+        self.assertEqual([int(row['_id']) for row in body['predictions']], self.ids)
+        self.assertNotIn('nextCursor', body)
+
+    def test_limit_pages_by_id(self):
+        body = Client().get('/api/auth/predictions?limit=2').json()
+        self.assertEqual([int(row['_id']) for row in body['predictions']], self.ids[:1:-1])
+        self.assertEqual(body['nextCursor'], str(self.ids[2]))
+
+
+def plain_percentile(values, p):
+    values = sorted(values)
+    position = p / 100 * (len(values) - 1)
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+class AnalyticsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        patcher = mock.patch.object(analytics, '_snapshot', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.patient = make_user('patient@example.com')
+
+    def test_aggregates_match_a_plain_computation(self):
+        days = [3, 0, 1, 3, 4, 4, 4, 6, 0, 2, 5, 6]
+        confidence = [12.5, 99.0, 40.0, 55.5, 100.0, 0.0, 73.0, 61.0, 38.0, 90.5, 20.0, 47.0]
+        groups = [0, 1, 0, 1, 1, 0, 2, 2, 0, 1, 2, 0]
+        window = 3
+        trends = analytics.compute_trends(np.array(days, dtype=np.int32), np.array(confidence, dtype=np.float32),
+                                          np.array(groups), 3, window)
+
+        self.assertEqual(trends['firstDay'], 0)
+        for group in range(3):
+            rows = [(day, value) for day, value, g in zip(days, confidence, groups) if g == group]
+            counts = [sum(1 for day, _ in rows if day == d) for d in range(7)]
+            self.assertEqual(trends['counts'][group].tolist(), counts)
+            self.assertEqual(trends['totals'][group], len(rows))
+            rolling = [sum(counts[max(0, d - window + 1):d + 1]) / min(d + 1, window) for d in range(7)]
+            self.assertEqual(np.round(trends['rolling'][group], 9).tolist(), [round(v, 9) for v in rolling])
+            values = [value for _, value in rows]
+            for p, got in zip(analytics.PERCENTILES, trends['percentiles'][group]):
+                self.assertAlmostEqual(got, plain_percentile(values, p), places=3)
+            edges = analytics.HISTOGRAM_EDGES
+            histogram = [sum(1 for v in values if edges[i] <= v < edges[i + 1] or (i == 9 and v == 100))
+                         for i in range(10)]
+            self.assertEqual(trends['histogram'][group].tolist(), histogram)
+
+    def test_grouping_by_two_fields(self):
+        for disease, part in (('Acne', 'Face'), ('Acne', 'Back'), ('Eczema', 'Face'), ('Acne', 'Face')):
+            make_prediction(self.patient, disease, body_part=part)
+        report = analytics.disease_trends(group_by=('disease', 'body_part'))
+        self.assertEqual({group['key']: group['total'] for group in report['groups']},
+                         {'Acne / Face': 2, 'Acne / Back': 1, 'Eczema / Face': 1})
+
+    def totals(self):
+        return {group['key']: group['total'] for group in analytics.disease_trends()['groups']}
+
+    def test_deletes_and_edits_reach_the_report(self):
+        other = make_user('other@example.com')
+        make_prediction(other, 'Acne')
+        acne = make_prediction(self.patient, 'Acne')
+        self.assertEqual(self.totals(), {'Acne': 2})
+
+        other.delete()  # cascades to the prediction
+        self.assertEqual(self.totals(), {'Acne': 1})
+        acne.disease = 'Eczema'
+        acne.save()
+        self.assertEqual(self.totals(), {'Eczema': 1})
+
+    @override_settings(OUTBOX_ENABLED=False)
+    def test_snapshot_expires_without_the_outbox(self):
+        acne = make_prediction(self.patient, 'Acne')
+        self.assertEqual(self.totals(), {'Acne': 1})
+        Prediction.objects.filter(id=acne.id).update(disease='Eczema')
+        self.assertEqual(self.totals(), {'Acne': 1})
+        with override_settings(ANALYTICS_SNAPSHOT_MAX_AGE=0):
+            self.assertEqual(self.totals(), {'Eczema': 1})
+
+
+@override_settings(ADMIN_ESTIMATED_COUNT_THRESHOLD=5)
+class EstimatedCountTests(TestCase):
+    def setUp(self):
+        self.patient = make_user('patient@example.com')
+
+    def count(self, queryset):
+        return EstimatedCountPaginator(queryset, 10).count
+
+    def test_small_sparse_table_is_counted_exactly(self):
+        make_prediction(self.patient)
+        make_prediction(self.patient, id=10 ** 6)
+        self.assertEqual(self.count(Prediction.objects.order_by('-id')), 2)
+
+    def test_large_table_is_estimated(self):
+        for _ in range(7):
+            make_prediction(self.patient)
+        Prediction.objects.filter(id=Prediction.objects.order_by('id')[3].id).delete()
+        self.assertEqual(self.count(Prediction.objects.order_by('-id')), 7)  # the id range
+        self.assertEqual(self.count(Prediction.objects.filter(disease='Eczema').order_by('-id')), 6)
+
+    def test_changelists_list_newest_first(self):
+        self.client.force_login(make_user('admin@example.com', is_staff=True, is_superuser=True))
+        first, second = make_prediction(self.patient), make_prediction(self.patient)
+        response = self.client.get(reverse('admin:authentication_prediction_changelist'))
+        self.assertEqual([row.pk for row in response.context['cl'].result_list], [second.id, first.id])
+        for model, model_admin in admin.site._registry.items():
+            if isinstance(model_admin, LargeTableAdmin):
+                url = reverse(f'admin:{model._meta.app_label}_{model._meta.model_name}_changelist')
+                self.assertEqual(self.client.get(url).status_code, 200, url)
+
+
+class DateRangeTests(TestCase):
+    def setUp(self):
+        self.client = client_for(make_user('staff@example.com', is_staff=True))
+
+    def test_invalid_dates_are_rejected(self):
+        for path in ('/api/auth/dashboard/stats', '/api/auth/analytics/diseases'):
+            for query in ('from=yesterday', 'to=2026-02-30', 'from=2026-01-01&to=01/02/2026'):
+                self.assertEqual(self.client.get(f'{path}?{query}').status_code, 400, (path, query))
+
+    def test_missing_dates_mean_unbounded(self):
+        body = self.client.get('/api/auth/dashboard/stats?from=2026-01-01&to=').json()
+        self.assertEqual((body['from'], body['to']), ('2026-01-01', None))
+
+
+class StatusContentionTests(TransactionTestCase):
+    def setUp(self):
+        self.patient = make_user('patient@example.com')
+        self.doctor = Doctor.objects.create(user=make_user('doctor@example.com', 'doctor'), fam_dr_name='Dr. A',
+                                            fam_dr_edu='MD', fam_dr_hospital='General',
+                                            fam_dr_hospital_location='Town')
+        self.ids = [
+            Appointment.objects.create(patient=self.patient, doctor=self.doctor, date=date(2026, 1, day),
+                                       time=time(9)).id
+            for day in range(1, 11)
+        ]
+        rebuild_rollups()
+
+    def race(self, *jobs):
+        """Run ``jobs`` on their own threads, released together; returns their results."""
+        start = threading.Barrier(len(jobs))
+        results = [None] * len(jobs)
+
+        def run(index, job):
+            start.wait()
+            try:
+                results[index] = job()
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=run, args=(index, job)) for index, job in enumerate(jobs)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def status_events(self, apt_id):
+        return [event.payload['status'] for event in
+                OutboxEvent.objects.filter(aggregate='appointment', aggregate_id=apt_id, action='updated')
+                .order_by('id')]
+
+    def test_racing_transitions_both_apply_in_order(self):
+        for apt_id in self.ids:
+            cancelled, completed = self.race(lambda: transition(self.patient, apt_id, 'cancelled'),
+                                             lambda: transition(self.doctor.user, apt_id, 'completed'))
+            self.assertEqual([cancelled[0], completed[0]], [APPLIED, APPLIED])
+            steps = self.status_events(apt_id)
+            self.assertEqual(sorted(steps), ['cancelled', 'completed'])
+            self.assertEqual(Appointment.objects.get(id=apt_id).status, steps[-1])
+        self.assertEqual(stored_rollups(), dict(compute_rollups()))
+
+    def test_bulk_update_loses_nothing_to_single_updates(self):
+        jobs = [lambda: bulk_transition(self.doctor.user, self.ids, 'completed')]
+        jobs += [lambda apt_id=apt_id: transition(self.patient, apt_id, 'cancelled') for apt_id in self.ids]
+        bulk, *singles = self.race(*jobs)
+        for apt_id, (outcome, _) in zip(self.ids, singles):
+            self.assertEqual(outcome, APPLIED)
+            steps = self.status_events(apt_id)
+            # The bulk update either lost the row to the cancel or applied before or after it
+            self.assertIn(steps, (['cancelled'], ['completed', 'cancelled'], ['cancelled', 'completed']))
+            self.assertEqual(bulk[apt_id][0], 'completed' in steps)
+            self.assertEqual(Appointment.objects.get(id=apt_id).status, steps[-1])
+        self.assertEqual(stored_rollups(), dict(compute_rollups()))
+
+
+class StatusPolicyTests(TestCase):
+    def setUp(self):
+        self.patient = make_user('patient@example.com')
+        self.doctor = Doctor.objects.create(user=make_user('doctor@example.com', 'doctor'), fam_dr_name='Dr. A',
+                                            fam_dr_edu='MD', fam_dr_hospital='General',
+                                            fam_dr_hospital_location='Town')
+        self.appointment = Appointment.objects.create(patient=self.patient, doctor=self.doctor,
+                                                      date=date(2026, 1, 1), time=time(9))
+
+    def update(self, user, new_status):
+        return client_for(user).post(f'/api/auth/appointments/{self.appointment.id}/status',
+                                     {'status': new_status}, content_type='application/json')
+
+    def assertStatus(self, expected):
+        self.appointment.refresh_from_db()
+        self.assertEqual(self.appointment.status, expected)
+
+    def test_doctors_cannot_cancel_through_status_updates(self):
+        self.assertEqual(self.update(self.doctor.user, 'cancelled').status_code, 403)
+        self.assertStatus('pending')
+
+    def test_doctors_can_cancel_through_the_cancel_endpoint(self):
+        response = client_for(self.doctor.user).delete(f'/api/auth/appointments/{self.appointment.id}/cancel')
+        self.assertEqual(response.status_code, 200)
+        self.assertStatus('cancelled')
+
+    def test_patients_can_only_cancel(self):
+        self.assertEqual(self.update(self.patient, 'confirmed').status_code, 403)
+        self.assertEqual(self.update(self.patient, 'cancelled').status_code, 200)
+        self.assertStatus('cancelled')
+
+    def test_any_status_can_be_set_from_any_other(self):
+        for new_status in ('completed', 'confirmed', 'pending'):
+            self.assertEqual(self.update(self.doctor.user, new_status).status_code, 200)
+            self.assertStatus(new_status)
+        self.assertEqual(self.update(self.patient, 'cancelled').status_code, 200)
+        self.assertEqual(self.update(self.doctor.user, 'pending').status_code, 200)
+        self.assertStatus('pending')
+
+
+class BulkStatusTests(TestCase):
+    def setUp(self):
+        doctor = Doctor.objects.create(user=make_user('doctor@example.com', 'doctor'), fam_dr_name='Dr. A',
+                                       fam_dr_edu='MD', fam_dr_hospital='General', fam_dr_hospital_location='Town')
+        self.appointment = Appointment.objects.create(patient=make_user('patient@example.com'), doctor=doctor,
+                                                      date=date(2026, 1, 1), time=time(9))
+        self.client = client_for(doctor.user)
+
+    def post(self, ids):
+        return self.client.post('/api/auth/appointments/bulk-status', {'ids': ids, 'status': 'confirmed'},
+                                content_type='application/json')
+
+    def test_ids_must_be_a_list_of_integers(self):
+        for ids in (str(self.appointment.id), [str(self.appointment.id)], [True], [1.0], None):
+            self.assertEqual(self.post(ids).status_code, 400, ids)
+
+    def test_confirms_the_listed_appointments(self):
+        body = self.post([self.appointment.id, self.appointment.id]).json()
+        self.assertEqual(body['updated'], 1)
+        self.appointment.refresh_from_db()
+        self.assertEqual(self.appointment.status, 'confirmed')
+
+
+class DashboardTests(TestCase):
+    @override_settings(DASHBOARD_PARALLEL_QUERIES=True)
+    def test_parallel_queries_close_their_connections(self):
+        client = client_for(make_user('patient@example.com'))
+        with mock.patch('authentication.dashboard.connections', wraps=connections) as worker_connections:
+            self.assertEqual(client.get('/api/auth/dashboard').status_code, 200)
+        self.assertEqual(worker_connections.close_all.call_count, 5)
+
+
+class AdmissionControlTests(TestCase):
+    def setUp(self):
+        self.staff = make_user('staff@example.com', is_staff=True)
+        self.client = client_for(self.staff)
+        self.client.get('/ping')  # builds the middleware and its classes
+
+    def test_streaming_export_holds_its_slot_until_sent(self):
+        heavy = admission_classes['heavy']
+        response = self.client.get('/api/auth/export/predictions')
+        self.assertEqual(heavy.active, 1)
+        b''.join(response.streaming_content)
+        self.assertEqual(heavy.active, 0)
+
+    def test_batch_items_are_admitted_in_their_own_class(self):
+        auth = admission_classes['auth']
+        active, queue = auth.active, auth.queue
+        auth.active, auth.queue = auth.concurrency, 0
+        try:
+            response = self.client.post('/api/auth/batch', {'requests': [
+                {'method': 'POST', 'path': '/api/auth/login', 'body': {'email': 'x@example.com'}},
+                {'method': 'GET', 'path': '/api/auth/doctors'},
+            ]}, content_type='application/json')
+        finally:
+            auth.active, auth.queue = active, queue
+        self.assertEqual([item['status'] for item in response.json()['responses']], [503, 200])
+
+
+class RateLimitTests(TestCase):
+    def setUp(self):
+        self.store = throttling.SlidingWindowStore(os.path.join(tempfile.mkdtemp(), 'ratelimit.sqlite3'))
+        patcher = mock.patch.object(throttling, '_store', self.store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def rates(self, **rates):
+        return override_settings(REST_FRAMEWORK={**settings.REST_FRAMEWORK, 'DEFAULT_THROTTLE_RATES': rates})
+
+    def test_window_slides(self):
+        self.assertEqual(self.store.hit('k', 2, 60, now=0), (True, None))
+        self.assertEqual(self.store.hit('k', 2, 60, now=1), (True, None))
+        # Half of the previous window still overlaps: 2 * 0.5 + 1
+        self.assertEqual(self.store.hit('k', 2, 60, now=90), (True, None))
+        # 2 * 29/60 + 2
+        self.assertEqual(self.store.hit('k', 2, 60, now=91), (False, 29))
+        # A whole idle window later nothing carries over
+        self.assertEqual(self.store.hit('k', 2, 60, now=180), (True, None))
+
+    def test_rejected_hits_count(self):
+        for now in range(6):
+            self.store.hit('k', 2, 60, now=now)
+        # 6 * 20/60 + 1; counting only the two allowed hits would give 1.67
+        self.assertEqual(self.store.hit('k', 2, 60, now=100), (False, 20))
+
+    def test_limit_returns_429_with_retry_after(self):
+        with self.rates(**{'login.ip': '2/min'}):
+            codes = [self.client.post('/api/auth/login', {}, content_type='application/json') for _ in range(3)]
+        self.assertEqual([response.status_code for response in codes], [400, 400, 429])
+        self.assertTrue(1 <= int(codes[-1]['Retry-After']) <= 60)
+
+    def test_addresses_are_limited_separately(self):
+        with self.rates(**{'login.ip': '1/min'}):
+            first = self.client.post('/api/auth/login', {}, content_type='application/json', REMOTE_ADDR='10.0.0.1')
+            second = self.client.post('/api/auth/login', {}, content_type='application/json', REMOTE_ADDR='10.0.0.2')
+        self.assertEqual([first.status_code, second.status_code], [400, 400])
+
+    def test_users_are_limited_separately(self):
+        first, second = make_user('first@example.com'), make_user('second@example.com')
+        view = type('send_message', (), {})()
+        with self.rates(**{'send_message.user': '1/min'}):
+            hits = [
+                throttling.UserRateThrottle().allow_request(mock.Mock(user=user), view)
+                for user in (first, second, first)
+            ]
+        self.assertEqual(hits, [True, True, False])
+
+    def test_views_without_a_rate_are_not_counted(self):
+        with self.rates(), mock.patch.object(self.store, 'hit') as hit:
+            for _ in range(3):
+                self.client.post('/api/auth/login', {}, content_type='application/json')
+        hit.assert_not_called()
+
+
+class BatchTests(TestCase):
+    def test_failing_item_does_not_fail_the_batch(self):
+        client = client_for(make_user('patient@example.com'))
+        with self.assertLogs('authentication.batch', 'ERROR'):
+            response = client.post('/api/auth/batch', {'requests': [
+                {'method': 'POST', 'path': '/api/auth/reports/generate', 'body': {}},
+                {'method': 'GET', 'path': '/api/auth/doctors'},
+            ]}, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([item['status'] for item in response.json()['responses']], [500, 200])
+
+    def test_items_run_through_the_middleware(self):
+        client = client_for(make_user('patient@example.com'))
+        with mock.patch('authentication.middleware.AdmissionControlMiddleware.__call__', autospec=True,
+                        side_effect=lambda middleware, request: middleware.get_response(request)) as called:
+            client.post('/api/auth/batch', {'requests': [{'method': 'GET', 'path': '/api/auth/doctors'}]},
+                        content_type='application/json')
+        self.assertEqual([call.args[1].path for call in called.call_args_list],
+                         ['/api/auth/batch', '/api/auth/doctors'])
+
+
+class WarmUpTests(TestCase):
+    def test_only_runs_the_named_steps(self):
+        with mock.patch.object(warmup, 'STEPS', (('one', mock.Mock()), ('two', mock.Mock()))):
+            timings = warmup.warm_up(only=['two'])
+            self.assertEqual(list(timings), ['two'])
+            warmup.STEPS[0][1].assert_not_called()
+
+    def test_release_connections_closes_them(self):
+        default = connections[DEFAULT_DB_ALIAS]
+        default.ensure_connection()
+        with mock.patch.object(type(default), 'close', autospec=True) as close:
+            warmup.release_connections()
+        self.assertIn(default, [call.args[0] for call in close.call_args_list])
+
+
+class ProfilingTests(TestCase):
+    def setUp(self):
+        self.directory = os.path.join(tempfile.mkdtemp(prefix='epicure-profiles-'), 'profiles')
+        self.staff = make_user('staff@example.com', is_staff=True)
+
+    def profile(self, **extra):
+        with override_settings(PROFILING_ENABLED=True, PROFILING_DIR=self.directory, **extra):
+            response = client_for(self.staff).get('/api/auth/doctors?email=someone@example.com',
+                                                  HTTP_X_PROFILE=profiling.make_token())
+            return response['X-Profile-Id']
+
+    def test_profiles_are_private_and_redacted(self):
+        name = self.profile()
+        self.assertEqual(os.stat(self.directory).st_mode & 0o777, 0o700)
+        self.assertEqual(os.stat(os.path.join(self.directory, name)).st_mode & 0o777, 0o600)
+        with override_settings(PROFILING_DIR=self.directory):
+            stored = profiling.read_profile(name)
+        self.assertEqual(stored['path'], '/api/auth/doctors')
+        self.assertTrue(stored['queries'])
+        self.assertFalse(any('params' in query for query in stored['queries']))
+
+    def test_params_are_recorded_when_enabled(self):
+        name = self.profile(PROFILING_RECORD_PARAMS=True)
+        with override_settings(PROFILING_DIR=self.directory):
+            stored = profiling.read_profile(name)
+        self.assertIn('email=', stored['path'])
+        self.assertTrue(all('params' in query for query in stored['queries']))
+
+    def test_listing_reads_only_headers(self):
+        name = self.profile()
+        path = os.path.join(self.directory, name)
+        with open(path) as handle:
+            header = handle.readline()
+        with open(path, 'w') as handle:
+            handle.write(header + '{not json')
+        with override_settings(PROFILING_DIR=self.directory):
+            body = client_for(self.staff).get('/api/auth/profiles').json()
+        self.assertEqual([entry['id'] for entry in body['profiles']], [name])
+        self.assertEqual(body['profiles'][0]['path'], '/api/auth/doctors')
+        self.assertGreater(body['profiles'][0]['queryCount'], 0)
+
+
+class ModelStoreTests(TestCase):
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'model.weights')
+        self.arrays = {
+            'conv': np.arange(2 * 3 * 5, dtype=np.float32).reshape(2, 3, 5),
+            'ids': np.array([-1, 2 ** 40, 7], dtype=np.int64),
+            'mask': np.array([[1, 0, 1]], dtype=np.uint8),
+            'scale': np.array(0.5, dtype=np.float16),
+            'bias': np.array([1.5, -2.25], dtype='>f8'),
+        }
+
+    def test_round_trip(self):
+        model_store.save_weights(self.path, self.arrays, meta={'version': 'v1'})
+        with model_store.Weights(self.path) as weights:
+            self.assertEqual(weights.meta, {'version': 'v1'})
+            self.assertEqual(sorted(weights), sorted(self.arrays))
+            for name, array in self.arrays.items():
+                self.assertEqual(weights[name].dtype, array.dtype.newbyteorder('<'), name)
+                self.assertEqual(weights[name].shape, array.shape, name)
+                np.testing.assert_array_equal(weights[name], array)
+                self.assertEqual(weights[name].ctypes.data % model_store.ALIGN, 0, name)
+                self.assertFalse(weights[name].flags.writeable)
+
+    def test_other_files_are_rejected(self):
+        model_store.save_weights(self.path, self.arrays)
+        with open(self.path, 'rb') as handle:
+            good = handle.read()
+        for bad in (b'', b'EPW', b'NOPE' + good[4:], good[:4] + struct.pack('<I', 99) + good[8:]):
+            with open(self.path, 'wb') as handle:
+                handle.write(bad)
+            with self.assertRaises(ValueError):
+                model_store.Weights(self.path)
+
+    def test_replaced_file_is_mapped_again(self):
+        model_store.save_weights(self.path, {'w': np.zeros(4)})
+        old = model_store.open_weights(self.path)
+        self.assertIs(model_store.open_weights(self.path), old)
+        model_store.save_weights(self.path, {'w': np.ones(4)})
+        np.testing.assert_array_equal(model_store.open_weights(self.path)['w'], np.ones(4))
+        np.testing.assert_array_equal(old['w'], np.zeros(4))  # still mapped for whoever holds it
+
+    def test_convert_weights(self):
+        source = os.path.join(os.path.dirname(self.path), 'model.npz')
+        np.savez(source, **self.arrays)
+        call_command('convert_weights', source, output=self.path, model_version='v2', stdout=StringIO())
+        with model_store.Weights(self.path) as weights:
+            self.assertEqual(weights.meta['version'], 'v2')
+            np.testing.assert_array_equal(weights['conv'], self.arrays['conv'])
+
+
+class OutboxTests(TransactionTestCase):
+    def setUp(self):
+        self.patient = make_user('patient@example.com')
+        for _ in range(3):
+            make_prediction(self.patient)
+        self.events = outbox.read()
+
+    def test_read_resumes_after_an_event(self):
+        self.assertEqual(outbox.read(self.events[0].id), self.events[1:])
+
+    def test_commit_never_moves_back(self):
+        outbox.commit('tests', self.events[1].id)
+        outbox.commit('tests', self.events[0].id)
+        self.assertEqual(outbox.position('tests'), self.events[1].id)
+
+    def test_compact_keeps_the_event_at_the_offset(self):
+        outbox.commit('tests', self.events[1].id)
+        with override_settings(OUTBOX_RETENTION_HOURS=-1):
+            self.assertEqual(outbox.compact(), 1)
+        self.assertEqual(outbox.read(self.events[1].id), self.events[2:])
+
+
+@skipUnless(os.environ.get('DB_ENGINE') == 'postgresql', 'PostgreSQL only (DB_ENGINE=postgresql)')
+class PostgreSQLTests(TransactionTestCase):
+    def run_in_thread(self, job):
+        def run():
+            try:
+                job()
+            finally:
+                connection.close()
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        return thread
+
+    def test_connections_are_borrowed_from_the_pool(self):
+        if not settings.POSTGRES_POOL:
+            self.skipTest('POSTGRES_POOL=0')
+        default = connections[DEFAULT_DB_ALIAS]
+        default.ensure_connection()
+        pool = default.pool
+        before = pool.get_stats().get('requests_num', 0)
+        for _ in range(5):
+            default.close()  # hands the connection back
+            default.ensure_connection()
+        stats = pool.get_stats()
+        self.assertEqual(stats.get('requests_num', 0) - before, 5)
+        self.assertLessEqual(stats['pool_size'], pool.max_size)
+
+    def test_release_connections_drops_the_pool(self):
+        if not settings.POSTGRES_POOL:
+            self.skipTest('POSTGRES_POOL=0')
+        default = connections[DEFAULT_DB_ALIAS]
+        default.ensure_connection()
+        warmup.release_connections()
+        self.assertNotIn(DEFAULT_DB_ALIAS, default._connection_pools)
+
+    def test_export_reads_one_snapshot(self):
+        patient = make_user('patient@example.com')
+        ids = [make_prediction(patient).id for _ in range(3)]
+        chunks = iter_rows('predictions', chunk_size=1)
+        first = next(chunks)  # the snapshot is taken here
+
+        def write():
+            make_prediction(patient)
+            Prediction.objects.filter(id=ids[-1]).delete()
+
+        self.run_in_thread(write).join()
+        rows = first + [row for chunk in chunks for row in chunk]
+        self.assertEqual([row[0] for row in rows], ids)
+
+    def test_outbox_waits_for_open_transactions(self):
+        started, proceed = threading.Event(), threading.Event()
+
+        def hold_open():
+            with transaction.atomic():
+                with connection.cursor() as cursor:
+                    cursor.execute('SELECT pg_current_xact_id()')  # takes a txid before the other writer
+                started.set()
+                proceed.wait(10)
+                outbox.record(Prediction, [1])
+
+        thread = self.run_in_thread(hold_open)
+        started.wait(10)
+        outbox.record(Prediction, [2])  # lower txid still open: not readable yet
+        self.assertEqual(outbox.read(), [])
+        proceed.set()
+        thread.join()
+        events = outbox.read()
+        self.assertEqual([event.aggregate_id for event in events], [1, 2])
+        self.assertGreater(events[0].id, events[1].id)
+        outbox.commit('tests', events[0].id)
+        self.assertEqual(outbox.read(events[0].id), events[1:])
+        outbox.commit('tests', events[1].id)
+        self.assertEqual(outbox.position('tests'), events[1].id)
+
+
+@override_settings(SHARDS=[DEFAULT_DB_ALIAS, *TEST_SHARDS])
+class ShardingTests(TransactionTestCase):
+    databases = {DEFAULT_DB_ALIAS, *TEST_SHARDS}
+
+    def setUp(self):
+        if not connections.settings[DEFAULT_DB_ALIAS]['ENGINE'].endswith('sqlite3'):
+            self.skipTest('SQLite shard files only')
+        cache.clear()
+        call_command('shards', 'init', stdout=StringIO())
+        self.doctor = Doctor.objects.create(
+            user=make_user('doctor@example.com', 'doctor'), fam_dr_name='Dr. A', fam_dr_edu='MD',
+            fam_dr_hospital='General', fam_dr_hospital_location='Town',
+        )
+        self.first, self.second = make_user('first@example.com'), make_user('second@example.com')
+        ShardAssignment.objects.create(user_id=self.first.id, shard='shard1')
+        ShardAssignment.objects.create(user_id=self.second.id, shard='shard2')
+
+    def test_rows_are_written_to_the_patients_shard(self):
+        prediction = make_prediction(self.first)
+        self.assertEqual(prediction._state.db, 'shard1')
+        self.assertGreaterEqual(prediction.id, settings.SHARD_ID_SPAN)
+        self.assertFalse(Prediction.objects.using(DEFAULT_DB_ALIAS).exists())
+
+    def test_reference_rows_are_copied_to_every_shard(self):
+        self.assertEqual(fan_out(lambda alias: Doctor.objects.using(alias).count()), [1, 1, 1])
+
+    def test_fan_out_returns_results_in_shard_order(self):
+        make_prediction(self.first)
+        make_prediction(self.second)
+        make_prediction(self.second)
+        self.assertEqual(fan_out(lambda alias: Prediction.objects.using(alias).count()), [0, 1, 2])
+
+    def test_locate(self):
+        prediction = make_prediction(self.second)
+        self.assertEqual(locate(Prediction, prediction.id), 'shard2')
+        self.assertEqual(locate(Prediction, prediction.id + 1), DEFAULT_DB_ALIAS)
+
+    def test_move_tenant(self):
+        prediction = make_prediction(self.first)
+        similarity.store_embeddings([prediction], [[1.0, 0.0]])
+        embedding = PredictionEmbedding.objects.using('shard1').get()
+        report = Report.objects.create(patient=self.first, prediction=prediction, patient_name='First',
+                                       patient_age=30, patient_gender='F', pdf_url='/r.pdf')
+        Appointment.objects.create(patient=self.first, doctor=self.doctor, prediction=prediction,
+                                   date=date.today(), time=time(10, 0))
+        Message.objects.create(sender=self.first, receiver=self.doctor.user, content='hi')
+
+        moved = move_tenant(self.first.id, 'shard2')
+
+        self.assertEqual(moved, {'prediction': 1, 'predictionembedding': 1, 'appointment': 1, 'report': 1,
+                                 'message': 1})
+        self.assertEqual(shard_for_user(self.first.id), 'shard2')
+        for model in (Prediction, Appointment, Report, Message):
+            self.assertFalse(model.objects.using('shard1').exists())
+            self.assertEqual(model.objects.using('shard2').count(), 1)
+        self.assertEqual(Report.objects.using('shard2').get().created_at, report.created_at)
+        moved_embedding = PredictionEmbedding.objects.using('shard2').get()
+        self.assertEqual(moved_embedding.created_at, embedding.created_at)
+        self.assertGreaterEqual(moved_embedding.id, 2 * settings.SHARD_ID_SPAN)
+        self.assertFalse(PredictionEmbedding.objects.using('shard1').exists())
+
+    def test_move_tenant_refuses_to_overwrite_another_row(self):
+        make_prediction(self.first)
+        taken = Prediction.objects.using('shard1').get()
+        Prediction.objects.using('shard2').create(id=taken.id, user=self.second, disease='Acne', confidence=50.0,
+                                                  image_url='https://example.com/y.jpg')
+        with self.assertRaises(ShardMoveError):
+            move_tenant(self.first.id, 'shard2')
+        self.assertEqual(shard_for_user(self.first.id), 'shard1')
+
+    def test_write_and_its_outbox_event_roll_back_together(self):
+        with mock.patch('authentication.outbox._append', side_effect=RuntimeError('outbox down')):
+            with self.assertRaises(RuntimeError):
+                run_write(lambda: make_prediction(self.first), using='shard1')
+        self.assertFalse(Prediction.objects.using('shard1').exists())
+
+    @override_settings(WRITE_QUEUE_ENABLED=True)
+    def test_queued_write_runs_in_a_transaction_on_its_shard(self):
+        def insert():
+            self.assertTrue(connections['shard1'].in_atomic_block)
+            return make_prediction(self.first)
+
+        self.assertEqual(run_write(insert, using='shard1')._state.db, 'shard1')
+        with mock.patch('authentication.outbox._append', side_effect=RuntimeError('outbox down')):
+            with self.assertRaises(RuntimeError):
+                run_write(lambda: make_prediction(self.first), using='shard1')
+        self.assertEqual(Prediction.objects.using('shard1').count(), 1)
+
+    def test_status_change_and_its_outbox_event_roll_back_together(self):
+        appointment = Appointment.objects.create(patient=self.first, doctor=self.doctor,
+                                                 date=date.today(), time=time(10, 0))
+        with mock.patch('authentication.outbox._append', side_effect=RuntimeError('outbox down')):
+            with self.assertRaises(RuntimeError):
+                transition(self.doctor.user, appointment.id, 'confirmed')
+        self.assertEqual(Appointment.objects.using('shard1').get().status, 'pending')
+
+    def test_created_appointment_is_written_with_its_event(self):
+        Patient.objects.create(user=self.first, name='First', mail_id='first@example.com')
+        response = client_for(self.first).post('/api/auth/appointments/request',
+                                               {'doctorId': self.doctor.id}, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        appointment = Appointment.objects.using('shard1').get()
+        self.assertTrue(OutboxEvent.objects.using('shard1').filter(aggregate_id=appointment.id).exists())
+
+    def test_rescored_rollups_reach_default_once(self):
+        make_prediction(self.first, disease='Eczema')
+        rebuild_rollups()
+        checkpoint = rescoring.checkpoint_for('v2', 'predictions', 'shard1')
+        rows = next(rescoring._chunks(Prediction, 'shard1', 'v2', 0, 10))
+        with mock.patch.object(rescoring, '_apply_rollups', side_effect=RuntimeError('crashed')):
+            with self.assertRaises(RuntimeError):
+                rescoring._write(Prediction, 'shard1', 'v2', checkpoint, rows, [('Acne', 90.0)])
+        self.assertNotEqual(stored_rollups(), dict(compute_rollups()))
+
+        for _ in range(2):  # resuming applies the chunk's rollups, resuming again does not
+            rescoring.checkpoint_for('v2', 'predictions', 'shard1')
+            self.assertEqual(stored_rollups(), dict(compute_rollups()))
+
+    def test_profiles_time_and_explain_queries_on_their_shard(self):
+        directory = os.path.join(tempfile.mkdtemp(prefix='epicure-profiles-'), 'profiles')
+        with override_settings(PROFILING_ENABLED=True, PROFILING_DIR=directory, PROFILING_SLOW_QUERY_MS=0):
+            response = client_for(self.first).get('/api/auth/appointments', HTTP_X_PROFILE=profiling.make_token())
+            stored = profiling.read_profile(response['X-Profile-Id'])
+        sharded = [query for query in stored['queries'] if query['alias'] == 'shard1']
+        self.assertTrue(sharded)
+        self.assertAlmostEqual(stored['sqlMs'], sum(query['ms'] for query in stored['queries']), places=2)
+        for query in sharded:
+            if query['sql'].lstrip().upper().startswith('SELECT') and not query['many']:
+                self.assertFalse(query['plan'][0].startswith('EXPLAIN failed'), query)
+
+    def test_thread_between_patients_spans_their_shards(self):
+        Message.objects.create(sender=self.first, receiver=self.second, content='one')
+        Message.objects.create(sender=self.second, receiver=self.first, content='two')
+        self.assertEqual(fan_out(lambda alias: Message.objects.using(alias).count()), [0, 1, 1])
+
+        messages, _ = read_thread(self.first, self.second)
+        self.assertEqual([message.content for message in messages], ['two', 'one'])
+        self.assertEqual(mark_read(self.first, self.second), 1)
+        self.assertTrue(Message.objects.using('shard2').get().is_read)
+
+    def test_staff_lists_read_every_shard(self):
+        make_prediction(self.first)
+        make_prediction(self.second)
+        staff = client_for(make_user('staff@example.com', is_staff=True))
+        predictions = staff.get('/api/auth/predictions').json()['predictions']
+        self.assertEqual(len(predictions), 2)
+        self.assertEqual(predictions, sorted(predictions, key=lambda row: int(row['_id']), reverse=True))
+
+    def test_export_reads_every_shard(self):
+        ids = [make_prediction(self.second).id, make_prediction(self.first).id]
+        self.assertEqual([row[0] for chunk in iter_rows('predictions') for row in chunk], sorted(ids))
+
+    def test_archiving_refuses_to_run(self):
+        with self.assertRaises(ImproperlyConfigured):
+            archive_batch('predictions', timezone.now(), 10)
+
+
+class SimilarityIndexTests(TestCase):
+    def setUp(self):
+        self.patient = make_user('patient@example.com')
+        self.predictions = [make_prediction(self.patient) for _ in range(3)]
+        similarity.store_embeddings(self.predictions, [[1.0, 0.0], [0.0, 1.0], [1.0, 1.0]])
+        self.index = similarity.load_new_embeddings(None)
+
+    def test_deleted_predictions_leave_the_index(self):
+        gone = self.predictions[0].id
+        self.predictions[0].delete()
+        similarity.load_new_embeddings(self.index)
+        self.assertIsNone(self.index.vector(gone))
+        self.assertEqual(len(self.index), 2)
+
+    def test_archived_predictions_stay_in_the_index(self):
+        archive_batch('predictions', timezone.now() + timedelta(days=1), 100)
+        similarity.load_new_embeddings(self.index)
+        self.assertEqual(len(self.index), 3)
+
+    def test_due_refresh_runs_in_the_background(self):
+        with mock.patch.multiple(similarity, _index=self.index, _refreshed=1.0, _refreshing=False), \
+                mock.patch.object(similarity.threading, 'Thread') as thread:
+            self.assertIs(similarity.get_index(), self.index)
+            self.assertIs(similarity.get_index(), self.index)
+        thread.assert_called_once()
+
+
+class SingleFlightTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_keys_share_a_fixed_set_of_locks(self):
+        for number in range(200):
+            singleflight.cached(f'tests:{number}', lambda: number, ttl=60)
+        self.assertEqual(len(singleflight._stripes), settings.SINGLEFLIGHT_STRIPES)
+
+    def test_misses_are_kept_briefly(self):
+        self.assertIsNone(singleflight.cached('tests:missing', lambda: None, ttl=300))
+        _, _, fresh_until, stale_until = cache.get('tests:missing')
+        self.assertLessEqual(stale_until - timezone.now().timestamp(), settings.SINGLEFLIGHT_MISS_SECONDS)
+        self.assertAlmostEqual(fresh_until, stale_until, places=3)
+
+    def test_one_background_refresh_per_key(self):
+        with mock.patch.object(singleflight.threading, 'Thread') as thread:
+            singleflight._refresh_in_background('tests:key', lambda: 1, 60, 30)
+            singleflight._refresh_in_background('tests:key', lambda: 1, 60, 30)
+        thread.assert_called_once()
+        singleflight._refreshing.discard('tests:key')
+
+    def test_per_process_cache_skips_the_lock_file(self):
+        with mock.patch.object(singleflight, 'open') as opened:
+            singleflight.cached('tests:local', lambda: 1, ttl=60)
+        opened.assert_not_called()
+
+    def test_editing_a_doctor_drops_its_cache_entries(self):
+        doctor = Doctor.objects.create(user=make_user('doctor@example.com', 'doctor'), fam_dr_name='Dr. A',
+                                       fam_dr_edu='MD', fam_dr_hospital='General', fam_dr_hospital_location='Town')
+        client = Client()
+        self.assertEqual(client.get(f'/api/auth/doctors/{doctor.id}').json()['name'], 'Dr. A')
+        self.assertEqual(client.get(f'/api/auth/doctors/{doctor.id + 1}').status_code, 404)
+        doctor.fam_dr_name = 'Dr. B'
+        doctor.save()
+        self.assertEqual(client.get(f'/api/auth/doctors/{doctor.id}').json()['name'], 'Dr. B')
+        self.assertEqual(client.get('/api/auth/doctors').json()['doctors'][0]['name'], 'Dr. B')
+
+
+class IdempotencyTests(TestCase):
+    def setUp(self):
+        self.patient = make_user('patient@example.com')
+        self.doctor = Doctor.objects.create(user=make_user('doctor@example.com', 'doctor'), fam_dr_name='Dr. A',
+                                            fam_dr_edu='MD', fam_dr_hospital='General',
+                                            fam_dr_hospital_location='Town')
+
+    def send(self, client, key='key-1'):
+        return client.post('/api/auth/messages/send', {'doctorId': self.doctor.id, 'content': 'Hello'},
+                           content_type='application/json', HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_retry_replays_the_first_response(self):
+        client = client_for(self.patient)
+        self.assertEqual(self.send(client).status_code, 200)
+        replay = self.send(client)
+        self.assertEqual(replay.status_code, 200)
+        self.assertEqual(replay['Idempotent-Replayed'], 'true')
+        self.assertEqual(Message.objects.count(), 1)
+
+    def test_anonymous_callers_cannot_use_keys(self):
+        self.assertEqual(self.send(Client()).status_code, 401)
+        self.assertFalse(IdempotencyRecord.objects.exists())
+
+    @override_settings(IDEMPOTENCY_WAIT_SECONDS=0)
+    def test_live_attempt_blocks_retries(self):
+        client = client_for(self.patient)
+        self.send(client)
+        IdempotencyRecord.objects.update(status_code=None, claimed_at=timezone.now())
+        self.assertEqual(self.send(client).status_code, 409)
+
+    def test_abandoned_attempt_is_taken_over(self):
+        client = client_for(self.patient)
+        self.send(client)
+        abandoned = timezone.now() - timedelta(seconds=settings.IDEMPOTENCY_LEASE_SECONDS + 1)
+        IdempotencyRecord.objects.update(status_code=None, claimed_at=abandoned)
+        retry = self.send(client)
+        self.assertEqual(retry.status_code, 200)
+        self.assertFalse(retry.has_header('Idempotent-Replayed'))
+        self.assertEqual(IdempotencyRecord.objects.get().status_code, 200)
+        self.assertEqual(Message.objects.count(), 2)
+
+
+class NotificationTests(TestCase):
+    def setUp(self):
+        self.patient = make_user('patient@example.com')
+        self.doctor = Doctor.objects.create(user=make_user('doctor@example.com', 'doctor'), fam_dr_name='Dr. A',
+                                            fam_dr_edu='MD', fam_dr_hospital='General',
+                                            fam_dr_hospital_location='Town')
+
+    def test_events_roll_back_with_the_write(self):
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                notifications.enqueue(self.patient.id, 'message_received', sender='x@example.com')
+                self.assertEqual(NotificationEvent.objects.count(), 1)
+                raise ValueError
+        self.assertFalse(NotificationEvent.objects.exists())
+
+    def test_confirmations_notify_the_patient(self):
+        ids = [
+            Appointment.objects.create(patient=self.patient, doctor=self.doctor, date=date(2026, 1, day),
+                                       time=time(9)).id
+            for day in (1, 2, 3)
+        ]
+        doctor = client_for(self.doctor.user)
+        doctor.post(f'/api/auth/appointments/{ids[0]}/confirm')
+        doctor.post('/api/auth/appointments/bulk-status', {'ids': ids, 'status': 'confirmed'},
+                    content_type='application/json')
+        events = NotificationEvent.objects.filter(kind='appointment_confirmed')
+        self.assertEqual(sorted(event.payload['appointment'] for event in events), ids)
+        self.assertEqual({event.recipient_id for event in events}, {self.patient.id})
+
+
+class ReminderTests(TestCase):
+    def setUp(self):
+        self.patient = make_user('patient@example.com')
+        self.doctor = Doctor.objects.create(user=make_user('doctor@example.com', 'doctor'), fam_dr_name='Dr. A',
+                                            fam_dr_edu='MD', fam_dr_hospital='General',
+                                            fam_dr_hospital_location='Town')
+        self.now = timezone.now().replace(microsecond=0)
+        when = timezone.localtime(self.now + timedelta(minutes=40))  # reminder already due
+        self.appointment = Appointment.objects.create(patient=self.patient, doctor=self.doctor,
+                                                      date=when.date(), time=when.time())
+
+    def test_reminder_is_sent_once(self):
+        self.assertEqual(ReminderScheduler(now=self.now).run_once(self.now), 1)
+        self.assertEqual(ReminderScheduler(now=self.now).run_once(self.now), 0)
+        self.assertEqual(NotificationEvent.objects.get().payload['appointment'], self.appointment.id)
+
+    def test_failed_event_insert_leaves_the_reminder_due(self):
+        with mock.patch('authentication.reminders.NotificationEvent') as events:
+            events.objects.using.return_value.bulk_create.side_effect = RuntimeError('down')
+            with self.assertRaises(RuntimeError):
+                ReminderScheduler(now=self.now).run_once(self.now)
+        self.appointment.refresh_from_db()
+        self.assertIsNone(self.appointment.reminded_at)
+
+
+class ThreadTests(TestCase):
+    def setUp(self):
+        self.patient = make_user('patient@example.com')
+        self.doctor = make_user('doctor@example.com', 'doctor')
+        for number in range(3):
+            Message.objects.create(sender=self.doctor, receiver=self.patient, content=f'm{number}')
+        Message.objects.create(sender=self.patient, receiver=self.doctor, content='reply')
+
+    def test_opening_marks_unread_messages_read(self):
+        start = OutboxEvent.objects.order_by('-id').values_list('id', flat=True).first()
+        body = client_for(self.patient).get(f'/api/auth/messages/thread/{self.doctor.id}').json()
+        self.assertEqual(body['markedRead'], 3)
+        self.assertFalse(Message.objects.filter(receiver=self.patient, is_read=False).exists())
+        events = outbox.read(start)
+        self.assertEqual(sorted(event.aggregate_id for event in events),
+                         sorted(Message.objects.filter(receiver=self.patient).values_list('id', flat=True)))
+        self.assertEqual({event.payload['is_read'] for event in events}, {True})
+
+    def test_marking_read_without_returning(self):
+        with mock.patch.object(type(connection.features), 'can_return_columns_from_insert', False), \
+                mock.patch('authentication.threads.MARK_READ_BATCH_SIZE', 2):
+            self.assertEqual(mark_read(self.patient, self.doctor), 3)
+        self.assertFalse(Message.objects.filter(receiver=self.patient, is_read=False).exists())
+
+    def test_malformed_cursor_is_rejected(self):
+        response = client_for(self.patient).get(f'/api/auth/messages/thread/{self.doctor.id}?cursor=junk')
+        self.assertEqual(response.status_code, 400)
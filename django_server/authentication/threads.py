@@ -0,0 +1,142 @@
+"""Conversation threads between two users, newest message first.
+
+A thread is two directions of messages (A to B and B to A). Each direction
+is read straight off ``message_thread_idx`` (sender, receiver, timestamp),
+and the two are merged, so opening a thread costs the same however many
+other messages are stored. With shards, each direction is read from the
+shard its messages are stored on, which for two patients (or two doctors)
+is not the same one. Pages continue with a keyset cursor on
+``(timestamp, id)``; once the hot rows run out or reach the archive
+horizon, the archived thread is merged in the same way.
+
+Opening a thread marks the reader's unread messages in it as read with one
+UPDATE per table instead of one save per message. The ids it changed come
+back from ``UPDATE ... RETURNING`` for the change feed.
+"""
+from datetime import datetime, timedelta, timezone as dt_timezone
+from itertools import islice
+
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.models import Q
+
+from .archive import archive_watermark, default_cutoff
+from .models import ArchivedMessage, Message
+from .outbox import record
+from .sharding import merge_sorted, shard_for_user
+from .writer import run_write, write_transaction
+
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+# Ids per query when the database cannot return the updated rows
+MARK_READ_BATCH_SIZE = 500
+
+
+def encode_cursor(message):
+    micros = (message.timestamp - EPOCH) // timedelta(microseconds=1)
+    return f'{micros}-{message.id}'
+
+
+def decode_cursor(cursor):
+    """``(timestamp, id)`` from ``encode_cursor``; None when missing or malformed."""
+    try:
+        micros, pk = (int(part) for part in cursor.split('-'))
+    except (AttributeError, ValueError):
+        return None
+    return EPOCH + timedelta(microseconds=micros), pk
+
+
+def direction_alias(sender, receiver):
+    """Database holding the messages ``sender`` sent ``receiver``: the patient side's shard.
+
+    Mirrors ``sharding.owner_id``: a doctor's message is stored with its
+    receiver, anyone else's with its sender.
+    """
+    return shard_for_user(receiver.id if sender.role == 'doctor' else sender.id)
+
+
+def _directions(user, other):
+    if user.id == other.id:
+        return [(user, user)]  # notes to self: both directions are the same rows
+    return [(user, other), (other, user)]
+
+
+def _newest(directions, before, limit):
+    """The newest ``limit`` rows over ``[(queryset, sender, receiver), ...]``."""
+    pages = []
+    for queryset, sender, receiver in directions:
+        rows = queryset.filter(sender_id=sender.id, receiver_id=receiver.id)
+        if before is not None:
+            timestamp, pk = before
+            rows = rows.filter(Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=pk),
+                               timestamp__lte=timestamp)
+        pages.append(list(rows.order_by('-timestamp', '-id')[:limit]))
+    return list(islice(merge_sorted(pages, key=lambda row: (row.timestamp, row.id), reverse=True), limit))
+
+
+def read_thread(user, other, cursor=None, limit=100):
+    """Return ``(messages, next_cursor)`` for the conversation of ``user`` and ``other``."""
+    before = decode_cursor(cursor)
+    directions = _directions(user, other)
+    hot = [
+        (Message.objects.using(direction_alias(sender, receiver)).select_related('sender', 'receiver'),
+         sender, receiver)
+        for sender, receiver in directions
+    ]
+    rows = _newest(hot, before, limit)
+
+    if (len(rows) < limit or rows[-1].timestamp < default_cutoff()) and archive_watermark('messages'):
+        archived = ArchivedMessage.objects.select_related('sender', 'receiver')
+        cold = _newest([(archived, sender, receiver) for sender, receiver in directions], before, limit)
+        if cold:
+            rows = list(islice(merge_sorted([rows, cold], key=lambda row: (row.timestamp, row.id), reverse=True),
+                               limit))
+
+    next_cursor = encode_cursor(rows[-1]) if len(rows) == limit else None
+    return rows, next_cursor
+
+
+def _mark_returning(alias, sender, reader):
+    """One ``UPDATE ... RETURNING id``; the ids of the messages it marked read."""
+    db = connections[alias]
+    quote = db.ops.quote_name
+    column = {name: quote(Message._meta.get_field(name).column) for name in ('sender', 'receiver', 'is_read')}
+    with db.cursor() as cursor:
+        cursor.execute(
+            f"UPDATE {quote(Message._meta.db_table)} SET {column['is_read']} = %s "
+            f"WHERE {column['sender']} = %s AND {column['receiver']} = %s AND {column['is_read']} = %s "
+            f"RETURNING {quote(Message._meta.pk.column)}",
+            [True, sender.id, reader.id, False],
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+def _mark_in_batches(alias, sender, reader):
+    unread = Message.objects.using(alias).filter(sender=sender, receiver=reader, is_read=False)
+    marked = []
+    while True:
+        ids = list(unread.values_list('id', flat=True)[:MARK_READ_BATCH_SIZE])
+        if not ids:
+            return marked
+        Message.objects.using(alias).filter(id__in=ids).update(is_read=True)
+        marked += ids
+
+
+def mark_read(reader, sender):
+    """Mark every unread message from ``sender`` to ``reader`` read; returns how many were."""
+    alias = direction_alias(sender, reader)
+    # PostgreSQL and SQLite 3.35+, the same versions that support INSERT ... RETURNING
+    returning = connections[alias].features.can_return_columns_from_insert
+
+    def update():
+        with write_transaction(using=alias):
+            ids = (_mark_returning if returning else _mark_in_batches)(alias, sender, reader)
+            # QuerySet.update() sends no signals, so the change feed is told here
+            record(Message, ids, using=alias, is_read=True)
+        if not archive_watermark('messages'):
+            return len(ids)
+        with write_transaction(using=DEFAULT_DB_ALIAS):
+            return len(ids) + ArchivedMessage.objects.using(DEFAULT_DB_ALIAS).filter(
+                sender=sender, receiver=reader, is_read=False
+            ).update(is_read=True)
+
+    return run_write(update, using=alias)
@@ -0,0 +1,146 @@
+"""Sliding-window rate limits shared by every worker process on the host.
+
+Counters live in a small SQLite file (RATELIMIT_DB_PATH, by default next to
+the project's database), separate from the application database so
+throttling never contends with its writer lock. Each
+request costs one UPSERT on a primary key (O(1)). The row keeps the counts of
+the current and the previous fixed window, and the sliding estimate weights
+the previous one by how much of it still overlaps:
+
+    estimate = previous * (1 - elapsed / duration) + current
+
+Rates are configured per view in REST_FRAMEWORK['DEFAULT_THROTTLE_RATES'],
+under ``<view name>.ip`` and ``<view name>.user``. Views without a rate are
+not throttled. Rejected attempts still count, so a client that keeps
+hammering stays limited until it backs off.
+"""
+import os
+import random
+import sqlite3
+import threading
+import time
+
+from django.conf import settings
+from rest_framework.settings import api_settings
+from rest_framework.throttling import BaseThrottle
+
+DURATIONS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+HIT_SQL = """
+INSERT INTO ratelimit (key, window, current, previous) VALUES (?, ?, 1, 0)
+ON CONFLICT (key) DO UPDATE SET
+    previous = CASE
+        WHEN excluded.window = window THEN previous
+        WHEN excluded.window = window + 1 THEN current
+        ELSE 0 END,
+    current = CASE WHEN excluded.window = window THEN current + 1 ELSE 1 END,
+    window = excluded.window
+RETURNING current, previous
+"""
+
+
+def parse_rate(rate):
+    """'10/min' -> (10, 60)"""
+    num, period = rate.split('/')
+    return int(num), DURATIONS[period[0]]
+
+
+class SlidingWindowStore:
+    """Per-thread connections to the shared counter file."""
+
+    def __init__(self, path=None):
+        self.path = path or getattr(settings, 'RATELIMIT_DB_PATH', None) or os.path.join(
+            settings.BASE_DIR, 'ratelimit.sqlite3'
+        )
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            # Counters are disposable; losing the last writes on power loss is fine
+            conn.execute('PRAGMA synchronous=OFF')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS ratelimit ('
+                'key TEXT PRIMARY KEY, window INTEGER NOT NULL, '
+                'current INTEGER NOT NULL, previous INTEGER NOT NULL) WITHOUT ROWID'
+            )
+            self._local.conn = conn
+        return conn
+
+    def hit(self, key, limit, duration, now=None):
+        """Count one request for ``key``; return ``(allowed, retry_after_seconds)``."""
+        now = time.time() if now is None else now
+        window, offset = divmod(now, duration)
+        conn = self._connection()
+        current, previous = conn.execute(HIT_SQL, (key, int(window))).fetchone()
+        estimate = previous * (1 - offset / duration) + current
+        if random.random() < 0.001:
+            # Rows idle for two windows carry no state; drop them occasionally
+            conn.execute('DELETE FROM ratelimit WHERE window < ?', (int(window) - 1,))
+        if estimate <= limit:
+            return True, None
+        return False, duration - offset
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = SlidingWindowStore()
+    return _store
+
+
+class SlidingWindowThrottle(BaseThrottle):
+    """Base class: subclasses pick the identity a request is counted under."""
+
+    suffix = None
+
+    def get_identity(self, request):
+        raise NotImplementedError
+
+    def allow_request(self, request, view):
+        # @api_view builds a view class named after the decorated function
+        view_name = type(view).__name__
+        rate = api_settings.DEFAULT_THROTTLE_RATES.get(f'{view_name}.{self.suffix}')
+        if rate is None:
+            return True
+        identity = self.get_identity(request)
+        if identity is None:
+            return True
+
+        limit, duration = parse_rate(rate)
+        allowed, self.retry_after = get_store().hit(
+            f'{view_name}:{self.suffix}:{identity}', limit, duration
+        )
+        return allowed
+
+    def wait(self):
+        return getattr(self, 'retry_after', None)
+
+
+class IPRateThrottle(SlidingWindowThrottle):
+    """Limits per client address (X-Forwarded-For aware via NUM_PROXIES)."""
+
+    suffix = 'ip'
+
+    def get_identity(self, request):
+        return self.get_ident(request)
+
+
+class UserRateThrottle(SlidingWindowThrottle):
+    """Limits per authenticated user; anonymous requests are left to the IP limit."""
+
+    suffix = 'user'
+
+    def get_identity(self, request):
+        user = getattr(request, 'user', None)
+        if not user or user.is_anonymous:
+            return None
+        return user.pk
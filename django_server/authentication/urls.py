@@ -2,6 +2,8 @@ from django.urls import path
 from . import views
 
 urlpatterns = [
+    path('batch/', views.batch),
+    path('batch', views.batch),
     path('config/', views.config),
     path('config', views.config),
     path('register/', views.register),
@@ -16,6 +18,8 @@ urlpatterns = [
     path('doctors/<int:doctor_id>', views.get_doctor_by_id),
     path('predictions/', views.get_predictions),
     path('predictions', views.get_predictions),
+    path('predictions/<int:prediction_id>/similar/', views.similar_predictions),
+    path('predictions/<int:prediction_id>/similar', views.similar_predictions),
     path('appointments/', views.get_appointments),
     path('appointments', views.get_appointments),
     path('messages/', views.get_messages),
@@ -24,6 +28,8 @@ urlpatterns = [
     path('reports', views.get_reports),
     path('reports/generate/', views.generate_report),
     path('reports/generate', views.generate_report),
+    path('appointments/bulk-status/', views.bulk_update_appointment_status),
+    path('appointments/bulk-status', views.bulk_update_appointment_status),
     path('appointments/request/', views.create_appointment),
     path('appointments/request', views.create_appointment),
     path('appointments/<int:appointment_id>/cancel/', views.cancel_appointment),
@@ -32,10 +38,30 @@ urlpatterns = [
     path('appointments/<int:appointment_id>/confirm', views.confirm_appointment),
     path('appointments/<int:appointment_id>/status/', views.update_appointment_status),
     path('appointments/<int:appointment_id>/status', views.update_appointment_status),
+    path('dashboard/', views.patient_dashboard),
+    path('dashboard', views.patient_dashboard),
+    path('dashboard/stats/', views.dashboard_stats),
+    path('dashboard/stats', views.dashboard_stats),
+    path('analytics/diseases/', views.disease_analytics),
+    path('analytics/diseases', views.disease_analytics),
+    path('export/<str:kind>/', views.export_data),
+    path('export/<str:kind>', views.export_data),
+    path('admission/stats/', views.admission_stats),
+    path('admission/stats', views.admission_stats),
+    path('outbox/events/', views.outbox_events),
+    path('outbox/events', views.outbox_events),
+    path('outbox/offsets/', views.commit_outbox_offset),
+    path('outbox/offsets', views.commit_outbox_offset),
+    path('profiles/', views.list_profiles),
+    path('profiles', views.list_profiles),
+    path('profiles/<str:profile_id>/', views.get_profile),
+    path('profiles/<str:profile_id>', views.get_profile),
     path('conversations/', views.get_conversations),
     path('patient/profile/', views.upsert_patient_profile),
     path('patient/profile', views.upsert_patient_profile),
     path('conversations', views.get_conversations),
+    path('messages/thread/<int:user_id>/', views.get_thread),
+    path('messages/thread/<int:user_id>', views.get_thread),
     path('messages/send/', views.send_message),
     path('messages/send', views.send_message),
 ]
\ No newline at end of file
@@ -1,9 +1,40 @@
+import traceback
+import uuid
+from datetime import datetime, date, time
+
+from rest_framework import status
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import AllowAny
 from rest_framework.response import Response
-from django.contrib.auth import get_user_model
+from django.contrib.auth import authenticate, get_user_model
+from django.http import StreamingHttpResponse
+from django.db import router
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils.dateparse import parse_date
 import jwt
 from django.conf import settings
+from . import notifications, outbox
+from .analytics import GROUP_FIELDS, disease_trends
+from .appointment_status import (
+    bulk_transition, role_for, transition, APPLIED, CANCEL_TRANSITIONS, UNCHANGED, NOT_FOUND, FORBIDDEN,
+)
+from .archive import parse_page_params, read_all, read_page, wants_page
+from .batch import run_batch
+from .dashboard import patient_dashboard as build_dashboard
+from .export import EXPORT_FORMATS, EXPORT_KINDS, stream_export
+from .idempotency import idempotent
+from .middleware import admission_classes
+from .models import (
+    Appointment, ArchivedMessage, ArchivedPrediction, Doctor, Message, Patient, Prediction, Report,
+)
+from .profiling import list_profiles as stored_profiles, read_profile
+from .rollups import dashboard_stats as rollup_stats, record_appointment_created, record_prediction_created
+from .sharding import fan_out, merge_sorted
+from .similarity import similar_cases
+from .singleflight import cached, invalidate
+from .threads import decode_cursor, mark_read, read_thread
+from .writer import run_write
 
 User = get_user_model()
 
@@ -13,9 +44,96 @@ def config(request):
 
 @api_view(['GET'])
 @permission_classes([AllowAny])
-def get_doctors(request):
-    from .models import Doctor
-    
+def admission_stats(request):
+    """Staff-only queue depth and shed counts of this worker's admission classes."""
+    if not getattr(request, 'user', None) or not request.user.is_staff:
+        return Response({'message': 'Not authorized to view admission stats'}, status=status.HTTP_403_FORBIDDEN)
+
+    return Response({'classes': {name: admission.stats() for name, admission in admission_classes.items()}})
+
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def outbox_events(request):
+    """Staff-only change feed: outbox events after ``after`` or the consumer's committed offset."""
+    if not getattr(request, 'user', None) or not request.user.is_staff:
+        return Response({'message': 'Not authorized to read the change feed'}, status=status.HTTP_403_FORBIDDEN)
+
+    database = request.query_params.get('database', 'default')
+    if database not in settings.DATABASES:
+        return Response({'message': f'Unknown database {database}'}, status=status.HTTP_400_BAD_REQUEST)
+    consumer = request.query_params.get('consumer')
+    try:
+        after = int(request.query_params['after']) if 'after' in request.query_params else None
+        limit = min(int(request.query_params.get('limit', getattr(settings, 'OUTBOX_BATCH_SIZE', 500))),
+                    getattr(settings, 'API_MAX_PAGE_SIZE', 500))
+    except ValueError:
+        return Response({'message': 'after and limit must be integers'}, status=status.HTTP_400_BAD_REQUEST)
+    if after is None:
+        after = outbox.position(consumer, database) if consumer else 0
+
+    events = outbox.read(after, max(limit, 1), database)
+    return Response({
+        'events': [outbox.event_dict(event) for event in events],
+        'nextAfter': events[-1].id if events else after,
+    })
+
+@api_view(['POST'])
+@permission_classes([AllowAny])
+def commit_outbox_offset(request):
+    """Staff-only: record that a consumer has processed the feed up to ``position``."""
+    if not getattr(request, 'user', None) or not request.user.is_staff:
+        return Response({'message': 'Not authorized to commit offsets'}, status=status.HTTP_403_FORBIDDEN)
+
+    consumer = request.data.get('consumer')
+    database = request.data.get('database', 'default')
+    try:
+        position = int(request.data.get('position'))
+    except (TypeError, ValueError):
+        position = None
+    if not consumer or position is None or database not in settings.DATABASES:
+        return Response({'message': 'consumer, position and a known database are required'},
+                        status=status.HTTP_400_BAD_REQUEST)
+
+    outbox.commit(consumer, position, database)
+    return Response({'consumer': consumer, 'database': database, 'position': outbox.position(consumer, database)})
+
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def list_profiles(request):
+    """Staff-only index of captured request profiles, newest first."""
+    if not getattr(request, 'user', None) or not request.user.is_staff:
+        return Response({'message': 'Not authorized to view profiles'}, status=status.HTTP_403_FORBIDDEN)
+    return Response({'profiles': stored_profiles()})
+
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def get_profile(request, profile_id):
+    if not getattr(request, 'user', None) or not request.user.is_staff:
+        return Response({'message': 'Not authorized to view profiles'}, status=status.HTTP_403_FORBIDDEN)
+
+    profile = read_profile(profile_id)
+    if profile is None:
+        return Response({'message': 'Profile not found'}, status=status.HTTP_404_NOT_FOUND)
+    return Response(profile)
+
+@api_view(['POST'])
+@permission_classes([AllowAny])
+def batch(request):
+    """Run several API calls in one round trip.
+
+    Expects: { requests: [{ method, path, body? }, ...] } and returns
+    { responses: [{ status, body }, ...] } in the same order.
+    """
+    items = request.data.get('requests')
+    max_items = getattr(settings, 'BATCH_MAX_REQUESTS', 20)
+    if not isinstance(items, list) or not items:
+        return Response({'message': 'requests must be a non-empty list'}, status=status.HTTP_400_BAD_REQUEST)
+    if len(items) > max_items:
+        return Response({'message': f'A batch may contain at most {max_items} requests'}, status=status.HTTP_400_BAD_REQUEST)
+
+    return Response({'responses': run_batch(request, items)})
+
+def _doctor_roster():
     doctors = Doctor.objects.all()
     doctors_data = []
     
@@ -35,69 +153,93 @@ def get_doctors(request):
             'education': doctor.fam_dr_edu
         })
     
-    return Response({'doctors': doctors_data})
+    return doctors_data
 
 @api_view(['GET'])
 @permission_classes([AllowAny])
-def get_predictions(request):
-    from .models import Prediction
-    
-    # Get all predictions for demo purposes
-    predictions = Prediction.objects.all().order_by('-timestamp')
-    predictions_data = []
-    
-    for pred in predictions:
-        predictions_data.append({
-            '_id': str(pred.id),
-            'disease': pred.disease,
-            'confidence': pred.confidence,
-            'timestamp': pred.timestamp.isoformat(),
-            'imageUrl': pred.image_url
-        })
-    
-    return Response({'predictions': predictions_data})
+def get_doctors(request):
+    # Concurrent misses share one roster query instead of stampeding the DB
+    doctors_data = cached('doctors:roster', _doctor_roster, ttl=settings.DOCTOR_CACHE_SECONDS)
+    return Response({'doctors': doctors_data})
 
 @api_view(['GET'])
 @permission_classes([AllowAny])
-def get_doctor_by_id(request, doctor_id):
-    from .models import Doctor
-    
+def get_predictions(request):
+    # Get all predictions for demo purposes, newest first. With cursor/limit,
+    # one page by id; older pages fall through to the archive once the cursor
+    # reaches archived ids.
+    hot, archived = Prediction.objects.all(), ArchivedPrediction.objects.all()
+    if not wants_page(request):
+        return Response({'predictions': [_prediction_data(pred) for pred in read_all('predictions', hot, archived)]})
+
+    cursor, limit = parse_page_params(request)
+    predictions, next_cursor = read_page('predictions', hot, archived, cursor=cursor, limit=limit)
+    predictions_data = [_prediction_data(pred) for pred in predictions]
+    
+    return Response({'predictions': predictions_data, 'nextCursor': next_cursor})
+
+def _prediction_data(pred):
+    return {
+        '_id': str(pred.id),
+        'disease': pred.disease,
+        'confidence': pred.confidence,
+        'timestamp': pred.timestamp.isoformat(),
+        'imageUrl': pred.image_url
+    }
+
+def _doctor_detail(doctor_id):
     try:
         doctor = Doctor.objects.get(id=doctor_id)
-        doctor_data = {
-            '_id': str(doctor.id),
-            'name': doctor.fam_dr_name,
-            'specialization': 'Dermatology',
-            'bio': f'Practicing at {doctor.fam_dr_hospital}, {doctor.fam_dr_hospital_location}',
-            'qualifications': [doctor.fam_dr_edu],
-            'responseTime': '24 hours',
-            'isAvailable': True,
-            'avatar': '',
-            'rating': 4.5,
-            'reviewCount': 150,
-            'experience': 10,
-            'hospital': doctor.fam_dr_hospital,
-            'location': doctor.fam_dr_hospital_location,
-            'education': doctor.fam_dr_edu
-        }
-        return Response(doctor_data)
     except Doctor.DoesNotExist:
+        return None
+    return {
+        '_id': str(doctor.id),
+        'name': doctor.fam_dr_name,
+        'specialization': 'Dermatology',
+        'bio': f'Practicing at {doctor.fam_dr_hospital}, {doctor.fam_dr_hospital_location}',
+        'qualifications': [doctor.fam_dr_edu],
+        'responseTime': '24 hours',
+        'isAvailable': True,
+        'avatar': '',
+        'rating': 4.5,
+        'reviewCount': 150,
+        'experience': 10,
+        'hospital': doctor.fam_dr_hospital,
+        'location': doctor.fam_dr_hospital_location,
+        'education': doctor.fam_dr_edu
+    }
+
+@receiver([post_save, post_delete], sender=Doctor)
+def _invalidate_doctor(sender, instance, **kwargs):
+    invalidate('doctors:roster', f'doctors:{instance.pk}')
+
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def get_doctor_by_id(request, doctor_id):
+    doctor_data = cached(
+        f'doctors:{doctor_id}',
+        lambda: _doctor_detail(doctor_id),
+        ttl=settings.DOCTOR_CACHE_SECONDS,
+    )
+    if doctor_data is None:
         return Response({'error': 'Doctor not found'}, status=404)
+    return Response(doctor_data)
 
 @api_view(['GET'])
 @permission_classes([AllowAny])
 def get_appointments(request):
-    from .models import Appointment, Doctor
-    from rest_framework import status
-    
     if not getattr(request, 'user', None) or request.user.is_anonymous:
         return Response({'message': 'Authentication required'}, status=status.HTTP_401_UNAUTHORIZED)
     
     # If user is a doctor, show ALL appointments across all doctors (managed by admins)
     # If user is a patient, show appointments where the patient is the requester
     if request.user.role == 'doctor':
-        # Doctors see all appointments
-        appointments = Appointment.objects.all().order_by('-created_at')
+        # Doctors see all appointments, merged across every shard
+        appointments = merge_sorted(
+            fan_out(lambda alias: list(Appointment.objects.using(alias).order_by('-created_at'))),
+            key=lambda apt: apt.created_at,
+            reverse=True,
+        )
     else:
         # Patient: show their own appointment requests
         appointments = Appointment.objects.filter(patient=request.user).order_by('-created_at')
@@ -109,7 +251,6 @@ def get_appointments(request):
         patient_age = None
         patient_gender = None
         try:
-            from .models import Patient
             patient_profile = Patient.objects.get(user=apt.patient)
             if patient_profile.name:
                 patient_name = patient_profile.name
@@ -140,35 +281,20 @@ def get_appointments(request):
 @api_view(['DELETE'])
 @permission_classes([AllowAny])
 def cancel_appointment(request, appointment_id):
-    from .models import Appointment
-    from rest_framework import status
-
     # Require authentication
     if not getattr(request, 'user', None) or request.user.is_anonymous:
         return Response({'message': 'Authentication required'}, status=status.HTTP_401_UNAUTHORIZED)
 
-    try:
-        appointment = Appointment.objects.get(id=appointment_id)
-    except Appointment.DoesNotExist:
-        return Response({'message': 'Appointment not found'}, status=status.HTTP_404_NOT_FOUND)
-
-    # Authorization: allow if request.user is the patient, or any doctor user, the assigned doctor user, or staff
-    is_patient = appointment.patient and appointment.patient == request.user
-    # Allow any authenticated user with role 'doctor' to cancel (doctors manage appointments centrally)
-    is_doctor = getattr(request.user, 'role', None) == 'doctor'
-    # Also allow the specifically assigned doctor user
-    is_assigned_doctor = False
-    try:
-        is_assigned_doctor = appointment.doctor and appointment.doctor.user == request.user
-    except Exception:
-        is_assigned_doctor = False
+    # Soft-cancel as a compare-and-set on the status column. Patients may
+    # cancel their own appointments; doctors and staff may cancel any.
+    outcome, current = transition(request.user, appointment_id, 'cancelled', CANCEL_TRANSITIONS)
 
-    if not (is_patient or is_doctor or is_assigned_doctor or request.user.is_staff):
+    if outcome == NOT_FOUND:
+        return Response({'message': 'Appointment not found'}, status=status.HTTP_404_NOT_FOUND)
+    if outcome == FORBIDDEN:
         return Response({'message': 'Not authorized to cancel this appointment'}, status=status.HTTP_403_FORBIDDEN)
-
-    # Soft-cancel: update status to 'cancelled'
-    appointment.status = 'cancelled'
-    appointment.save()
+    if outcome not in (APPLIED, UNCHANGED):
+        return Response({'message': f'Appointment status changed concurrently (now {current})', 'status': current}, status=status.HTTP_409_CONFLICT)
 
     return Response({'success': True, 'message': 'Appointment cancelled successfully'})
 
@@ -177,33 +303,18 @@ def cancel_appointment(request, appointment_id):
 @permission_classes([AllowAny])
 def confirm_appointment(request, appointment_id):
     """Doctors can confirm a pending appointment."""
-    from .models import Appointment, Doctor
-    from rest_framework import status
-
     if not getattr(request, 'user', None) or request.user.is_anonymous:
         return Response({'message': 'Authentication required'}, status=status.HTTP_401_UNAUTHORIZED)
 
-    try:
-        appointment = Appointment.objects.get(id=appointment_id)
-    except Appointment.DoesNotExist:
-        return Response({'message': 'Appointment not found'}, status=status.HTTP_404_NOT_FOUND)
-
-    # Authorization: allow if user is a doctor (any doctor can confirm centralized appointments),
-    # or if user is staff, or assigned doctor
-    is_doctor_role = getattr(request.user, 'role', None) == 'doctor'
-    is_assigned_doctor = False
-    try:
-        assigned_doc = Doctor.objects.get(user=request.user)
-        is_assigned_doctor = appointment.doctor == assigned_doc
-    except Exception:
-        is_assigned_doctor = False
+    # Any doctor (appointments are managed centrally) or staff may confirm
+    outcome, current = transition(request.user, appointment_id, 'confirmed')
 
-    if not (is_doctor_role or is_assigned_doctor or request.user.is_staff):
+    if outcome == NOT_FOUND:
+        return Response({'message': 'Appointment not found'}, status=status.HTTP_404_NOT_FOUND)
+    if outcome == FORBIDDEN:
         return Response({'message': 'Not authorized to confirm this appointment'}, status=status.HTTP_403_FORBIDDEN)
-
-    # Update status to confirmed
-    appointment.status = 'confirmed'
-    appointment.save()
+    if outcome not in (APPLIED, UNCHANGED):
+        return Response({'message': f'Appointment status changed concurrently (now {current})', 'status': current}, status=status.HTTP_409_CONFLICT)
 
     return Response({'success': True, 'message': 'Appointment confirmed', 'status': 'confirmed'})
 
@@ -212,58 +323,173 @@ def confirm_appointment(request, appointment_id):
 @permission_classes([AllowAny])
 def update_appointment_status(request, appointment_id):
     """Update appointment status. Doctors can set to confirmed/completed, patients can cancel."""
-    from .models import Appointment, Doctor
-    from rest_framework import status
-
     if not getattr(request, 'user', None) or request.user.is_anonymous:
         return Response({'message': 'Authentication required'}, status=status.HTTP_401_UNAUTHORIZED)
 
-    try:
-        appointment = Appointment.objects.get(id=appointment_id)
-    except Appointment.DoesNotExist:
-        return Response({'message': 'Appointment not found'}, status=status.HTTP_404_NOT_FOUND)
-
     new_status = request.data.get('status')
     if not new_status or new_status not in ['pending', 'confirmed', 'completed', 'cancelled']:
         return Response({'message': 'Invalid status'}, status=status.HTTP_400_BAD_REQUEST)
 
-    # Authorization checks
-    is_patient = appointment.patient == request.user
-    # Treat any user with role 'doctor' as a doctor manager
-    is_doctor = getattr(request.user, 'role', None) == 'doctor'
-    # Also allow if user is assigned doctor
-    try:
-        doctor = Doctor.objects.get(user=request.user)
-        if appointment.doctor == doctor:
-            is_doctor = True
-    except Doctor.DoesNotExist:
-        pass
-
     # Patients can only cancel; doctors can confirm or mark as completed
-    if is_patient and new_status != 'cancelled':
+    role = role_for(request.user)
+    if role == 'patient' and new_status != 'cancelled':
         return Response({'message': 'Patients can only cancel appointments'}, status=status.HTTP_403_FORBIDDEN)
-    elif is_doctor and new_status == 'cancelled':
+    elif role == 'doctor' and new_status == 'cancelled':
         return Response({'message': 'Doctors cannot cancel; only patients can'}, status=status.HTTP_403_FORBIDDEN)
-    elif not (is_patient or is_doctor or request.user.is_staff):
-        return Response({'message': 'Not authorized to update this appointment'}, status=status.HTTP_403_FORBIDDEN)
 
-    appointment.status = new_status
-    appointment.save()
+    outcome, current = transition(request.user, appointment_id, new_status)
+
+    if outcome == NOT_FOUND:
+        return Response({'message': 'Appointment not found'}, status=status.HTTP_404_NOT_FOUND)
+    if outcome == FORBIDDEN:
+        return Response({'message': 'Not authorized to update this appointment'}, status=status.HTTP_403_FORBIDDEN)
+    if outcome not in (APPLIED, UNCHANGED):
+        return Response({'message': f'Appointment status changed concurrently (now {current})', 'status': current}, status=status.HTTP_409_CONFLICT)
 
     return Response({
         'success': True,
         'message': f'Appointment status updated to {new_status}',
         'status': new_status,
-        '_id': str(appointment.id)
+        '_id': str(appointment_id)
     })
 
 @api_view(['POST'])
 @permission_classes([AllowAny])
-def create_appointment(request):
-    from .models import Appointment, Doctor, Prediction, Patient
-    from datetime import datetime, date, time
-    from rest_framework import status
+def bulk_update_appointment_status(request):
+    """Apply one status to many appointments: { ids: [...], status: string }."""
+    if not getattr(request, 'user', None) or request.user.is_anonymous:
+        return Response({'message': 'Authentication required'}, status=status.HTTP_401_UNAUTHORIZED)
 
+    new_status = request.data.get('status')
+    if not new_status or new_status not in ['pending', 'confirmed', 'completed', 'cancelled']:
+        return Response({'message': 'Invalid status'}, status=status.HTTP_400_BAD_REQUEST)
+
+    ids = request.data.get('ids')
+    max_ids = getattr(settings, 'BULK_STATUS_MAX_IDS', 200)
+    # bool is an int subclass, and int() would take strings apart
+    if not isinstance(ids, list) or not all(type(apt_id) is int for apt_id in ids):
+        return Response({'message': 'ids must be a list of appointment ids'}, status=status.HTTP_400_BAD_REQUEST)
+    ids = list(dict.fromkeys(ids))
+    if not ids or len(ids) > max_ids:
+        return Response({'message': f'Provide between 1 and {max_ids} appointment ids'}, status=status.HTTP_400_BAD_REQUEST)
+
+    if role_for(request.user) == 'doctor' and new_status == 'cancelled':
+        return Response({'message': 'Doctors cannot cancel; only patients can'}, status=status.HTTP_403_FORBIDDEN)
+
+    results = bulk_transition(request.user, ids, new_status)
+    return Response({
+        'success': all(ok for ok, _ in results.values()),
+        'status': new_status,
+        'updated': sum(1 for ok, _ in results.values() if ok),
+        'results': [
+            {'_id': str(apt_id), 'success': ok, 'message': message}
+            for apt_id, (ok, message) in results.items()
+        ],
+    })
+
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def patient_dashboard(request):
+    """Everything the patient app shows on launch, in one response."""
+    if not getattr(request, 'user', None) or request.user.is_anonymous:
+        return Response({'message': 'Authentication required'}, status=status.HTTP_401_UNAUTHORIZED)
+
+    try:
+        limit = max(1, min(int(request.query_params.get('limit', 5)), 50))
+    except ValueError:
+        limit = 5
+
+    return Response(build_dashboard(request.user, limit=limit))
+
+def _date_param(request, name):
+    """Query param ``name`` as a date (YYYY-MM-DD); None when absent, ValueError when invalid."""
+    value = request.query_params.get(name)
+    if not value:
+        return None
+    parsed = parse_date(value)  # None for the wrong format, ValueError for an impossible date
+    if parsed is None:
+        raise ValueError(f'Invalid {name} date: {value}')
+    return parsed
+
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def dashboard_stats(request):
+    """Appointment and prediction counts for a date range, served from rollups.
+
+    Query params: from, to (YYYY-MM-DD, inclusive) and optional doctorId.
+    """
+    if not getattr(request, 'user', None) or request.user.is_anonymous:
+        return Response({'message': 'Authentication required'}, status=status.HTTP_401_UNAUTHORIZED)
+
+    if not (getattr(request.user, 'role', None) == 'doctor' or request.user.is_staff):
+        return Response({'message': 'Not authorized to view dashboard stats'}, status=status.HTTP_403_FORBIDDEN)
+
+    try:
+        start = _date_param(request, 'from')
+        end = _date_param(request, 'to')
+    except ValueError:
+        return Response({'message': 'Invalid date range'}, status=status.HTTP_400_BAD_REQUEST)
+
+    doctor_id = request.query_params.get('doctorId')
+    if doctor_id and not doctor_id.isdigit():
+        return Response({'message': 'Invalid doctorId'}, status=status.HTTP_400_BAD_REQUEST)
+
+    stats = rollup_stats(start=start, end=end, doctor_id=doctor_id)
+    stats['from'] = start.isoformat() if start else None
+    stats['to'] = end.isoformat() if end else None
+    return Response(stats)
+
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def disease_analytics(request):
+    """Per-disease trend lines and confidence distributions.
+
+    Query params: groupBy (disease, body_part or disease,body_part),
+    window (rolling mean days), from and to (YYYY-MM-DD, inclusive).
+    """
+    if not getattr(request, 'user', None) or request.user.is_anonymous:
+        return Response({'message': 'Authentication required'}, status=status.HTTP_401_UNAUTHORIZED)
+
+    if not (getattr(request.user, 'role', None) == 'doctor' or request.user.is_staff):
+        return Response({'message': 'Not authorized to view analytics'}, status=status.HTTP_403_FORBIDDEN)
+
+    group_by = tuple(part for part in request.query_params.get('groupBy', 'disease').split(',') if part)
+    if not group_by or any(field not in GROUP_FIELDS for field in group_by):
+        return Response({'message': 'Invalid groupBy'}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        window = max(1, min(int(request.query_params.get('window', 7)), 365))
+        start = _date_param(request, 'from')
+        end = _date_param(request, 'to')
+    except ValueError:
+        return Response({'message': 'Invalid window or date range'}, status=status.HTTP_400_BAD_REQUEST)
+
+    return Response(disease_trends(group_by=group_by, window=window, start=start, end=end))
+
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def export_data(request, kind):
+    """Stream predictions, appointments or reports as CSV or Parquet (staff only)."""
+    if not getattr(request, 'user', None) or request.user.is_anonymous:
+        return Response({'message': 'Authentication required'}, status=status.HTTP_401_UNAUTHORIZED)
+
+    if not request.user.is_staff:
+        return Response({'message': 'Not authorized to export data'}, status=status.HTTP_403_FORBIDDEN)
+
+    # Not ?format=, which DRF reserves for renderer selection
+    fmt = request.query_params.get('fileFormat', 'csv')
+    if kind not in EXPORT_KINDS or fmt not in EXPORT_FORMATS:
+        return Response({'message': 'Unknown export kind or format'}, status=status.HTTP_400_BAD_REQUEST)
+
+    content_type = 'text/csv' if fmt == 'csv' else 'application/vnd.apache.parquet'
+    response = StreamingHttpResponse(stream_export(kind, fmt), content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="{kind}.{fmt}"'
+    return response
+
+@api_view(['POST'])
+@permission_classes([AllowAny])
+@idempotent('create_appointment')
+def create_appointment(request):
     # Require authenticated user
     if not getattr(request, 'user', None) or request.user.is_anonymous:
         return Response({'message': 'Authentication required to request an appointment'}, status=status.HTTP_401_UNAUTHORIZED)
@@ -296,14 +522,23 @@ def create_appointment(request):
             pass
 
     # Create appointment
-    appointment = Appointment.objects.create(
-        patient=request.user,
-        doctor=doctor,
-        prediction=prediction,
-        date=date.today(),
-        time=time(10, 0),
-        status='pending'
-    )
+    def insert():
+        appointment = Appointment.objects.create(
+            patient=request.user,
+            doctor=doctor,
+            prediction=prediction,
+            date=date.today(),
+            time=time(10, 0),
+            status='pending'
+        )
+        record_appointment_created(appointment)
+        notifications.enqueue(
+            doctor.user_id, 'appointment_requested',
+            appointment=appointment.id, patient=patient_profile.name, date=appointment.date.isoformat(),
+        )
+        return appointment
+
+    appointment = run_write(insert, using=_write_alias(Appointment, patient=request.user))
 
     return Response({
         '_id': str(appointment.id),
@@ -314,32 +549,63 @@ def create_appointment(request):
 @api_view(['GET'])
 @permission_classes([AllowAny])
 def get_messages(request):
-    from .models import Message
-    from django.db import models
-    
-    # Get all messages for demo purposes
-    messages = Message.objects.all().order_by('-timestamp')
-    
-    messages_data = []
-    for msg in messages:
-        messages_data.append({
-            '_id': str(msg.id),
-            'senderId': str(msg.sender.id),
-            'senderName': msg.sender.email,
-            'receiverId': str(msg.receiver.id),
-            'receiverName': msg.receiver.email,
-            'content': msg.content,
-            'timestamp': msg.timestamp.isoformat(),
-            'isRead': msg.is_read
-        })
-    
-    return Response({'messages': messages_data})
+    # Get all messages for demo purposes, newest first (one page by id with cursor/limit)
+    hot = Message.objects.select_related('sender', 'receiver')
+    archived = ArchivedMessage.objects.select_related('sender', 'receiver')
+    if not wants_page(request):
+        return Response({'messages': [_message_data(msg) for msg in read_all('messages', hot, archived)]})
+
+    cursor, limit = parse_page_params(request)
+    messages, next_cursor = read_page('messages', hot, archived, cursor=cursor, limit=limit)
+    
+    messages_data = [_message_data(msg) for msg in messages]
+    
+    return Response({'messages': messages_data, 'nextCursor': next_cursor})
+
+def _message_data(msg):
+    return {
+        '_id': str(msg.id),
+        'senderId': str(msg.sender.id),
+        'senderName': msg.sender.email,
+        'receiverId': str(msg.receiver.id),
+        'receiverName': msg.receiver.email,
+        'content': msg.content,
+        'timestamp': msg.timestamp.isoformat(),
+        'isRead': msg.is_read
+    }
+
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def get_thread(request, user_id):
+    """One page of the conversation with ``user_id``, newest first.
+
+    Opening the thread (no cursor) first marks the caller's unread messages
+    in it as read; ``markedRead`` says how many.
+    """
+    if not getattr(request, 'user', None) or request.user.is_anonymous:
+        return Response({'message': 'Authentication required'}, status=status.HTTP_401_UNAUTHORIZED)
+
+    try:
+        other = User.objects.get(id=user_id)
+    except User.DoesNotExist:
+        return Response({'message': 'User not found'}, status=status.HTTP_404_NOT_FOUND)
+
+    _, limit = parse_page_params(request)
+    cursor = request.query_params.get('cursor')
+    if cursor is not None and decode_cursor(cursor) is None:
+        return Response({'message': 'Invalid cursor'}, status=status.HTTP_400_BAD_REQUEST)
+    marked = mark_read(request.user, other) if cursor is None else 0
+    messages, next_cursor = read_thread(request.user, other, cursor=cursor, limit=limit)
+
+    return Response({
+        'messages': [_message_data(msg) for msg in messages],
+        'nextCursor': next_cursor,
+        'markedRead': marked,
+    })
 
 @api_view(['GET'])
 @permission_classes([AllowAny])
 def get_conversations(request):
-    from .models import Doctor
-    
     # Get all doctors as potential conversations
     doctors = Doctor.objects.all()[:5]
     conversations_data = []
@@ -359,9 +625,8 @@ def get_conversations(request):
 
 @api_view(['POST'])
 @permission_classes([AllowAny])
+@idempotent('send_message')
 def send_message(request):
-    from .models import Message, Doctor
-    
     doctor_id = request.data.get('doctorId')
     content = request.data.get('content')
     
@@ -387,12 +652,17 @@ def send_message(request):
         receiver = doctor.user
     
     # Create message
-    message = Message.objects.create(
-        sender=sender,
-        receiver=receiver,
-        content=content,
-        is_read=False
-    )
+    def insert():
+        message = Message.objects.create(
+            sender=sender,
+            receiver=receiver,
+            content=content,
+            is_read=False
+        )
+        notifications.enqueue(receiver.id, 'message_received', sender=sender.email, preview=(content or '')[:200])
+        return message
+
+    message = run_write(insert, using=_write_alias(Message, sender=sender, receiver=receiver))
     
     return Response({
         'success': True,
@@ -402,10 +672,12 @@ def send_message(request):
 @api_view(['GET'])
 @permission_classes([AllowAny])
 def get_reports(request):
-    from .models import Report
-    
-    # Get all reports for demo purposes
-    reports = Report.objects.all().order_by('-created_at')
+    # Get all reports for demo purposes, merged across every shard
+    reports = merge_sorted(
+        fan_out(lambda alias: list(Report.objects.using(alias).select_related('prediction').order_by('-created_at'))),
+        key=lambda report: report.created_at,
+        reverse=True,
+    )
     reports_data = []
     
     for report in reports:
@@ -420,17 +692,53 @@ def get_reports(request):
     
     return Response({'reports': reports_data})
 
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def similar_predictions(request, prediction_id):
+    """Doctors and staff: past cases whose images are closest to this prediction's."""
+    if not getattr(request, 'user', None) or request.user.is_anonymous:
+        return Response({'message': 'Authentication required'}, status=status.HTTP_401_UNAUTHORIZED)
+    if not request.user.is_staff and request.user.role != 'doctor':
+        return Response({'message': 'Only doctors can look up similar cases'}, status=status.HTTP_403_FORBIDDEN)
+
+    max_k = getattr(settings, 'SIMILARITY_MAX_K', 50)
+    try:
+        k = max(1, min(int(request.query_params.get('k', 10)), max_k))
+    except ValueError:
+        return Response({'message': 'k must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
+
+    cases = similar_cases(prediction_id, k)
+    if cases is None:
+        return Response({'message': 'No image embedding for this prediction'}, status=status.HTTP_404_NOT_FOUND)
+    return Response({'predictionId': str(prediction_id), 'similar': cases})
+
 @api_view(['POST'])
 @permission_classes([AllowAny])
 def refresh_token(request):
     return Response({'success': True, 'data': {'accessToken': 'token', 'refreshToken': 'token'}})
 
+def _write_alias(model, **fields):
+    """Database a new ``model(**fields)`` row is saved to (its patient's shard)."""
+    return router.db_for_write(model, instance=model(**fields))
+
+
+def _insert_demo_prediction(user):
+    prediction = Prediction.objects.create(
+        user=user,
+        disease='Melanoma',
+        confidence=87.5,
+        image_url='https://via.placeholder.com/150',
+        body_part='Arm',
+        symptoms='Sample symptoms',
+        duration='2 weeks'
+    )
+    record_prediction_created(prediction)
+    return prediction
+
 @api_view(['POST'])
 @permission_classes([AllowAny])
+@idempotent('generate_report')
 def generate_report(request):
-    from .models import Report, Prediction, Patient
-    import uuid
-    
     # Remove authentication check for now
     # if request.user.is_anonymous:
     #     return Response({'error': 'Authentication required'}, status=401)
@@ -478,15 +786,7 @@ def generate_report(request):
             else:
                 real_user = request.user
                 
-            prediction = Prediction.objects.create(
-                user=real_user,
-                disease='Melanoma',
-                confidence=87.5,
-                image_url='https://via.placeholder.com/150',
-                body_part='Arm',
-                symptoms='Sample symptoms',
-                duration='2 weeks'
-            )
+            prediction = run_write(lambda: _insert_demo_prediction(real_user), using=_write_alias(Prediction, user=real_user))
     except Prediction.DoesNotExist:
         # Create a mock prediction
         # Get a real user for prediction
@@ -509,25 +809,17 @@ def generate_report(request):
         else:
             real_user = request.user
             
-        prediction = Prediction.objects.create(
-            user=real_user,
-            disease='Melanoma',
-            confidence=87.5,
-            image_url='https://via.placeholder.com/150',
-            body_part='Arm',
-            symptoms='Sample symptoms',
-            duration='2 weeks'
-        )
+        prediction = run_write(lambda: _insert_demo_prediction(real_user), using=_write_alias(Prediction, user=real_user))
     
     # Create report
-    report = Report.objects.create(
+    report = run_write(lambda: Report.objects.create(
         patient=real_user,
         prediction=prediction,
         patient_name=patient_name,
         patient_age=patient_age,
         patient_gender=patient_gender,
         pdf_url=f'/reports/report_{prediction.id}.pdf'
-    )
+    ), using=_write_alias(Report, patient=real_user))
     
     return Response({
         '_id': str(report.id),
@@ -544,8 +836,6 @@ def generate_report(request):
 @api_view(['POST'])
 @permission_classes([AllowAny])
 def register(request):
-    import traceback
-
     try:
         email = request.data.get('email')
         password = request.data.get('password')
@@ -585,9 +875,6 @@ def upsert_patient_profile(request):
        POST: create or update the Patient profile for the authenticated user.
        Expects (POST): { name: string, age?: int, gender?: string, mail_id?: string }
     """
-    from .models import Patient
-    from rest_framework import status
-
     if not getattr(request, 'user', None) or request.user.is_anonymous:
         return Response({'message': 'Authentication required'}, status=status.HTTP_401_UNAUTHORIZED)
 
@@ -645,15 +932,12 @@ def upsert_patient_profile(request):
 
         return Response({'success': True, 'message': 'Profile saved'})
     except Exception as e:
-        import traceback
         traceback.print_exc()
         return Response({'message': 'Failed to save profile'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 @api_view(['POST'])
 @permission_classes([AllowAny])
 def login(request):
-    from django.contrib.auth import authenticate
-    
     email = request.data.get('email')
     password = request.data.get('password')
     
@@ -670,14 +954,12 @@ def login(request):
         # Get user's name based on role
         name = user.email
         if user.role == 'doctor':
-            from .models import Doctor
             try:
                 doctor = Doctor.objects.get(user=user)
                 name = doctor.fam_dr_name
             except Doctor.DoesNotExist:
                 pass
         elif user.role == 'patient':
-            from .models import Patient
             try:
                 patient = Patient.objects.get(user=user)
                 name = patient.name
@@ -700,6 +982,5 @@ def login(request):
         })
             
     except Exception as e:
-        import traceback
         traceback.print_exc()
         return Response({'message': 'Email or password is incorrect'}, status=400)
\ No newline at end of file
@@ -0,0 +1,134 @@
+"""Start-up warm-up: do the first-request work before the worker takes traffic.
+
+A cold worker's first requests pay for importing the views and everything
+they use, compiling the URL patterns, resolving DRF's settings strings into
+classes, connecting to each database and filling the read caches. With
+WARMUP_ON_START set, the WSGI/ASGI entry points call ``warm_up`` at import
+time, which does all of that up front and fails the boot if something is
+misconfigured (a missing module, a bad route, an unreachable database).
+
+SKIN_MODEL_PRELOAD on its own runs just the ``model`` step.
+
+Under ``gunicorn --preload`` (gunicorn.conf.py) the warm-up runs once in the
+master and forked workers inherit the imported modules, compiled patterns
+and primed in-process caches. Database connections and connection pools
+must not be inherited (every worker would draw from the same sockets), so
+the master drops them with ``release_connections`` before each fork, and
+each worker opens its own with ``warm_connections`` before serving.
+"""
+import importlib
+import logging
+import time
+
+from django.conf import settings
+from django.db import connections
+from django.urls import URLPattern, URLResolver, get_resolver
+
+logger = logging.getLogger(__name__)
+
+
+def import_modules():
+    """Import the view layer and everything it pulls in."""
+    importlib.import_module(settings.ROOT_URLCONF)
+    for path in getattr(settings, 'WARMUP_MODULES', ()):
+        importlib.import_module(path)
+
+
+def compile_urls(resolver=None):
+    """Compile every route's regex now instead of on its first match; returns the count."""
+    resolver = resolver or get_resolver()
+    resolver._populate()
+    compiled = 0
+    for pattern in resolver.url_patterns:
+        pattern.pattern.regex  # compiled lazily on first access
+        if isinstance(pattern, URLResolver):
+            compiled += compile_urls(pattern)
+        elif isinstance(pattern, URLPattern):
+            pattern.lookup_str
+            compiled += 1
+    return compiled
+
+
+def load_rest_framework():
+    """Resolve and instantiate DRF's default renderers, parsers, auth, permissions and throttles."""
+    from rest_framework.negotiation import DefaultContentNegotiation
+    from rest_framework.settings import api_settings
+
+    DefaultContentNegotiation()
+    for name in ('DEFAULT_RENDERER_CLASSES', 'DEFAULT_PARSER_CLASSES', 'DEFAULT_AUTHENTICATION_CLASSES',
+                 'DEFAULT_PERMISSION_CLASSES', 'DEFAULT_THROTTLE_CLASSES'):
+        for cls in getattr(api_settings, name):
+            cls()
+
+
+def warm_connections():
+    """Open each database's connection for this thread and check it answers."""
+    for alias in connections:
+        with connections[alias].cursor() as cursor:
+            cursor.execute('SELECT 1')
+            cursor.fetchone()
+    return len(connections.all())
+
+
+def release_connections():
+    """Close every connection and connection pool this process holds."""
+    connections.close_all()
+    for connection in connections.all(initialized_only=True):
+        # Only pools that exist: the ``pool`` property creates one on access
+        if connection.alias in getattr(connection, '_connection_pools', {}):
+            connection.close_pool()
+
+
+def prime_caches():
+    """Fill the read caches the busiest endpoints serve from."""
+    from . import views
+    from .analytics import disease_trends
+    from .similarity import get_index
+    from .singleflight import cached
+
+    primed = getattr(settings, 'WARMUP_CACHES', ())
+    if 'doctors' in primed:
+        cached('doctors:roster', views._doctor_roster, ttl=settings.DOCTOR_CACHE_SECONDS)
+    if 'analytics' in primed:
+        disease_trends()
+    if 'similarity' in primed:
+        get_index()
+
+
+def load_model():
+    """Load the classifier and fault in its weights (SKIN_MODEL_PRELOAD)."""
+    if getattr(settings, 'SKIN_MODEL_PRELOAD', False):
+        from .inference import warm_up as warm_model
+
+        warm_model()
+
+
+STEPS = (
+    ('imports', import_modules),
+    ('urls', compile_urls),
+    ('rest_framework', load_rest_framework),
+    ('databases', warm_connections),
+    ('caches', prime_caches),
+    ('model', load_model),
+)
+
+
+def warm_up(only=None):
+    """Run every step (or those named in ``only``) in order; returns ``{step: seconds}``.
+
+    A failing step raises.
+    """
+    timings = {}
+    for name, step in STEPS:
+        if only is not None and name not in only:
+            continue
+        started = time.perf_counter()
+        try:
+            step()
+        except Exception:
+            logger.exception('Warm-up step %s failed', name)
+            raise
+        timings[name] = time.perf_counter() - started
+    logger.info('Warm-up done in %.2fs: %s', sum(timings.values()),
+                ', '.join(f'{name} {seconds * 1000:.0f}ms' for name, seconds in timings.items()))
+    return timings
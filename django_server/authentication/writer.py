@@ -0,0 +1,162 @@
+"""Single-writer queue for ORM writes (group commit).
+
+SQLite allows one writer at a time. When several request threads insert at
+once, all but one wait on the database lock, and under load some give up
+with ``database is locked``. With WRITE_QUEUE_ENABLED, ``run_write(fn)``
+does not run ``fn`` in the request thread. It hands ``fn`` to a single writer
+thread per process, which drains up to WRITE_QUEUE_BATCH_SIZE pending writes
+and commits them in one transaction. Each write runs in its own savepoint,
+so one failing write does not take the rest of the batch with it.
+
+``run_write(fn, using=alias)`` names the database the write goes to: with
+sharding, a patient's shard (``router.db_for_write`` with the new row as the
+``instance`` hint). ``fn`` then runs in a transaction on that shard, so the
+row and the outbox event recorded with it commit or roll back together, and
+in one on ``default`` for what it records there (rollups, notifications).
+The writer thread keeps one group-commit transaction per database.
+
+With the queue disabled, or when the caller is already inside a
+transaction on either database, ``fn`` simply runs inline.
+
+On SQLite, ``write_transaction`` begins with ``BEGIN IMMEDIATE``, taking the
+write lock up front so a busy database is waited on for the connection
+``timeout`` instead of failing on a read-to-write lock upgrade. Every other
+transaction stays DEFERRED, so read-only blocks (exports, reports) never
+hold the write lock.
+
+``run_write`` always waits for the writer's answer. Giving up early could
+report a failure for a write that then commits, and the client's retry
+would write it twice.
+"""
+import queue
+import threading
+from concurrent.futures import Future
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+_queue = queue.Queue()
+_writer = None
+_writer_lock = threading.Lock()
+
+
+@contextmanager
+def write_transaction(using=None):
+    """``transaction.atomic(using)`` that takes SQLite's write lock when it begins."""
+    db = connections[using or DEFAULT_DB_ALIAS]
+    if db.vendor != 'sqlite' or db.in_atomic_block:
+        with transaction.atomic(using=using):
+            yield
+        return
+    db.ensure_connection()
+    mode = db.transaction_mode
+    db.transaction_mode = 'IMMEDIATE'
+    try:
+        with transaction.atomic(using=using):
+            db.transaction_mode = mode
+            yield
+    finally:
+        db.transaction_mode = mode
+
+
+def _aliases(using):
+    # The write's database first, then default; always in that order
+    using = using or DEFAULT_DB_ALIAS
+    return [using] if using == DEFAULT_DB_ALIAS else [using, DEFAULT_DB_ALIAS]
+
+
+@contextmanager
+def write_transactions(using=None):
+    """``write_transaction`` on ``using`` and, for a shard, on ``default`` as well.
+
+    For writes to a shard that also record rollups or notifications, which
+    are stored on ``default``.
+    """
+    with ExitStack() as stack:
+        for alias in _aliases(using):
+            stack.enter_context(write_transaction(using=alias))
+        yield
+
+
+@contextmanager
+def _savepoints(aliases):
+    with ExitStack() as stack:
+        for alias in aliases:
+            stack.enter_context(transaction.atomic(using=alias))
+        yield
+
+
+def _drain(first):
+    batch = [first]
+    linger = getattr(settings, 'WRITE_QUEUE_LINGER_MS', 2) / 1000
+    limit = getattr(settings, 'WRITE_QUEUE_BATCH_SIZE', 100)
+    while len(batch) < limit:
+        try:
+            batch.append(_queue.get(timeout=linger) if linger else _queue.get_nowait())
+        except queue.Empty:
+            break
+    return batch
+
+
+def _commit(batch):
+    by_alias = {}
+    for fn, future, using in batch:
+        by_alias.setdefault(using, []).append((fn, future))
+    for using, writes in by_alias.items():
+        _commit_group(using, writes)
+
+
+def _commit_group(using, batch):
+    aliases = _aliases(using)
+    outcomes = []
+    try:
+        for alias in aliases:
+            connections[alias].close_if_unusable_or_obsolete()
+        with write_transactions(using):
+            for fn, future in batch:
+                try:
+                    with _savepoints(aliases):
+                        outcomes.append((future, fn(), None))
+                except Exception as exc:
+                    outcomes.append((future, None, exc))
+    except Exception as exc:
+        # The group commit itself failed: nothing in the batch was written
+        for _, future in batch:
+            future.set_exception(exc)
+        return
+    for future, result, exc in outcomes:
+        if exc is None:
+            future.set_result(result)
+        else:
+            future.set_exception(exc)
+
+
+def _run():
+    while True:
+        _commit(_drain(_queue.get()))
+
+
+def _ensure_writer():
+    global _writer
+    if _writer is None or not _writer.is_alive():
+        with _writer_lock:
+            if _writer is None or not _writer.is_alive():
+                _writer = threading.Thread(target=_run, name='db-writer', daemon=True)
+                _writer.start()
+
+
+def run_write(fn, using=None):
+    """Run the write ``fn()`` atomically on ``using`` and return its result (see module docs)."""
+    using = using or DEFAULT_DB_ALIAS
+    # Inside a transaction the writer thread would wait for the caller's locks
+    if not getattr(settings, 'WRITE_QUEUE_ENABLED', False) or any(
+        connections[alias].in_atomic_block for alias in _aliases(using)
+    ):
+        with write_transactions(using):
+            return fn()
+
+    _ensure_writer()
+    future = Future()
+    _queue.put((fn, future, using))
+    return future.result()
@@ -14,3 +14,10 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'epicure_skin.settings')
 
 application = get_asgi_application()
+
+from django.conf import settings  # noqa: E402
+
+if settings.WARMUP_ON_START or settings.SKIN_MODEL_PRELOAD:
+    from authentication.warmup import warm_up
+
+    warm_up(only=None if settings.WARMUP_ON_START else ['model'])
@@ -1,3 +1,4 @@
+import os
 from pathlib import Path
 
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -20,7 +21,9 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'corsheaders.middleware.CorsMiddleware',
+    'authentication.middleware.AdmissionControlMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'authentication.middleware.RequestProfilingMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -49,12 +52,72 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'epicure_skin.wsgi.application'
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# DB_ENGINE=postgresql switches to PostgreSQL (POSTGRES_DB, POSTGRES_USER,
+# POSTGRES_PASSWORD, POSTGRES_HOST, POSTGRES_PORT) with a psycopg 3 connection
+# pool per worker (psycopg[pool]); POSTGRES_POOL=0 falls back to persistent
+# connections. Behind PgBouncer in transaction mode set
+# POSTGRES_SERVER_SIDE_CURSORS=0, since .iterator() otherwise streams through
+# named cursors. Anything else keeps the local SQLite file.
+if os.environ.get('DB_ENGINE') == 'postgresql':
+    POSTGRES_POOL = os.environ.get('POSTGRES_POOL', '1') == '1'
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('POSTGRES_DB', 'epicure_skin'),
+            'USER': os.environ.get('POSTGRES_USER', 'postgres'),
+            'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+            'HOST': os.environ.get('POSTGRES_HOST', 'localhost'),
+            'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+            'OPTIONS': {
+                'pool': {
+                    'min_size': int(os.environ.get('POSTGRES_POOL_MIN_SIZE', 2)),
+                    'max_size': int(os.environ.get('POSTGRES_POOL_MAX_SIZE', 10)),
+                    'timeout': float(os.environ.get('POSTGRES_POOL_TIMEOUT', 10)),
+                },
+            } if POSTGRES_POOL else {},
+            # Django's pool requires non-persistent connections: "closing"
+            # returns the connection to the pool instead.
+            'CONN_MAX_AGE': 0 if POSTGRES_POOL else 60,
+            'CONN_HEALTH_CHECKS': not POSTGRES_POOL,
+            'DISABLE_SERVER_SIDE_CURSORS': os.environ.get('POSTGRES_SERVER_SIDE_CURSORS', '1') == '0',
+        }
     }
-}
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'db.sqlite3',
+            # WAL lets readers run alongside the writer. Transactions stay
+            # DEFERRED so read-only ones never take the write lock; write paths
+            # begin IMMEDIATE themselves (authentication/writer.py).
+            'OPTIONS': {
+                'init_command': 'PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL',
+                'timeout': 20,
+            },
+            'CONN_MAX_AGE': 60,
+            'CONN_HEALTH_CHECKS': True,
+        }
+    }
+
+# Horizontal sharding (authentication/sharding.py): each patient's
+# predictions, appointments, messages and reports live on one shard; users,
+# patients and doctors are copied to all of them. EPICURE_SHARDS=shard1,shard2
+# adds shards next to `default` (SQLite files beside db.sqlite3, or databases
+# of that name on the same PostgreSQL server); then run `manage.py shards init`.
+# Empty = no sharding.
+SHARDS = []
+for _alias in filter(None, os.environ.get('EPICURE_SHARDS', '').split(',')):
+    _sqlite = DATABASES['default']['ENGINE'].endswith('sqlite3')
+    DATABASES.setdefault(_alias, {
+        **DATABASES['default'],
+        'NAME': BASE_DIR / f'{_alias}.sqlite3' if _sqlite else _alias,
+    })
+    SHARDS = SHARDS or ['default']
+    SHARDS.append(_alias)
+DATABASE_ROUTERS = ['authentication.sharding.ShardRouter']
+# Primary keys each shard allocates from (shard N starts at N * SHARD_ID_SPAN)
+SHARD_ID_SPAN = 10 ** 12
+SHARD_MAP_CACHE_SECONDS = 60
 
 LANGUAGE_CODE = 'en-us'
 TIME_ZONE = 'UTC'
@@ -75,4 +138,219 @@ REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
         'authentication.authentication.SimpleJWTAuthentication',
     ),
-}
\ No newline at end of file
+    # Sliding-window limits (authentication/throttling.py), keyed by
+    # '<view name>.ip' and '<view name>.user'; views not listed are unlimited.
+    'DEFAULT_THROTTLE_CLASSES': (
+        'authentication.throttling.IPRateThrottle',
+        'authentication.throttling.UserRateThrottle',
+    ),
+    'DEFAULT_THROTTLE_RATES': {
+        'login.ip': '20/min',
+        'register.ip': '10/min',
+        'send_message.ip': '120/min',
+        'send_message.user': '60/min',
+        'generate_report.ip': '60/min',
+        'generate_report.user': '20/min',
+    },
+}
+
+# Counter file the rate limiter shares between this project's processes
+RATELIMIT_DB_PATH = BASE_DIR / 'ratelimit.sqlite3'
+
+# Cursor pagination for list endpoints (?cursor=<id>&limit=<n>).
+API_PAGE_SIZE = 100
+API_MAX_PAGE_SIZE = 500
+
+# Predictions and messages older than this many days are moved to the archive
+# tables by `manage.py archive_old_rows`, ARCHIVE_BATCH_SIZE rows per transaction.
+ARCHIVE_HORIZON_DAYS = 180
+ARCHIVE_BATCH_SIZE = 1000
+
+# Prediction analytics: rows fetched per chunk when building the NumPy column
+# snapshot, the longest a snapshot is served before it is reloaded even when
+# the tables look unchanged, and how long computed trend reports stay cached.
+ANALYTICS_CHUNK_SIZE = 50000
+ANALYTICS_SNAPSHOT_MAX_AGE = 600
+ANALYTICS_CACHE_SECONDS = 300
+
+# Rows fetched per .iterator() chunk (and per Parquet row group) by exports.
+EXPORT_CHUNK_SIZE = 2000
+
+# Admin changelists over unfiltered tables with more rows than this use an
+# estimated row count instead of an exact COUNT(*); at most this many rows
+# are counted to find out.
+ADMIN_ESTIMATED_COUNT_THRESHOLD = 10000
+
+# Maximum number of appointment ids accepted by appointments/bulk-status.
+BULK_STATUS_MAX_IDS = 200
+
+# Run the patient dashboard's queries concurrently on a thread pool. Each
+# thread opens its own connection, so only worth it with pooled connections.
+DASHBOARD_PARALLEL_QUERIES = False
+
+# POST /api/auth/batch: maximum sub-requests per batch and how many
+# independent GETs may run at once.
+BATCH_MAX_REQUESTS = 20
+BATCH_MAX_CONCURRENCY = 4
+
+# Doctor roster/detail caching (authentication/singleflight.py). Concurrent
+# misses for one key wait on a single computation; for SINGLEFLIGHT_STALE_SECONDS
+# after expiry the old value is served while one request refreshes it. Unknown
+# ids are remembered for SINGLEFLIGHT_MISS_SECONDS. Editing a doctor drops its
+# entries. LocMemCache coalesces within each process only: point CACHES at a
+# shared backend (redis, memcached, file) to coalesce across workers.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+DOCTOR_CACHE_SECONDS = 300
+SINGLEFLIGHT_STALE_SECONDS = 30
+SINGLEFLIGHT_MISS_SECONDS = 5
+SINGLEFLIGHT_WAIT_SECONDS = 10
+SINGLEFLIGHT_STRIPES = 64
+SINGLEFLIGHT_LOCK_DIR = None  # defaults to <tmp>/epicure-singleflight
+
+# Idempotency-Key support on create_appointment, send_message and
+# generate_report (authenticated callers only): how long stored responses are
+# replayed, how long a duplicate waits for an in-flight first attempt before
+# getting a 409, and after how long an unfinished attempt is presumed dead and
+# a retry may run the request again (keep it above the worker timeout).
+IDEMPOTENCY_TTL_SECONDS = 24 * 60 * 60
+IDEMPOTENCY_WAIT_SECONDS = 10
+IDEMPOTENCY_LEASE_SECONDS = 120
+
+# Opt-in request profiling (authentication/middleware.py). When enabled, a
+# request is profiled if it sends a valid signed X-Profile header
+# (manage.py profile_token) or is sampled at PROFILING_SAMPLE_RATE. Profiles
+# are browsable by staff at /api/auth/profiles. They are kept in a 0700
+# directory; SQL parameters and query strings are only recorded with
+# PROFILING_RECORD_PARAMS, as they can carry personal data.
+PROFILING_ENABLED = False
+PROFILING_SAMPLE_RATE = 0.0
+PROFILING_INTERVAL_MS = 5
+PROFILING_SLOW_QUERY_MS = 50
+PROFILING_TOKEN_MAX_AGE = 60 * 60
+PROFILING_DIR = None  # defaults to BASE_DIR / 'profiles'
+PROFILING_RECORD_PARAMS = False
+PROFILING_MAX_FILES = 200
+
+# Admission control (authentication/middleware.py): views are grouped into
+# classes, each with its own concurrency limit and bounded wait queue.
+# Requests that cannot be admitted within `timeout` seconds get a 503 with
+# Retry-After. Views missing from ADMISSION_ROUTES use ADMISSION_DEFAULT_CLASS
+# (None = unlimited). Batch items are admitted individually, so `batch`
+# itself is unlimited. Live numbers: /api/auth/admission/stats (staff).
+ADMISSION_CONTROL_ENABLED = True
+ADMISSION_CLASSES = {
+    'auth': {'concurrency': 4, 'queue': 32, 'timeout': 2.0},
+    'write': {'concurrency': 8, 'queue': 64, 'timeout': 5.0},
+    'heavy': {'concurrency': 2, 'queue': 8, 'timeout': 10.0},
+    'read': {'concurrency': 32, 'queue': 256, 'timeout': 5.0},
+}
+ADMISSION_ROUTES = {
+    'login': 'auth',
+    'register': 'auth',
+    'create_appointment': 'write',
+    'cancel_appointment': 'write',
+    'confirm_appointment': 'write',
+    'update_appointment_status': 'write',
+    'bulk_update_appointment_status': 'write',
+    'send_message': 'write',
+    'generate_report': 'write',
+    'upsert_patient_profile': 'write',
+    'export_data': 'heavy',
+    'disease_analytics': 'heavy',
+    'get_doctors': 'read',
+    'get_doctor_by_id': 'read',
+    'get_predictions': 'read',
+    'get_appointments': 'read',
+    'get_messages': 'read',
+    'get_reports': 'read',
+    'get_conversations': 'read',
+    'patient_dashboard': 'read',
+    'dashboard_stats': 'read',
+}
+ADMISSION_DEFAULT_CLASS = None
+
+# Single-writer queue (authentication/writer.py): when enabled, message,
+# appointment and report inserts are funnelled through one writer thread per
+# process that commits up to WRITE_QUEUE_BATCH_SIZE of them per transaction,
+# waiting WRITE_QUEUE_LINGER_MS for a batch to fill.
+WRITE_QUEUE_ENABLED = False
+WRITE_QUEUE_BATCH_SIZE = 100
+WRITE_QUEUE_LINGER_MS = 2
+
+# Notification emails (authentication/notifications.py), delivered by
+# `manage.py send_notifications` through Django's EMAIL_* settings. Events for
+# one recipient within NOTIFICATION_DIGEST_SECONDS go out as one email.
+NOTIFICATIONS_ENABLED = True
+EMAIL_HOST = os.environ.get('EMAIL_HOST', 'localhost')
+EMAIL_PORT = int(os.environ.get('EMAIL_PORT', 25))
+EMAIL_HOST_USER = os.environ.get('EMAIL_HOST_USER', '')
+EMAIL_HOST_PASSWORD = os.environ.get('EMAIL_HOST_PASSWORD', '')
+EMAIL_USE_TLS = os.environ.get('EMAIL_USE_TLS', '0') == '1'
+DEFAULT_FROM_EMAIL = os.environ.get('DEFAULT_FROM_EMAIL', 'Epicure Skin <no-reply@epicure-skin.local>')
+NOTIFICATION_DIGEST_SECONDS = 60
+NOTIFICATION_POLL_SECONDS = 2
+NOTIFICATION_SMTP_CONNECTIONS = 4
+NOTIFICATION_RETRY_BASE_SECONDS = 30
+NOTIFICATION_MAX_ATTEMPTS = 6
+NOTIFICATION_LEASE_SECONDS = 300
+NOTIFICATION_RETENTION_DAYS = 7
+
+# Appointment reminders (authentication/reminders.py), sent by
+# `manage.py run_reminders` REMINDER_LEAD_MINUTES before each appointment.
+# The timing wheel ticks every REMINDER_TICK_SECONDS; its slot counts per level
+# set the horizon held in memory (60 x 60 x 24 one-second ticks = one day).
+# Reminders missed while the scheduler was down are still sent if no more
+# than REMINDER_GRACE_MINUTES late.
+REMINDER_TICK_SECONDS = 1
+REMINDER_LEAD_MINUTES = 60
+REMINDER_GRACE_MINUTES = 30
+REMINDER_WHEEL_SIZES = (60, 60, 24)
+
+# Transactional outbox (authentication/outbox.py): every change to
+# predictions, appointments, messages and reports is logged in the same
+# transaction. Consumers tail it with `manage.py stream_outbox <consumer>` or
+# /api/auth/outbox/events (staff). Events every consumer has read are
+# compacted away after OUTBOX_RETENTION_HOURS. On PostgreSQL, events are read
+# in transaction order and only once every earlier transaction has finished.
+OUTBOX_ENABLED = True
+OUTBOX_BATCH_SIZE = 500
+OUTBOX_RETENTION_HOURS = 72
+
+# Similar-case search (authentication/similarity.py) over prediction image
+# embeddings. `manage.py embed_predictions` fills them in with
+# EMBEDDING_ENCODER, a dotted path to `encode(predictions) -> (n, dim) array`,
+# and `--save-index` writes a memory-mapped index to SIMILARITY_INDEX_PATH
+# for workers to share. SIMILARITY_IVF_LISTS = 0 searches exactly; around
+# sqrt(N) lists with SIMILARITY_IVF_PROBES probed trades recall for speed.
+EMBEDDING_ENCODER = os.environ.get('EMBEDDING_ENCODER') or None
+SIMILARITY_INDEX_PATH = os.environ.get('SIMILARITY_INDEX_PATH', str(BASE_DIR / 'similarity_index'))
+SIMILARITY_IVF_LISTS = 0
+SIMILARITY_IVF_PROBES = 16
+SIMILARITY_REFRESH_SECONDS = 30
+SIMILARITY_MERGE_ROWS = 50000
+SIMILARITY_MAX_K = 50
+
+# Offline re-scoring (`manage.py rescore_predictions`, authentication/
+# rescoring.py). SKIN_MODEL_LOADER is a dotted path to a zero-argument
+# callable returning the classifier; see authentication/inference.py.
+# SKIN_MODEL_WEIGHTS is its flat weights file (`manage.py convert_weights`),
+# memory-mapped so all workers share one copy. SKIN_MODEL_PRELOAD loads the
+# model and faults the weights in when the WSGI/ASGI app is imported (on its
+# own or as part of the EPICURE_WARMUP warm-up).
+SKIN_MODEL_LOADER = os.environ.get('SKIN_MODEL_LOADER') or None
+SKIN_MODEL_WEIGHTS = os.environ.get('SKIN_MODEL_WEIGHTS', str(BASE_DIR / 'skin_model.weights'))
+SKIN_MODEL_PRELOAD = os.environ.get('SKIN_MODEL_PRELOAD', '') == '1'
+RESCORE_FETCH_TIMEOUT_SECONDS = 10
+
+# Start-up warm-up (authentication/warmup.py). With EPICURE_WARMUP=1 the
+# WSGI/ASGI app imports the views, compiles the URL patterns, loads DRF's
+# classes, connects to every database and primes WARMUP_CACHES before taking
+# traffic. WARMUP_MODULES lists extra modules to import up front (optional
+# exporters such as 'pyarrow.parquet').
+WARMUP_ON_START = os.environ.get('EPICURE_WARMUP', '') == '1'
+WARMUP_CACHES = ('doctors', 'analytics', 'similarity')
+WARMUP_MODULES = ()
@@ -0,0 +1,33 @@
+"""Gunicorn settings: `gunicorn epicure_skin.wsgi` (run from django_server/).
+
+preload_app imports the project once in the master. With EPICURE_WARMUP=1
+that also runs the start-up warm-up (authentication/warmup.py) there; the
+master then closes its database connections and pools before forking, and
+each worker opens its own. SKIN_MODEL_PRELOAD=1 loads the classifier and
+faults in its memory-mapped weights, so forked workers start serving at once and share
+those pages instead of each reading its own copy. Uvicorn workers
+(`-k uvicorn.workers.UvicornWorker` with epicure_skin.asgi) get the same
+sharing through the page cache even without preload.
+"""
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', os.cpu_count() or 1))
+preload_app = True
+timeout = 60
+
+
+def pre_fork(server, worker):
+    # Connections and pools opened while preloading must not be shared across processes
+    from authentication.warmup import release_connections
+
+    release_connections()
+
+
+def post_worker_init(worker):
+    from django.conf import settings
+
+    if settings.WARMUP_ON_START:
+        from authentication.warmup import warm_connections
+
+        warm_connections()